@@ -13,10 +13,22 @@ stephl25@uci.edu
 # No pylint catching for the file naming of Profile.py
 # pylint: disable=invalid-name
 
+import bisect
 import json
+import mmap
+import os
+import shutil
+import sys
+import threading
 import time
+from collections import deque
 from pathlib import Path
 
+DSU_VERSION = 2
+# a lazy load reads at most this many lines per message it may load,
+# so friends with few (or no) messages do not make it read the whole file
+LAZY_SCAN_FACTOR = 2
+
 
 class DsuFileError(Exception):
     '''
@@ -31,11 +43,19 @@ class DsuProfileError(Exception):
     '''
 
 
-class Message(dict):
+class Message:
     '''
-    Creates a Message dict that stores all messages for the user,
-    both sent and received.
+    Stores one message of the user, sent or received.
+
+    Messages use __slots__ instead of a dict so that a profile with a
+    long history stays small: no per-message __dict__ and every field
+    stored once. Usernames are interned, the many messages of one
+    contact share a single string. message['entry'] style access
+    still works for the entry, timestamp, from_user and to_user keys.
     '''
+    __slots__ = ('_entry', '_timestamp', '_from_user', '_to_user')
+    KEYS = ('entry', 'timestamp', 'from_user', 'to_user')
+
     def __init__(self, entry: str = None,
                  timestamp: float = 0,
                  from_user: str = None,
@@ -45,17 +65,11 @@ class Message(dict):
         self.set_to_user(to_user)
         self.set_from_user(from_user)
 
-        dict.__init__(self, entry=self._entry,
-                      timestamp=self._timestamp,
-                      from_user=self._from_user,
-                      to_user=self._to_user)
-
     def set_to_user(self, to_user):
         '''
-        Set a dict key and value for the user the message was sent to.
+        Set the user the message was sent to.
         '''
-        self._to_user = to_user
-        dict.__setitem__(self, 'to_user', to_user)
+        self._to_user = sys.intern(to_user) if isinstance(to_user, str) else to_user
 
     def get_to_user(self):
         '''
@@ -65,10 +79,9 @@ class Message(dict):
 
     def set_entry(self, entry):
         '''
-        Set a dict key and value for the message content.
+        Set the message content.
         '''
         self._entry = entry
-        dict.__setitem__(self, 'entry', entry)
 
         if self._timestamp == 0:
             self._timestamp = f'{time.time()}'
@@ -81,10 +94,9 @@ class Message(dict):
 
     def set_time(self, time: float):
         '''
-        Set a dict key and value for the timestamp of the message.
+        Set the timestamp of the message.
         '''
         self._timestamp = time
-        dict.__setitem__(self, 'timestamp', time)
 
     def get_time(self):
         '''
@@ -94,10 +106,9 @@ class Message(dict):
 
     def set_from_user(self, from_user):
         '''
-        Set a dict key and value for the user who sent the message.
+        Set the user who sent the message.
         '''
-        self._from_user = from_user
-        dict.__setitem__(self, 'from_user', from_user)
+        self._from_user = sys.intern(from_user) if isinstance(from_user, str) else from_user
 
     def get_from_user(self):
         '''
@@ -105,16 +116,163 @@ class Message(dict):
         '''
         return self._from_user
 
+    def to_dict(self) -> dict:
+        '''
+        Returns the message as the dict saved in DSU files.
+        '''
+        return {'entry': self._entry,
+                'timestamp': self._timestamp,
+                'from_user': self._from_user,
+                'to_user': self._to_user}
+
+    def __getitem__(self, key: str):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        return getattr(self, '_' + key)
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            return self.to_dict() == other.to_dict()
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f'Message({self.to_dict()!r})'
+
     user = property(get_to_user, set_to_user)
     entry = property(get_entry, set_entry)
     timestamp = property(get_time, set_time)
 
 
+def _time_key(msg: Message) -> float:
+    '''
+    Sort key of a message, its timestamp as a number.
+    '''
+    return float(msg.get_time())
+
+
+def _message(msg_obj: dict) -> Message:
+    '''
+    Returns the Message of a message object read from a DSU file.
+    '''
+    return Message(msg_obj['entry'],
+                   msg_obj['timestamp'],
+                   msg_obj['from_user'],
+                   msg_obj['to_user'])
+
+
+class _LazyHistory:
+    '''
+    Offset index over the message lines of a version 2 DSU file that
+    are not loaded yet. The file is memory-mapped and read backwards,
+    newest message first, only as far as needed: lines before the
+    frontier have not been looked at, lines after it that were not
+    loaded are remembered per contact by their offsets.
+    '''
+    def __init__(self, path: Path, username: str):
+        self.username = username
+        self._open(path)
+        self.start = self._map.find(b'\n') + 1
+        end = len(self._map)
+        # a torn last line (the program stopped while appending) is skipped
+        self.complete = self._map[end - 1:end] == b'\n'
+        if not self.complete:
+            end = self._map.rfind(b'\n', self.start - 1, end) + 1
+        self.frontier = end
+        self.older = {}  # contact -> deque of (start, end) offsets, newest first
+
+    def contact(self, msg_obj: dict) -> str:
+        '''
+        Returns the other user of a message.
+        '''
+        if msg_obj['from_user'] == self.username:
+            return msg_obj['to_user']
+        return msg_obj['from_user']
+
+    def scan(self):
+        '''
+        Reads the line before the frontier and moves the frontier to
+        its start. Returns (start, end, message object), or None once
+        the whole file has been read.
+        '''
+        if self.frontier <= self.start:
+            return None
+        line_start = self._map.rfind(b'\n', self.start - 1, self.frontier - 1) + 1
+        line_end = self.frontier
+        self.frontier = line_start
+        return line_start, line_end, json.loads(self._map[line_start:line_end])
+
+    def read(self, line_start: int, line_end: int) -> dict:
+        '''
+        Returns the message object of a line found by scan.
+        '''
+        return json.loads(self._map[line_start:line_end])
+
+    def remember(self, contact: str, line_start: int, line_end: int) -> None:
+        '''
+        Adds a scanned line that was not loaded to the offset index.
+        '''
+        self.older.setdefault(contact, deque()).append((line_start, line_end))
+
+    def exhausted(self) -> bool:
+        '''
+        True once every message line has been loaded.
+        '''
+        return self.frontier <= self.start and not any(self.older.values())
+
+    def _open(self, path: Path) -> None:
+        '''
+        Opens and memory-maps the file.
+        '''
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def reopen(self, path: Path, shift: int) -> None:
+        '''
+        Maps the file again after close(), once it was rewritten with a
+        header shift bytes longer and the same message lines after it.
+        '''
+        self._open(path)
+        self.start += shift
+        self.frontier += shift
+        self.older = {contact: deque((line_start + shift, line_end + shift)
+                                     for line_start, line_end in offsets)
+                      for contact, offsets in self.older.items()}
+
+    def close(self) -> None:
+        '''
+        Unmaps and closes the file.
+        '''
+        self._map.close()
+        self._file.close()
+
+
 class Profile:
     '''
     Handles the local storage of data. Stores messages and contacts added
     and stored by the user. Stores user data, including the selected
     dsuserver, username, and password.
+
+    DSU files are saved in the version 2 format: the first line is a
+    json header with the profile and the friends, every following
+    line is one json message. Once the profile has been saved to or
+    loaded from a file, add_msg appends the new message to it, so
+    saving after a new message does not rewrite the whole history
+    (unless autosave is False, see ProfileWriter). A whole file is
+    written to a temporary file first and renamed over the old one.
+    Files in the old format (a single json object) are still loaded
+    and are converted on the next save.
+
+    load_profile(path, newest=N) only loads the newest N messages of
+    each contact, see load_older for the rest of the history.
+
+    The messages are also indexed per contact in timestamp order
+    (see get_conversation), the index follows add_msg and del_msg.
+
+    A ProfileWriter saves from its own thread while the GUI reads the
+    conversations: the lazy history and the messages it loads are
+    only used with _history_lock held.
     '''
     def __init__(self, dsuserver=None, username=None, password=None):
         self.dsuserver = dsuserver
@@ -122,6 +280,14 @@ class Profile:
         self.password = password
         self.friends = []
         self.messages = []
+        self.autosave = True
+        self._path = None  # file the profile is saved in
+        self._saved_header = None  # header as written in _path
+        self._written = None  # messages already in _path, None to rewrite it
+        self._history = None  # messages of _path not loaded yet (lazy load)
+        self._history_lock = threading.RLock()
+        self._conversations = {}  # contact -> messages sorted by timestamp
+        self._indexed_user = None  # username the index was built for
 
     def make_friend(self, user: str) -> None:
         '''
@@ -148,11 +314,20 @@ class Profile:
     def add_msg(self, msg: Message) -> None:
         '''
         Adds a Message object to the message list stored in
-        the Profile object
-        
+        the Profile object. If the profile is saved in a file
+        that is up to date, the message is appended to it.
+
         :param msg: The Message object to be added to the list self.messages
         '''
         self.messages.append(msg)
+        self._index([msg])
+        if self.autosave and self._written is not None and self._written == len(self.messages) - 1:
+            try:
+                with open(self._path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(msg.to_dict()) + '\n')
+                self._written += 1
+            except OSError:
+                self._written = None  # the next save_profile rewrites the file
 
     def del_msg(self, index: int) -> bool:
         '''
@@ -162,7 +337,9 @@ class Profile:
         :param index: The index of the message list to delete.
         '''
         try:
-            del self.messages[index]
+            msg = self.messages.pop(index)
+            self._unindex(msg)
+            self._written = None
             return True
         except IndexError:
             return False
@@ -170,14 +347,167 @@ class Profile:
     def get_messages(self) -> list[Message]:
         '''
         Returns the list of Messages stored in the Profile object.
+        After a lazy load, only the messages loaded so far.
         '''
         return self.messages
 
+    def _contact(self, msg: Message) -> str:
+        '''
+        Returns the other user of a message.
+        '''
+        if msg.get_from_user() == self.username:
+            return msg.get_to_user()
+        return msg.get_from_user()
+
+    def _index(self, msgs) -> None:
+        '''
+        Adds messages to the conversation index. The index is rebuilt
+        by get_conversation instead when the username changed.
+        '''
+        if self._indexed_user != self.username:
+            return
+        for msg in msgs:
+            conversation = self._conversations.setdefault(self._contact(msg), [])
+            if not conversation or _time_key(conversation[-1]) <= _time_key(msg):
+                conversation.append(msg)
+            else:
+                bisect.insort(conversation, msg, key=_time_key)
+
+    def _unindex(self, msg: Message) -> None:
+        '''
+        Removes a message from the conversation index.
+        '''
+        if self._indexed_user != self.username:
+            return
+        conversation = self._conversations.get(self._contact(msg), [])
+        position = bisect.bisect_left(conversation, _time_key(msg), key=_time_key)
+        while position < len(conversation):
+            if conversation[position] is msg:
+                del conversation[position]
+                return
+            position += 1
+
+    def get_conversation(self, contact: str, limit: int = None, before=None) -> list[Message]:
+        '''
+        Returns the messages exchanged with contact, oldest first.
+        After a lazy load, only the messages loaded so far.
+
+        :param contact: The other user of the conversation.
+        :param limit: Only the newest limit messages.
+        :param before: Only messages with a timestamp before before.
+        '''
+        with self._history_lock:
+            if self._indexed_user != self.username:
+                self._indexed_user = self.username
+                self._conversations = {}
+                self._index(sorted(self.messages, key=_time_key))
+            conversation = self._conversations.get(contact, [])
+            end = len(conversation)
+            if before is not None:
+                end = bisect.bisect_left(conversation, float(before), key=_time_key)
+            start = 0 if limit is None else max(0, end - limit)
+            return conversation[start:end]
+
+    def has_older(self, contact: str) -> bool:
+        '''
+        Returns True if contact may have messages in the file that
+        are not loaded yet (lazy load).
+        '''
+        with self._history_lock:
+            history = self._history
+            if history is None:
+                return False
+            return bool(history.older.get(contact)) or history.frontier > history.start
+
+    def load_older(self, contact: str, count: int = None) -> list[Message]:
+        '''
+        Loads up to count (all if None) older messages of a contact
+        from the file of a lazy load. Returns them, oldest first; they
+        are also added to the Profile object.
+
+        :param contact: The other user of the messages.
+        :param count: The number of messages to load.
+        '''
+        with self._history_lock:
+            history = self._history
+            if history is None:
+                return []
+            offsets = history.older.get(contact, deque())
+            found = []
+            while count is None or len(found) < count:
+                if offsets:
+                    found.append(history.read(*offsets.popleft()))
+                    continue
+                scanned = history.scan()
+                if scanned is None:
+                    break
+                line_start, line_end, msg_obj = scanned
+                if history.contact(msg_obj) == contact:
+                    found.append(msg_obj)
+                else:
+                    history.remember(history.contact(msg_obj), line_start, line_end)
+            msgs = [_message(msg_obj) for msg_obj in reversed(found)]
+            self.messages[0:0] = msgs
+            self._index(msgs)
+            if self._written is not None:
+                self._written += len(msgs)
+            if history.exhausted():
+                self._close_history()
+            return msgs
+
+    def _load_all(self) -> None:
+        '''
+        Loads every message of the file of a lazy load that is not
+        loaded yet.
+        '''
+        with self._history_lock:
+            history = self._history
+            if history is None:
+                return
+            found = []
+            for offsets in history.older.values():
+                found.extend(history.read(*line) for line in offsets)
+            history.older = {}
+            while (scanned := history.scan()) is not None:
+                found.append(scanned[2])
+            msgs = [_message(msg_obj) for msg_obj in reversed(found)]
+            self.messages[0:0] = msgs
+            self._index(msgs)
+            if self._written is not None:
+                self._written += len(found)
+            self._close_history()
+
+    def _close_history(self) -> None:
+        '''
+        Releases the file of a lazy load.
+        '''
+        with self._history_lock:
+            if self._history is not None:
+                self._history.close()
+                self._history = None
+
+    def _header(self) -> dict:
+        '''
+        Returns the header line of the DSU file: everything but the messages.
+        '''
+        return {'version': DSU_VERSION,
+                'dsuserver': self.dsuserver,
+                'username': self.username,
+                'password': self.password,
+                'friends': list(self.friends)}
+
     def save_profile(self, path: str) -> None:
         '''
         save_profile accepts an existing dsu file to save the
         current instance of Profile to the file system.
 
+        Only the messages added since the last save are appended when
+        the file is the one the profile was saved to or loaded from and
+        the header did not change. If only the header changed, the
+        message lines of the file are copied as they are after the new
+        header, without loading the messages of a lazy load. Otherwise
+        the whole file is written.
+
         Example usage:
 
         profile = Profile()
@@ -185,21 +515,125 @@ class Profile:
 
         Raises DsuFileError
         '''
-        p = Path(path)
+        save = self._begin_save(path)
+        try:
+            self._write_save(save)
+        finally:
+            self._end_save(save)
 
-        if p.exists() and p.suffix == '.dsu':
-            try:
-                with open(p, 'w', encoding='utf-8') as f:
-                    json.dump(self.__dict__, f)
-            except Exception as ex:
-                raise DsuFileError("Error while attempting to process the DSU file.", ex)
-        else:
+    def _begin_save(self, path: str) -> dict:
+        '''
+        First step of save_profile: decides how the file is written and
+        takes what is written from the profile, without writing it.
+        Messages added afterwards are left for the next save. The
+        ProfileWriter runs this and _end_save with its lock held and
+        _write_save without it, so the GUI does not wait for the disk.
+
+        Raises DsuFileError
+        '''
+        p = Path(path)
+        if not (p.exists() and p.suffix == '.dsu'):
             raise DsuFileError("Invalid DSU file path or type")
+        header = self._header()
+        up_to_date = p == self._path and self._written is not None
+        if not up_to_date:
+            self._load_all()  # a rewrite needs the whole history
+            mode = 'rewrite'
+        elif header == self._saved_header:
+            mode = 'append'
+        else:
+            mode = 'header'
+        count = len(self.messages)
+        first = 0 if mode == 'rewrite' else self._written
+        return {'path': p, 'header': header, 'mode': mode, 'written': self._written,
+                'count': count, 'messages': self.messages[first:count], 'error': None}
 
-    def load_profile(self, path: str) -> None:
+    def _write_save(self, save: dict) -> None:
+        '''
+        Second step of save_profile: writes the file as decided by
+        _begin_save.
+
+        Raises DsuFileError
+        '''
+        p = save['path']
+        lines = (json.dumps(msg.to_dict()) + '\n' for msg in save['messages'])
+        try:
+            if save['mode'] == 'append':
+                with open(p, 'a', encoding='utf-8') as f:
+                    f.writelines(lines)
+            elif save['mode'] == 'header':
+                self._replace_header(p, save['header'], lines)
+            else:
+                tmp = p.with_name(p.name + '.tmp')
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps(save['header']) + '\n')
+                    f.writelines(lines)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, p)
+        except Exception as ex:
+            save['error'] = ex
+            raise DsuFileError("Error while attempting to process the DSU file.", ex)
+
+    def _end_save(self, save: dict) -> None:
+        '''
+        Last step of save_profile: records what the file holds now.
+        Older messages loaded by load_older while the file was written
+        were counted in _written already.
+        '''
+        if save['error'] is not None:
+            self._written = None
+            return
+        self._path = save['path']
+        self._saved_header = save['header']
+        if save['mode'] == 'rewrite':
+            self._written = save['count']
+        elif self._written is not None:
+            self._written += save['count'] - save['written']
+
+    def _replace_header(self, p: Path, header: dict, lines) -> None:
+        '''
+        Writes header and the message lines of p (copied as bytes, not
+        parsed) to a temporary file, then lines (the messages not
+        written yet), and renames it over p. The lazy history is mapped
+        again on the new file; it is only locked for the rename.
+        '''
+        tmp = p.with_name(p.name + '.tmp')
+        header_line = (json.dumps(header) + '\n').encode('utf-8')
+        with open(p, 'rb') as old, open(tmp, 'wb') as f:
+            shift = len(header_line) - len(old.readline())
+            f.write(header_line)
+            shutil.copyfileobj(old, f)
+            f.writelines(line.encode('utf-8') for line in lines)
+            f.flush()
+            os.fsync(f.fileno())
+        with self._history_lock:
+            history = self._history
+            if history is None:
+                os.replace(tmp, p)
+                return
+            history.close()  # a mapped file cannot be replaced on Windows
+            try:
+                os.replace(tmp, p)
+            except OSError:
+                shift = 0
+                raise
+            finally:
+                history.reopen(p, shift)
+
+    def load_profile(self, path: str, newest: int = None) -> None:
         '''
         load_profile will populate the current instance of Profile
-        with data stored in a DSU file.
+        with data stored in a DSU file, in the version 2 or in the
+        old single json object format.
+
+        With newest, only the newest messages of each contact are
+        loaded (lazy load, version 2 files only): the file is read from
+        the end until every friend, and every other sender found on the
+        way, has newest messages, or at most LAZY_SCAN_FACTOR * newest
+        lines per contact. The rest of the
+        history stays in the file until load_older asks for it, so
+        opening a profile does not slow down as the history grows.
 
         Example usage:
 
@@ -211,20 +645,221 @@ class Profile:
         p = Path(path)
 
         if p.exists() and p.suffix == '.dsu':
+            self._close_history()
             try:
                 with open(p, 'r', encoding='utf-8') as f:
-                    obj = json.load(f)
-                    self.username = obj['username']
-                    self.password = obj['password']
-                    self.dsuserver = obj['dsuserver']
-                    self.friends = obj['friends']
-                    for msg_obj in obj['messages']:
-                        msg = Message(msg_obj['entry'],
-                                    msg_obj['timestamp'],
-                                    msg_obj['from_user'],
-                                    msg_obj['to_user'])
-                        self.messages.append(msg)
+                    if newest is not None:
+                        obj, msg_objs, complete = self._read_newest(f, p, newest)
+                    else:
+                        obj, msg_objs, complete = self._read_file(f)
+                self._written = len(msg_objs) if complete else None
+                self.username = obj['username']
+                self.password = obj['password']
+                self.dsuserver = obj['dsuserver']
+                self.friends = obj['friends']
+                self.messages = [_message(msg_obj) for msg_obj in msg_objs]
+                self._indexed_user = None  # rebuilt on the next get_conversation
             except Exception as ex:
+                self._close_history()
+                self._written = None
                 raise DsuProfileError(ex)
+            self._path = p
+            self._saved_header = self._header()
         else:
             raise DsuFileError()
+
+    def _read_newest(self, f, p: Path, newest: int):
+        '''
+        Reads the header of an open DSU file and the newest messages of
+        each contact (see load_profile). Returns the same as _read_file.
+        Old format files are read whole.
+        '''
+        try:
+            obj = json.loads(f.readline())
+        except json.JSONDecodeError:
+            obj = None
+        if not isinstance(obj, dict) or obj.get('version') != DSU_VERSION:
+            f.seek(0)
+            return self._read_file(f)
+
+        history = _LazyHistory(p, obj['username'])
+        self._history = history
+        counts = {}
+        friends = set(obj['friends'])
+        missing = set(friends)  # contacts with fewer than newest messages loaded
+        budget = LAZY_SCAN_FACTOR * newest * max(1, len(missing))  # lines left to read
+        msg_objs = []
+        while (missing or not counts) and budget > 0:
+            budget -= 1
+            scanned = history.scan()
+            if scanned is None:
+                break
+            line_start, line_end, msg_obj = scanned
+            contact = history.contact(msg_obj)
+            if contact not in counts and contact not in friends:
+                # not a friend (yet): its newest messages are loaded too, on a budget of their own
+                missing.add(contact)
+                budget += LAZY_SCAN_FACTOR * newest
+            if counts.get(contact, 0) < newest:
+                msg_objs.append(msg_obj)
+                counts[contact] = counts.get(contact, 0) + 1
+                if counts[contact] == newest:
+                    missing.discard(contact)
+            else:
+                history.remember(contact, line_start, line_end)
+        complete = history.complete
+        if history.exhausted():
+            self._close_history()
+        msg_objs.reverse()
+        return obj, msg_objs, complete
+
+    @staticmethod
+    def _read_file(f):
+        '''
+        Reads an open DSU file. Returns the profile object, the list
+        of message objects and whether the file can be appended to:
+        False for the old format, which is converted to version 2 on
+        the next save, and for a torn last line (the program stopped
+        while appending), which is skipped and dropped on the next save.
+        '''
+        try:
+            obj = json.loads(f.readline())
+        except json.JSONDecodeError:
+            obj = None
+        if not isinstance(obj, dict) or obj.get('version') != DSU_VERSION:
+            f.seek(0)
+            obj = json.load(f)
+            return obj, obj['messages'], False
+
+        msg_objs = []
+        for line in f:
+            try:
+                msg_objs.append(json.loads(line))
+            except json.JSONDecodeError:
+                return obj, msg_objs, False
+        return obj, msg_objs, True
+
+
+class ProfileWriter:
+    '''
+    Write-behind layer around a Profile saved in a DSU file.
+
+    Changes made through the writer only mark the profile dirty. A
+    background thread saves it once no change came in for delay
+    seconds, and close() saves whatever is left. A burst of N new
+    messages therefore costs one write instead of N.
+
+    :param profile: The profile to save.
+    :param path: The DSU file of the profile.
+    :param delay: Seconds without changes before the profile is saved.
+    '''
+    def __init__(self, profile: Profile, path, delay: float = 0.5):
+        self.profile = profile
+        self.path = path
+        self.delay = delay
+        self.error = None  # last DsuFileError of the background thread
+        profile.autosave = False
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # one save at a time, held while writing
+        self._changed = threading.Condition(self._lock)
+        self._dirty = False
+        self._last_change = 0.0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_msg(self, msg: Message) -> None:
+        '''
+        Adds a message to the profile and schedules a save.
+        '''
+        with self._lock:
+            self.profile.add_msg(msg)
+            self._mark_dirty()
+
+    def load_older(self, contact: str, count: int = None) -> list[Message]:
+        '''
+        Profile.load_older, run while no save is in progress.
+        '''
+        with self._lock:
+            return self.profile.load_older(contact, count)
+
+    def save(self) -> None:
+        '''
+        Schedules a save after the profile was changed directly
+        (e.g. with make_friend).
+        '''
+        with self._lock:
+            self._mark_dirty()
+
+    def _mark_dirty(self) -> None:
+        '''
+        Records a change. Call with the lock held.
+        '''
+        self._dirty = True
+        self._last_change = time.monotonic()
+        self._changed.notify()
+
+    def flush(self) -> None:
+        '''
+        Saves the profile now if it has unsaved changes. The lock is
+        only held to take the changes and to record the save, the
+        file is written without it (see Profile._begin_save), so
+        add_msg and load_older never wait for the disk.
+
+        Raises DsuFileError
+        '''
+        with self._write_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+                try:
+                    save = self.profile._begin_save(self.path)
+                except DsuFileError:
+                    self._dirty = True
+                    raise
+            try:
+                self.profile._write_save(save)
+            finally:
+                with self._lock:
+                    self.profile._end_save(save)
+                    if save['error'] is not None:
+                        self._dirty = True
+
+    def close(self) -> None:
+        '''
+        Stops the background thread and saves the unsaved changes.
+
+        Raises DsuFileError
+        '''
+        with self._lock:
+            self._closed = True
+            self._changed.notify()
+        self._thread.join()
+        self.flush()
+        self.profile.autosave = True
+
+    def _run(self) -> None:
+        '''
+        Body of the background thread: waits for a change, then for
+        delay quiet seconds, then saves.
+        '''
+        while True:
+            with self._lock:
+                while not self._dirty and not self._closed:
+                    self._changed.wait()
+                if self._closed:
+                    return
+                remaining = self._last_change + self.delay - time.monotonic()
+                while remaining > 0 and not self._closed:
+                    self._changed.wait(remaining)
+                    remaining = self._last_change + self.delay - time.monotonic()
+                if self._closed:
+                    return
+            try:
+                self.flush()
+                self.error = None
+            except DsuFileError as ex:
+                self.error = ex
+                with self._lock:
+                    self._changed.wait(self.delay)
@@ -10,14 +10,131 @@ stephl25@uci.edu
 
 '''
 
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, filedialog, simpledialog
 from typing import Text
 from pathlib import Path
 from ds_messenger import DirectMessenger
-from Profile import Profile, Message, DsuFileError, DsuProfileError
+from Profile import Profile, ProfileWriter, Message, DsuFileError, DsuProfileError
 import checker as c
 
+RECENT_MESSAGES = 100  # messages per contact loaded when a file is opened, see Profile.load_profile
+RENDER_PAGE = 100  # messages rendered at a time in the chat pane, see Body.show_conversation
+NETWORK_CHECK_MS = 50  # how often the main thread picks up results of the NetworkWorker
+POLL_MIN_MS = 1000  # poll interval right after messages were sent or received
+POLL_MAX_MS = 16000  # the interval doubles on every empty poll up to this, see MainApp._poll
+
+
+def take_inbox(inbox_queue: queue.Queue, is_loaded: bool) -> list:
+    '''
+    Returns the messages of every inbox queued for the main thread (by
+    the listener or a poll) and removes them from inbox_queue. While no
+    file is loaded they stay queued and [] is returned: the server has
+    already marked them read, saved to the placeholder profile they
+    would be lost.
+    '''
+    inbox = []
+    if not is_loaded:
+        return inbox
+    while True:
+        try:
+            inbox.extend(inbox_queue.get_nowait())
+        except queue.Empty:
+            return inbox
+
+
+def needs_poll(is_loaded: bool, listening: bool, poll_in_flight: bool) -> bool:
+    '''
+    True if the server must be polled with retrieve_new(): a file is
+    loaded to save the messages to, the listener is not receiving
+    pushed messages and no poll is in flight already.
+    '''
+    return is_loaded and not listening and not poll_in_flight
+
+
+def page_start(end: int) -> int:
+    '''
+    Returns the index of the first message of the page of RENDER_PAGE
+    messages ending before index end of a conversation.
+    '''
+    return max(0, end - RENDER_PAGE)
+
+
+def appended_messages(shown: list, first: int, conversation: list):
+    '''
+    Compares conversation with the one shown in the chat pane, shown
+    rendered from shown[first]. Returns the messages added at the end
+    of conversation since and the index of shown[first] in it (older
+    messages may have been loaded in front), or None if conversation
+    is not shown grown at either end and must be rendered again.
+    '''
+    if not shown:
+        return None
+    # the last message shown is at the end of the list or near it
+    last = shown[-1]
+    position = len(conversation) - 1
+    while position >= 0 and conversation[position] is not last:
+        position -= 1
+    shift = position - (len(shown) - 1)  # older messages loaded in between
+    if position < 0 or shift < 0 or conversation[first + shift] is not shown[first]:
+        return None
+    return conversation[position + 1:], first + shift
+
+
+class NetworkWorker:
+    '''
+    Runs the blocking DirectMessenger calls on a background thread so
+    the Tk main loop never waits on the network. Jobs are run one at a
+    time in the order they were submitted (the messenger keeps a single
+    socket). Results are queued and handed to the callbacks on the main
+    thread by process_results, which MainApp calls with after().
+    '''
+    def __init__(self):
+        self.in_flight = []
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, status: str, function, *args, callback=None):
+        '''
+        Queues function(*args) to run on the worker thread. status
+        describes the job while it is in flight (shown in the footer).
+        callback is called on the main thread with the return value,
+        or with None if function raised.
+        '''
+        self.in_flight.append(status)
+        self._jobs.put((status, function, args, callback))
+
+    def process_results(self):
+        '''
+        Calls the callbacks of the finished jobs. Must be called from
+        the main thread.
+        '''
+        while True:
+            try:
+                status, result, callback = self._results.get_nowait()
+            except queue.Empty:
+                return
+            self.in_flight.remove(status)
+            if callback is not None:
+                callback(result)
+
+    def _run(self):
+        '''
+        Body of the worker thread.
+        '''
+        while True:
+            status, function, args, callback = self._jobs.get()
+            try:
+                result = function(*args)
+            except Exception as ex:  # a failed job must not stop the worker
+                print(f'{status} failed: {ex}')
+                result = None
+            self._results.put((status, result, callback))
+
 
 class Body(tk.Frame):
     '''
@@ -25,11 +142,18 @@ class Body(tk.Frame):
     the text box to send messages, the text box that displays messages,
     and the contact list.
     '''
-    def __init__(self, root, recipient_selected_callback=None):
+    def __init__(self, root, recipient_selected_callback=None, load_older_callback=None):
         tk.Frame.__init__(self, root)
         self.root = root
         self._contacts = [str]
         self._select_callback = recipient_selected_callback
+        self._load_older_callback = load_older_callback
+
+        # what the chat pane shows: the conversation with _shown_contact,
+        # rendered from _shown[_first] to its end
+        self._shown_contact = None
+        self._shown = []
+        self._first = 0
 
         self._draw()
 
@@ -74,6 +198,79 @@ class Body(tk.Frame):
         '''
         self.entry_editor.insert(1.0, message + '\n', 'entry-left')
 
+    def show_conversation(self, contact: str, conversation: list):
+        '''
+        Displays the conversation (oldest message first) with contact.
+        Only the newest RENDER_PAGE messages are rendered at first,
+        older ones when the pane is scrolled to the top. When the same
+        conversation is shown again, only the messages added since are
+        rendered, instead of redrawing the whole pane.
+        '''
+        appended = None
+        if contact == self._shown_contact:
+            appended = appended_messages(self._shown, self._first, conversation)
+        if appended is None:
+            self._render_all(contact, conversation)
+            return
+
+        at_bottom = self.entry_editor.yview()[1] >= 1.0
+        new_messages, self._first = appended
+        for message in new_messages:
+            self._render(message, tk.END)
+        self._shown = conversation
+        if at_bottom:
+            self.entry_editor.see(tk.END)
+
+    def _render_all(self, contact: str, conversation: list):
+        '''
+        Clears the chat pane and renders the newest page of conversation.
+        '''
+        self.entry_editor.delete(1.0, tk.END)
+        self._shown_contact = contact
+        self._shown = conversation
+        self._first = page_start(len(conversation))
+        for message in conversation[self._first:]:
+            self._render(message, tk.END)
+        self.entry_editor.see(tk.END)
+
+    def _render(self, message, index):
+        '''
+        Inserts one message at index of the chat pane.
+        '''
+        tag = 'entry-left' if message.get_from_user() == self._shown_contact else 'entry-right'
+        self.entry_editor.insert(index, message.get_entry() + '\n', tag)
+
+    def show_older(self):
+        '''
+        Renders the page of messages before the oldest one rendered,
+        at the top of the chat pane, without moving the view. Asks
+        load_older_callback for more history once every loaded message
+        is rendered.
+        '''
+        if self._shown_contact is None:
+            return
+        if self._first == 0 and self._load_older_callback is not None:
+            older = self._load_older_callback(self._shown_contact)
+            self._shown[0:0] = older
+            self._first = len(older)
+        if self._first == 0:
+            return
+        start = page_start(self._first)
+        self.entry_editor.mark_set('view', '@0,0')
+        for message in reversed(self._shown[start:self._first]):
+            self._render(message, '1.0')
+        self._first = start
+        self.entry_editor.yview('view')
+
+    def _on_scroll(self, first, last):
+        '''
+        yscrollcommand of the chat pane: moves the scrollbar and
+        renders older messages once the top is reached.
+        '''
+        self.entry_editor_scrollbar.set(first, last)
+        if float(first) <= 0.0 and self._shown_contact is not None:
+            self.after_idle(self.show_older)
+
     def get_text_entry(self) -> str:
         '''
         Returns the text written in the text editor widget.
@@ -98,6 +295,9 @@ class Body(tk.Frame):
         Clears the text box that displays messages.
         '''
         self.entry_editor.delete(1.0, tk.END)
+        self._shown_contact = None
+        self._shown = []
+        self._first = 0
 
     def clear_contact_tree(self):
         '''
@@ -148,11 +348,11 @@ class Body(tk.Frame):
         self.entry_editor.pack(fill=tk.BOTH, side=tk.LEFT,
                                expand=True, padx=5, pady=5)
 
-        entry_editor_scrollbar = tk.Scrollbar(master=scroll_frame,
-                                              command=self.entry_editor.yview)
-        self.entry_editor['yscrollcommand'] = entry_editor_scrollbar.set
-        entry_editor_scrollbar.pack(fill=tk.Y, side=tk.LEFT,
-                                    expand=False, padx=2, pady=2)
+        self.entry_editor_scrollbar = tk.Scrollbar(master=scroll_frame,
+                                                   command=self.entry_editor.yview)
+        self.entry_editor['yscrollcommand'] = self._on_scroll
+        self.entry_editor_scrollbar.pack(fill=tk.Y, side=tk.LEFT,
+                                         expand=False, padx=2, pady=2)
 
 
 class Footer(tk.Frame):
@@ -175,6 +375,13 @@ class Footer(tk.Frame):
         if self._send_callback is not None:
             self._send_callback()
 
+    def set_status(self, text: str):
+        '''
+        Shows text in the lower left corner.
+        '''
+        if self.footer_label['text'] != text:
+            self.footer_label.config(text=text)
+
     def _draw(self):
         '''
         Draws the GUI for the Footer.
@@ -288,13 +495,34 @@ class MainApp(tk.Frame):
 
         self.direct_messenger = DirectMessenger()
         self.is_connected = False
+        self.inbox_queue = queue.Queue()
+        self.listener = None
+        self.worker = NetworkWorker()
+        self._poll_in_flight = False
+        self._poll_after = None
+        self._poll_interval = POLL_MIN_MS
 
         self.profile = Profile()
+        self.writer = None
         self.path = ""
         self.file_name = ""
         self.is_loaded = False
 
         self._draw()
+        self._process_network()
+        self._schedule_poll(POLL_MIN_MS)
+
+    def _process_network(self):
+        '''
+        Hands finished network jobs to their callbacks and shows
+        the request in flight, if any, in the footer.
+        '''
+        self.worker.process_results()
+        if self.worker.in_flight:
+            self.footer.set_status(f'{self.worker.in_flight[0]}...')
+        else:
+            self.footer.set_status('Ready.')
+        self.after(NETWORK_CHECK_MS, self._process_network)
 
     def configure_file(self):
         '''
@@ -324,12 +552,13 @@ class MainApp(tk.Frame):
                 self.body.set_text_entry('File already exists. Opening existing file...')
                 self.path = file_path
 
-            self.profile.load_profile(self.path)
+            self.profile.load_profile(self.path, newest=RECENT_MESSAGES)
             c.check_match(self.profile, self.username, self.password)
+            self.writer = ProfileWriter(self.profile, self.path)
             self._load_contacts()
-            self.check_new()
-            self.body.set_text_entry('File opened.')
             self.is_loaded = True
+            self.poll_now()
+            self.body.set_text_entry('File opened.')
         except c.NotConnected:
             self.body.set_text_entry('Please load a profile.')
         except c.CancelledEvent:
@@ -355,14 +584,15 @@ class MainApp(tk.Frame):
             c.check_suffix(self.path)
             c.check_existence(self.path)
 
-            self.profile.load_profile(self.path)
+            self.profile.load_profile(self.path, newest=RECENT_MESSAGES)
 
             c.check_match(self.profile, self.username, self.password)
+            self.writer = ProfileWriter(self.profile, self.path)
 
             self._load_contacts()
-            self.check_new()
-            self.body.set_text_entry("File opened.")
             self.is_loaded = True
+            self.poll_now()
+            self.body.set_text_entry("File opened.")
         except c.Mismatched as error_msg:
             self.body.set_text_entry(f'{error_msg}')
         except c.CancelledEvent:
@@ -384,6 +614,12 @@ class MainApp(tk.Frame):
         object attributes related to loading a file
         back to default values.
         '''
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except DsuFileError:
+                print(f'Unable to save {self.path}')
+            self.writer = None
         self.body.clear_contact_tree()
         self.body.clear_text_entry()
         self.body.clear_entry_editor()
@@ -416,7 +652,7 @@ class MainApp(tk.Frame):
             self.body.insert_contact(new_contact)
             if self.is_loaded:
                 self.profile.make_friend(new_contact)
-                self.profile.save_profile(self.path)
+                self.writer.save()
             self.body.set_text_entry(f"New contact entered: {new_contact}")
         except c.NotConnected:
             self.body.set_text_entry('Please log in, then open a file.')
@@ -446,77 +682,148 @@ class MainApp(tk.Frame):
         necessary functions to display message log for that recipient.
         '''
         self.recipient = recipient
-        self._load_messages()
-        self._refresh_messages()
+        self._show_messages()
+        self.poll_now()
 
-    def _load_messages(self):
+    def _show_messages(self):
         '''
-        Updates the inbox and displays the message log for
-        the selected contact to the text box.
+        Displays the conversation with the selected contact. Only what
+        changed since the last call is rendered (see Body.show_conversation).
         '''
-        self.check_new()
-        self.body.clear_entry_editor()
-        all_messages = sorted(self.profile.get_messages(),
-                              key=lambda item: item['timestamp'],
-                              reverse=True)
-        for message in all_messages:
-            if message['from_user'] == self.recipient:
-                self.body.insert_contact_message(message['entry'])
-            elif message['from_user'] == self.username and message['to_user'] == self.recipient:
-                self.body.insert_user_message(message['entry'])
+        self.body.show_conversation(self.recipient, self.profile.get_conversation(self.recipient))
 
-    def _refresh_messages(self):
+    def _load_older(self, contact: str) -> list:
         '''
-        Recursive function that checks for new messages every 2 seconds.
+        Reads the next page of older messages of contact from the file
+        (lazy load). Called by the chat pane when it is scrolled to the top.
         '''
-        if self.recipient:
-            self._load_messages()
-            self.body.after(2000, self._refresh_messages)
+        if self.writer is None or not self.profile.has_older(contact):
+            return []
+        return self.writer.load_older(contact, RENDER_PAGE)
+
+    def _schedule_poll(self, delay: int):
+        '''
+        (Re)starts the one poll timer of the app: _poll runs after
+        delay milliseconds. A pending timer is cancelled, so there is
+        never more than one.
+        '''
+        if self._poll_after is not None:
+            self.after_cancel(self._poll_after)
+        self._poll_after = self.after(delay, self._poll)
+
+    def _poll(self):
+        '''
+        Checks for new messages and schedules the next check. While the
+        listener receives pushed messages only its queue is read, at the
+        shortest interval. Otherwise the server is polled and the interval
+        doubles after every poll, up to POLL_MAX_MS; it is reset by
+        poll_now when there is activity.
+        '''
+        self._poll_after = None
+        if self.is_connected and self.is_loaded:
+            self.check_new()
+        if self.listener is not None and self.listener.is_alive():
+            self._schedule_poll(POLL_MIN_MS)
+        else:
+            self._schedule_poll(self._poll_interval)
+            self._poll_interval = min(self._poll_interval * 2, POLL_MAX_MS)
+
+    def poll_now(self):
+        '''
+        Checks for new messages right away and goes back to the
+        shortest poll interval. Called after activity (a contact was
+        selected, a file opened, a message sent or received).
+        '''
+        self._poll_interval = POLL_MIN_MS
+        self._schedule_poll(0)
+
+    def start_listener(self):
+        '''
+        Starts a background thread that receives the messages the
+        server pushes to the current user and queues them for check_new.
+        '''
+        self.listener = threading.Thread(target=self._listen,
+                                         args=(self.direct_messenger, self.inbox_queue),
+                                         daemon=True)
+        self.listener.start()
+
+    def _listen(self, messenger: DirectMessenger, inbox_queue: queue.Queue):
+        '''
+        Body of the listener thread. Only touches the queue, the Tk
+        widgets are updated from the main thread in check_new.
+        '''
+        for inbox in messenger.subscribe():
+            inbox_queue.put(inbox)
 
     def check_new(self):
         '''
-        Checks for new messages by calling retrieve_new()
-        and returning the list of new messages received by
-        the server.
+        Checks for new messages. Messages pushed by the server are
+        taken from the listener queue. If the listener is not running,
+        falls back to polling the server with retrieve_new() on the
+        NetworkWorker, unless such a poll is still in flight. Nothing
+        is taken or polled until a file is loaded (see take_inbox).
         '''
         try:
             c.check_connection(self.is_connected)
-            inbox = self.direct_messenger.retrieve_new()
-            self.save_messages_locally(inbox)
+            inbox = take_inbox(self.inbox_queue, self.is_loaded)
+            if inbox:
+                self.save_messages_locally(inbox)
+                if self.recipient:
+                    self._show_messages()
+            listening = self.listener is not None and self.listener.is_alive()
+            if needs_poll(self.is_loaded, listening, self._poll_in_flight):
+                self._poll_in_flight = True
+                self.worker.submit('Checking for messages',
+                                   self.direct_messenger.retrieve_new,
+                                   callback=self._polled)
         except c.NotConnected:
             self.body.set_text_entry('To log in: Settings, Configure DS Server')
             self.body.after(3000, self.body.clear_text_entry)
 
+    def _polled(self, inbox):
+        '''
+        Callback of the retrieve_new() poll submitted by check_new. The
+        messages go through the queue, so they wait there if the file
+        was closed while the poll was in flight.
+        '''
+        self._poll_in_flight = False
+        if inbox:
+            self.inbox_queue.put(inbox)
+            inbox = take_inbox(self.inbox_queue, self.is_loaded)
+        if inbox:
+            self.save_messages_locally(inbox)
+            if self.recipient:
+                self._show_messages()
+            self._poll_interval = POLL_MIN_MS
+
     def save_messages_locally(self, msg_inbox):
         '''
         Stores messages received by the server locally in
-        the file currently loaded.
+        the file currently loaded. The file is written in the
+        background by the ProfileWriter, once for the whole inbox.
         '''
         for message in msg_inbox:
             new_msg = Message(entry=message['message'],
                               timestamp=message['timestamp'],
                               from_user=message['from'])
-            self.profile.add_msg(new_msg)
-            self.profile.save_profile(self.path)
+            if self.writer is not None:
+                self.writer.add_msg(new_msg)
+            else:
+                self.profile.add_msg(new_msg)
 
     def send_message(self):
         '''
         Checks the connection to the server and a file is
         oepned. Checks the message (does not send if message is
         empty or whitespace) and calls publish if the message is valid.
-        Stores the sent message to the file loaded.
+        The sent message is stored to the file loaded by _sent.
         '''
         try:
             c.check_connection(self.is_loaded)
             c.check_connection(self.is_connected)
             message_to_send = self.body.get_text_entry()
             if c.check_valid_entry(message_to_send):
-                if self.publish(message_to_send):
-                    new_post = Message(entry=message_to_send,
-                                       from_user=self.username,
-                                       to_user=self.recipient)
-                    self.profile.add_msg(new_post)
-                    self.profile.save_profile(self.path)
+                self.publish(message_to_send)
         except c.InvalidEntry:
             self.body.set_text_entry('Sending empty messages is not allowed.')
         except c.NotConnected:
@@ -526,25 +833,42 @@ class MainApp(tk.Frame):
 
     def publish(self, message: str) -> bool:
         '''
-        Sends the message to the server and receives a message
-        from the server. Returns True if the send() returns True.
-        Returns False if send() returns False or a invalid
-        recipient is selected (user selects themselves or a
-        recipient is not selected).
+        Submits the message to the NetworkWorker, which sends it to
+        the server. Returns True if the message was submitted.
+        Returns False if a invalid recipient is selected (user
+        selects themselves or a recipient is not selected).
         '''
         try:
             if (self.recipient == self.username) or (not self.recipient):
                 raise c.InvalidRecipient
 
-            if self.direct_messenger.send(message, self.recipient):
-                self.body.entry_editor.insert(tk.END, message + '\n', 'entry-right')
-                self.body.set_text_entry('Sent.')
-                return True
-            self.body.set_text_entry('Failed to send.')
+            recipient = self.recipient
+            self.worker.submit(f'Sending to {recipient}', self.direct_messenger.send,
+                               message, recipient,
+                               callback=lambda sent: self._sent(sent, message, recipient))
+            return True
         except c.InvalidRecipient:
             self.body.set_text_entry('Select a recipient. Unable to send messages to yourself.')
         return False
 
+    def _sent(self, sent: bool, message: str, recipient: str):
+        '''
+        Callback of the send() submitted by publish. Stores the
+        message if the server accepted it.
+        '''
+        if not sent:
+            self.body.set_text_entry('Failed to send.')
+            return
+        self.body.set_text_entry('Sent.')
+        new_post = Message(entry=message, from_user=self.username, to_user=recipient)
+        if self.writer is not None:
+            self.writer.add_msg(new_post)
+        else:
+            self.profile.add_msg(new_post)
+        if self.recipient == recipient:
+            self._show_messages()
+        self.poll_now()
+
     def configure_server(self):
         '''
         Connects the user to the server using the information
@@ -562,22 +886,51 @@ class MainApp(tk.Frame):
 
             self.close_file()
 
+            self.is_connected = False
+            old_messenger = self.direct_messenger
+            self.inbox_queue = queue.Queue()
             self.direct_messenger = DirectMessenger(self.server, self.username, self.password)
-            welcome_msg = self.direct_messenger.start_session()
-
-            if welcome_msg is False:
-                self.body.set_text_entry('Server not connected.')
-            elif welcome_msg is None:
-                self.body.set_text_entry(f'Wrong password for {self.username}')
-            else:
-                next_instructions = "To get started: (1) Select File (2) Create/Open a file."
-                self.body.set_text_entry(f'{welcome_msg}\n{next_instructions}')
-                self.is_connected = True
+            self.worker.submit(f'Connecting to {self.server}', self._connect,
+                               old_messenger, self.direct_messenger,
+                               callback=self._connected)
         except c.CancelledEvent:
             self.body.set_text_entry('Cancelled loading a profile.')
-        finally:
             self.body.after(3000, self.body.clear_text_entry)
 
+    @staticmethod
+    def _connect(old_messenger: DirectMessenger, messenger: DirectMessenger):
+        '''
+        Runs on the NetworkWorker: closes the previous connection
+        and logs in with the new messenger.
+        '''
+        old_messenger.stop_subscription()
+        old_messenger.close_socket()
+        return messenger.start_session()
+
+    def _connected(self, welcome_msg):
+        '''
+        Callback of the login submitted by configure_server.
+        '''
+        if welcome_msg is False:
+            self.body.set_text_entry('Server not connected.')
+        elif welcome_msg is None:
+            self.body.set_text_entry(f'Wrong password for {self.username}')
+        else:
+            next_instructions = "To get started: (1) Select File (2) Create/Open a file."
+            self.body.set_text_entry(f'{welcome_msg}\n{next_instructions}')
+            self.is_connected = True
+            self.start_listener()
+        self.body.after(3000, self.body.clear_text_entry)
+
+    def close_app(self):
+        '''
+        Saves the file loaded, stops the listener and closes the window.
+        '''
+        self.close_file()
+        self.direct_messenger.stop_subscription()
+        self.direct_messenger.close_socket()
+        self.root.destroy()
+
     def _draw(self):
         '''
         Draws the GUI with the help of external classes
@@ -600,7 +953,8 @@ class MainApp(tk.Frame):
                                   command=self.configure_server)
 
         self.body = Body(self.root,
-                         recipient_selected_callback=self.recipient_selected)
+                         recipient_selected_callback=self.recipient_selected,
+                         load_older_callback=self._load_older)
         self.body.pack(fill=tk.BOTH, side=tk.TOP, expand=True)
         self.footer = Footer(self.root, send_callback=self.send_message)
         self.footer.pack(fill=tk.BOTH, side=tk.BOTTOM)
@@ -615,10 +969,9 @@ if __name__ == "__main__":
     main.option_add('*tearOff', False)
 
     app = MainApp(main)
+    main.protocol('WM_DELETE_WINDOW', app.close_app)
 
     main.update()
     main.minsize(main.winfo_width(), main.winfo_height())
-    after_id = main.after(2000, app.check_new)
-    print(after_id)
 
     main.mainloop()
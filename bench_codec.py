@@ -0,0 +1,90 @@
+'''
+bench_codec.py
+
+Micro-benchmark of the ds_protocol codec: frames per second encoded
+and decoded for the payload shapes of the join, direct message and
+inbox commands. Every codec of ds_protocol.CODECS is measured (orjson
+only when it is installed), next to the text path used before the
+codec layer (json.dumps to str, decode().strip(), json.loads).
+
+    python bench_codec.py [--frames N] [--inbox N]
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import argparse
+import json
+import sys
+import time
+import ds_protocol as dsp
+
+
+def payloads(inbox_size):
+    '''
+    Returns {shape: (request, response)} with the dicts the client and
+    the server exchange for each command.
+    '''
+    token = 'EBz4pTC3-Oxej-Ghca-PDpa-oM6siFYIECsi'
+    inbox = [{'from': f'user{number % 20}', 'message': f'message number {number}, hello!',
+              'timestamp': f'{1700000000 + number}.123456'} for number in range(inbox_size)]
+    return {
+        'join': ({'join': {'username': 'alice', 'password': 'pwd', 'token': ''}},
+                 {'response': {'type': 'ok', 'message': 'Welcome back, alice!', 'token': token}}),
+        'dm': ({'token': token, 'directmessage': {'entry': 'Hello World!', 'recipient': 'bob',
+                                                  'timestamp': 1700000000.123456}},
+               {'response': {'type': 'ok', 'message': 'Direct message sent'}}),
+        'inbox': ({'token': token, 'directmessage': 'new'},
+                  {'response': {'type': 'ok', 'messages': inbox}}),
+    }
+
+
+def legacy_round_trip(obj):
+    '''
+    One frame through the text path used before the codec layer.
+    '''
+    frame = (json.dumps(obj) + '\r\n').encode()
+    return json.loads(frame.decode(errors='replace').strip())
+
+
+def codec_round_trip(dumps, loads):
+    '''
+    Returns a function sending one frame through a ds_protocol codec.
+    '''
+    def round_trip(obj):
+        return loads(dumps(obj) + dsp.FRAME_END)
+    return round_trip
+
+
+def measure(round_trip, request, response, frames):
+    '''
+    Returns the frames per second of round_trip, alternating requests
+    and responses like a connection does.
+    '''
+    start = time.perf_counter()
+    for _ in range(frames // 2):
+        round_trip(request)
+        round_trip(response)
+    return (frames // 2 * 2) / (time.perf_counter() - start)
+
+
+def parse_args(argv):
+    '''Command line options of the benchmark'''
+    parser = argparse.ArgumentParser(description = 'Frames per second of the ds_protocol codecs')
+    parser.add_argument('--frames', type = int, default = 100000, help = 'frames per shape and codec')
+    parser.add_argument('--inbox', type = int, default = 50, help = 'messages in the inbox response')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    codecs = {'legacy text': legacy_round_trip}
+    codecs.update((name, codec_round_trip(*codec)) for name, codec in dsp.CODECS.items())
+    print(f'{args.frames} frames per shape, inbox of {args.inbox} messages (default codec: {dsp.CODEC})')
+    for shape, (request, response) in payloads(args.inbox).items():
+        frames = args.frames if shape != 'inbox' else max(args.frames // args.inbox, 2)
+        baseline = None
+        for name, round_trip in codecs.items():
+            rate = measure(round_trip, request, response, frames)
+            baseline = baseline or rate
+            print(f'  {shape:6} {name:12} {rate:12,.0f} frames/s ({rate / baseline:.1f}x)')
@@ -0,0 +1,75 @@
+'''
+bench_profile.py
+
+Measures the memory used per message by a Profile holding a long
+history, with the Message class of Profile.py and with the dict
+subclass it replaced (kept here as LegacyMessage for the comparison).
+
+    python bench_profile.py [--messages N] [--contacts N]
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import argparse
+import gc
+import sys
+import time
+import tracemalloc
+from Profile import Profile, Message
+
+
+class LegacyMessage(dict):
+    '''
+    The Message of earlier versions: a dict that also keeps every
+    field in an instance attribute.
+    '''
+    def __init__(self, entry=None, timestamp=0, from_user=None, to_user=None):
+        self._timestamp = timestamp
+        self._entry = entry
+        dict.__setitem__(self, 'entry', entry)
+        if self._timestamp == 0:
+            self._timestamp = f'{time.time()}'
+        self._to_user = to_user
+        dict.__setitem__(self, 'to_user', to_user)
+        self._from_user = from_user
+        dict.__setitem__(self, 'from_user', from_user)
+        dict.__init__(self, entry=self._entry, timestamp=self._timestamp,
+                      from_user=self._from_user, to_user=self._to_user)
+
+
+def measure(message_class, messages, contacts):
+    '''
+    Returns the bytes allocated per message by a Profile filled with
+    messages of message_class. Entries, timestamps and usernames are
+    new strings for every message, as they are after json loading.
+    '''
+    gc.collect()
+    tracemalloc.start()
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    for number in range(messages):
+        contact = ''.join(['user', str(number % contacts)])
+        if number % 2:
+            profile.add_msg(message_class(f'message {number}', f'{number}.0', contact, None))
+        else:
+            profile.add_msg(message_class(f'message {number}', f'{number}.0', 'alice', contact))
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return used / messages
+
+
+def parse_args(argv):
+    '''Command line options of the benchmark'''
+    parser = argparse.ArgumentParser(description = 'Memory per message of a Profile')
+    parser.add_argument('--messages', type = int, default = 1000000)
+    parser.add_argument('--contacts', type = int, default = 50)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    before = measure(LegacyMessage, args.messages, args.contacts)
+    after = measure(Message, args.messages, args.contacts)
+    print(f'{args.messages} messages, {args.contacts} contacts')
+    print(f'  dict Message   {before:8.1f} bytes/message')
+    print(f'  slots Message  {after:8.1f} bytes/message ({after / before:.0%})')
@@ -0,0 +1,88 @@
+'''
+bench_store.py
+
+Compares the storage backends of ds_store.py on a message workload
+like the one of the DSU server: users join, send direct messages to
+each other and poll their new messages; every user then reads the
+whole history once, and one page of it.
+
+    python bench_store.py [--users N] [--messages N] [--poll-every N]
+
+Each backend runs on its own temporary directory. The times are the
+total seconds spent in each kind of store call.
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import argparse
+import random
+import sys
+import tempfile
+import time
+import ds_store
+
+
+def run_workload(store, users, messages, poll_every, seed=0):
+    '''
+    Runs the workload on an opened store and returns
+    {operation: (calls, seconds)}.
+    '''
+    rng = random.Random(seed)
+    names = [f'user{number}' for number in range(users)]
+    timings = {}
+
+    def timed(operation, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        calls, seconds = timings.get(operation, (0, 0.0))
+        timings[operation] = (calls + 1, seconds + time.perf_counter() - start)
+        return result
+
+    for name in names:
+        timed('join', store.get_or_create_user, name, 'pwd')
+    for number in range(messages):
+        sender, recipient = rng.sample(names, 2)
+        timed('send', store.send_message, f'message {number}', sender, recipient, f'{number}.0')
+        if number % poll_every == 0:
+            timed('new', store.read_new_messages, rng.choice(names))
+    for name in names:
+        timed('all', store.read_all_messages, name)
+        timed('page', store.read_messages_page, name, None, 50)
+    return timings
+
+
+def bench(backend, users, messages, poll_every):
+    '''
+    Runs the workload on a fresh store of backend and returns the
+    timings, including open and close.
+    '''
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = ds_store.create_store(backend, store_dir)
+        start = time.perf_counter()
+        store.open()
+        timings = {'open': (1, time.perf_counter() - start)}
+        timings.update(run_workload(store, users, messages, poll_every))
+        start = time.perf_counter()
+        store.close()
+        timings['close'] = (1, time.perf_counter() - start)
+    return timings
+
+
+def parse_args(argv):
+    '''Command line options of the benchmark'''
+    parser = argparse.ArgumentParser(description = 'Compare the DSU store backends')
+    parser.add_argument('--users', type = int, default = 100)
+    parser.add_argument('--messages', type = int, default = 20000, help = 'direct messages sent in total')
+    parser.add_argument('--poll-every', type = int, default = 5, help = 'one "new" poll every N messages')
+    parser.add_argument('--backend', choices = ds_store.BACKENDS, action = 'append', help = 'backends to run (default: all)')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    for backend in args.backend or ds_store.BACKENDS:
+        timings = bench(backend, args.users, args.messages, args.poll_every)
+        print(f'{backend}:')
+        for operation, (calls, seconds) in timings.items():
+            print(f'  {operation:6} {calls:8} calls {seconds:9.3f} s {seconds / calls * 1e6:10.1f} us/call')
@@ -0,0 +1,142 @@
+'''
+ds_logging.py
+
+Logging of the DSU server. Records go through a queue to a listener
+thread that formats and writes them, so the threads handling clients
+never wait on the terminal or the log file. Log lines are structured:
+the key/values passed with extra={'fields': {...}} are written after
+the message (text) or as keys of a json object (json).
+
+The per-frame logs ('dsu.server.frames', level DEBUG) can be sampled:
+with frames_every=N only one frame log record of every N is kept.
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+LOG_FORMATS = ('text', 'json')
+ROOT_LOGGER = 'dsu'
+FRAMES_LOGGER = 'dsu.server.frames'
+
+_SECRET = re.compile(rb'("(?:token|password)"\s*:\s*)"[^"]*"')
+
+
+class Redacted:
+    '''
+    A raw frame for the logs, written with the values of its token and
+    password fields masked. The masking only happens when the record is
+    formatted, on the listener thread, and not at all for the records
+    dropped by a SampleFilter.
+
+    :param frame: The raw frame.
+    '''
+    __slots__ = ('frame',)
+
+    def __init__(self, frame: bytes):
+        self.frame = frame
+
+    def __str__(self):
+        return _SECRET.sub(rb'\1"***"', self.frame).decode(errors='replace')
+
+    def __repr__(self):
+        return repr(str(self))
+
+
+class StructuredFormatter(logging.Formatter):
+    '''
+    Formats a record as one line: "time level logger message key=value ..."
+    or, with as_json, one json object.
+
+    :param as_json: Write json objects instead of text lines.
+    '''
+    def __init__(self, as_json: bool = False):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, 'fields', None) or {}
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if self.as_json:
+            entry = {'time': self.formatTime(record), 'level': record.levelname,
+                     'logger': record.name, 'message': message, **fields}
+            if record.exc_text:
+                entry['exception'] = record.exc_text
+            return json.dumps(entry, default=str)
+        line = ' '.join([self.formatTime(record), record.levelname, record.name, message]
+                        + [f'{key}={value!r}' for key, value in fields.items()])
+        if record.exc_text:
+            line = f'{line}\n{record.exc_text}'
+        return line
+
+
+class SampleFilter(logging.Filter):
+    '''
+    Keeps one record of every `every`.
+
+    :param every: Keep 1 record out of every.
+    '''
+    def __init__(self, every: int = 1):
+        super().__init__()
+        self.every = max(1, every)
+        self._count = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return next(self._count) % self.every == 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''
+    QueueHandler that leaves the formatting of the message, the fields
+    and the traceback to the listener thread. Only the arguments of the
+    message are merged in the calling thread, since they may change
+    after the call.
+    '''
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure(level: str = 'INFO', log_format: str = 'text', log_file: str = None,
+              frames_every: int = 1) -> logging.handlers.QueueListener:
+    '''
+    Sends the records of the 'dsu' loggers through a queue to a listener
+    thread writing to log_file (stderr if None). Returns the started
+    listener, stop() it to flush the queue before exiting.
+
+    :param level: Lowest level logged, one of LOG_LEVELS.
+    :param log_format: 'text' or 'json'.
+    :param log_file: File the records are appended to, None for stderr.
+    :param frames_every: Keep one per-frame record (DEBUG) of every frames_every.
+    '''
+    if log_file is None:
+        target = logging.StreamHandler(sys.stderr)
+    else:
+        target = logging.FileHandler(log_file, encoding='utf-8')
+    target.setFormatter(StructuredFormatter(as_json=log_format == 'json'))
+
+    records = queue.SimpleQueue()
+    logger = logging.getLogger(ROOT_LOGGER)
+    logger.setLevel(level)
+    logger.handlers = [_QueueHandler(records)]
+    logger.propagate = False
+    frames_logger = logging.getLogger(FRAMES_LOGGER)
+    frames_logger.filters = [SampleFilter(frames_every)] if frames_every > 1 else []
+
+    listener = logging.handlers.QueueListener(records, target)
+    listener.start()
+    return listener
@@ -7,11 +7,32 @@ Stephanie Lee
 stephl25@uci.edu
 
 '''
+import json
+import os
+import select
 import socket
 import time
+from pathlib import Path
 import ds_protocol as dsp
 import checker as c
 
+CONNECT_TIMEOUT = 5  # seconds to wait for the server to accept a connection
+REQUEST_TIMEOUT = 10  # seconds to wait for the response to a request
+DSU_PORT = 3001
+PIPELINE_WINDOW = 64  # directmessage frames written per batch by send_many
+# requests sent again on a new connection when their response was lost:
+# running them twice changes nothing (unlike a directmessage or "new")
+RETRY_SAFE = (dsp.format_all,)
+
+
+class DeliveryUnknown(dsp.DSProtocolError):
+    '''
+    Raised when a request was written to the server but no response
+    came back (timeout or closed connection): the server may or may
+    not have run it, so it is not sent again right away. Direct
+    messages go to the outbox, resend_outbox() may deliver them twice.
+    '''
+
 
 class DirectMessage:
     '''
@@ -56,17 +77,97 @@ class DirectMessage:
         self.set_timestamp(marked_time)
 
 
+class Outbox:
+    '''
+    Direct messages that could not be delivered because the server
+    could not be reached, kept in a file (one json line per message)
+    until DirectMessenger.resend_outbox() delivers them.
+
+    :param path: The path of the outbox file.
+    '''
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def add(self, messages: list) -> None:
+        '''
+        Appends DirectMessage objects to the outbox file and syncs it
+        to disk, so they survive a crash of the client.
+        '''
+        if not messages:
+            return
+        with open(self.path, 'a', encoding='utf-8') as outbox_file:
+            for dm in messages:
+                outbox_file.write(json.dumps({"entry": dm.message,
+                                              "recipient": dm.recipient,
+                                              "timestamp": dm.timestamp}) + '\n')
+            outbox_file.flush()
+            os.fsync(outbox_file.fileno())
+
+    def load(self) -> list:
+        '''
+        Returns the DirectMessage objects in the outbox, oldest first.
+        A line torn by a crash while it was written is skipped.
+        '''
+        messages = []
+        try:
+            with open(self.path, encoding='utf-8') as outbox_file:
+                for line in outbox_file:
+                    try:
+                        obj = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    dm = DirectMessage()
+                    dm.set_message(obj['entry'])
+                    dm.set_recipient(obj['recipient'])
+                    dm.set_timestamp(obj['timestamp'])
+                    messages.append(dm)
+        except FileNotFoundError:
+            pass
+        return messages
+
+    def replace(self, messages: list) -> None:
+        '''
+        Replaces the content of the outbox with messages. The file is
+        swapped atomically, so a crash never leaves half an outbox.
+        '''
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        open(tmp_path, 'w', encoding='utf-8').close()
+        Outbox(tmp_path).add(messages)
+        os.replace(tmp_path, self.path)
+
+    def __len__(self):
+        return len(self.load())
+
+
 class DirectMessenger:
     '''
     The message sending functionality. An object of DirectMessenger created
     to establish a connection to the server and send messages to the server.
+    One joined connection is kept open for the whole session and is only
+    re-established when it drops.
+
+    :param connect_timeout: Seconds to wait for the server to accept a connection.
+    :param timeout: Seconds to wait for a response (None to wait forever).
+    :param port: The port of the DSU server.
+    :param outbox: Path of the file where messages that could not be
+    delivered are kept for resend_outbox() (None to drop them).
+    :param resume: Present the token of the previous connection when
+    joining again, so the server re-attaches the session (see join).
     '''
-    def __init__(self, dsuserver=None, username=None, password=None):
+    def __init__(self, dsuserver=None, username=None, password=None,
+                 connect_timeout=CONNECT_TIMEOUT, timeout=REQUEST_TIMEOUT, port=DSU_PORT,
+                 outbox=None, resume=True):
         self.token = None
         self.dsp_conn = None
         self.dsuserver = dsuserver
+        self.port = port
         self.username = username
         self.password = password
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.resume = resume
+        self.outbox = Outbox(outbox) if outbox is not None else None
+        self._listener = None
 
     def start_session(self):
         '''
@@ -76,6 +177,7 @@ class DirectMessenger:
         Returns the server message if joining the user is successful.
         Returns False otherwise.
         '''
+        self.close_socket()
         connection_established = self.init_socket()
         if connection_established:
             return self.join()
@@ -91,25 +193,140 @@ class DirectMessenger:
         :param recipient: The username of the user to send the message to.
         :param message: The message to be sent to the recipient
         '''
+        dm = self._direct_message(message, recipient)
         try:
-            dm = DirectMessage()
-            dm.set_recipient(recipient)
-            dm.set_message(message)
-            dm.create_timestamp()
-            dsp.write(self.dsp_conn, dsp.format_directmsg(self.token, dm))
-            return self.get_response()
+            return self.get_response(self._request(dsp.format_directmsg, dm))
         except dsp.DSProtocolError as dsp_error:
             print(f'ERROR: {dsp_error}')
+            if self.outbox is not None:
+                self.outbox.add([dm])
             return False
 
+    def send_many(self, messages) -> list:
+        '''
+        Sends many messages on the session connection without waiting
+        for each response before writing the next message: frames are
+        written PIPELINE_WINDOW at a time and the responses are matched
+        to them in order. Returns one bool per message, True if the
+        server accepted it. Messages that were not answered because the
+        connection was lost (twice) are added to the outbox.
+
+        :param messages: Iterable of (message, recipient) pairs.
+        '''
+        dms = [self._direct_message(message, recipient) for message, recipient in messages]
+        results, undelivered = self._send_pipelined(dms)
+        if undelivered and self.outbox is not None:
+            self.outbox.add(undelivered)
+        return results
+
+    def send_batch(self, messages) -> list:
+        '''
+        Sends many messages in a single directmessages command, which the
+        server stores in one transaction: one round trip and one write
+        for a fan-out to many recipients. Returns one bool per message,
+        True if the server accepted it (all False if the command failed).
+
+        :param messages: Iterable of (message, recipient) pairs.
+        '''
+        dms = [self._direct_message(message, recipient) for message, recipient in messages]
+        try:
+            server_msg = self._request(dsp.format_directmsg_batch, dms)
+            server_data = dsp.read_data(server_msg)
+            c.check_msg_type(dsp.get_msg_type(server_data))
+            return [result['type'] == 'ok' for result in dsp.get_results(server_data)]
+        except c.ErrorMessage:
+            print(f'ERROR: {dsp.get_server_message(server_data)}')
+        except dsp.DSProtocolError as dsp_error:
+            print(f'ERROR: {dsp_error}')
+            if self.outbox is not None:
+                self.outbox.add(dms)
+        return [False] * len(dms)
+
+    def resend_outbox(self) -> int:
+        '''
+        Sends the messages of the outbox again, with their original
+        timestamps. The messages that still cannot be delivered stay in
+        the outbox, the ones the server rejects are dropped. Returns
+        the number of messages delivered.
+        '''
+        if self.outbox is None:
+            return 0
+        dms = self.outbox.load()
+        if not dms:
+            return 0
+        results, undelivered = self._send_pipelined(dms)
+        self.outbox.replace(undelivered)
+        return sum(results)
+
+    @staticmethod
+    def _direct_message(message: str, recipient: str) -> DirectMessage:
+        '''
+        Returns a DirectMessage for message to recipient, timestamped now.
+        '''
+        dm = DirectMessage()
+        dm.set_recipient(recipient)
+        dm.set_message(message)
+        dm.create_timestamp()
+        return dm
+
+    def _send_pipelined(self, dms: list):
+        '''
+        Body of send_many. Like _request, reconnects once if the
+        connection drops and sends the messages that were not written
+        yet; the ones written but not answered are not sent again (see
+        DeliveryUnknown). Returns the list of results and the list of
+        DirectMessage objects that were never answered.
+        '''
+        results = [False] * len(dms)
+        written = [False] * len(dms)
+        answered = [False] * len(dms)
+        for attempt in range(2):
+            if attempt or self._peer_closed():
+                if not self.token or not self.reconnect():
+                    break
+            pending = [i for i in range(len(dms)) if not written[i]]
+            try:
+                self._pipeline(dms, pending, results, written, answered)
+                break
+            except (dsp.DSProtocolError, OSError, ValueError, AttributeError) as error:
+                # AttributeError: no session was ever started
+                print(f'ERROR: {error}')
+                # late responses would be read as the answers of the next requests
+                self.close_socket()
+        return results, [dm for dm, done in zip(dms, answered) if not done]
+
+    def _pipeline(self, dms: list, pending: list, results: list, written: list, answered: list):
+        '''
+        Writes the frames of dms[i] for i in pending, one window ahead of
+        the responses read: while the server answers one window the next
+        one is already on its way, and at most two windows are
+        unanswered so neither side blocks on a full socket buffer.
+        '''
+        windows = [pending[i:i + PIPELINE_WINDOW]
+                   for i in range(0, len(pending), PIPELINE_WINDOW)]
+        in_flight = []
+        for window in windows + [[]]:
+            if window:
+                dsp.write_many(self.dsp_conn, [dsp.format_directmsg(self.token, dms[i])
+                                               for i in window])
+                for i in window:
+                    written[i] = True
+            for i in in_flight:
+                server_msg = dsp.read_frame(self.dsp_conn)
+                # An empty read means the server closed the connection
+                if not server_msg:
+                    raise dsp.DSProtocolError('Connection to the server was lost.')
+                results[i] = self.get_response(server_msg)
+                answered[i] = True
+            in_flight = window
+
     def retrieve_new(self) -> list:
         '''
         Sends a formated retrieve new message to the server and returns the
         list of new messages sent to the user.
         '''
         try:
-            dsp.write(self.dsp_conn, dsp.format_new(self.token))
-            return self.get_inbox()
+            return self.get_inbox(self._request(dsp.format_new))
         except dsp.DSProtocolError as dsp_error:
             print(f'ERROR: {dsp_error}')
             return None
@@ -120,19 +337,130 @@ class DirectMessenger:
         list of all messages sent to the user.
         '''
         try:
-            dsp.write(self.dsp_conn, dsp.format_all(self.token))
-            return self.get_inbox()
+            return self.get_inbox(self._request(dsp.format_all))
+        except dsp.DSProtocolError as dsp_error:
+            print(f'ERROR: {dsp_error}')
+            return None
+
+    def retrieve_page(self, since=None, limit: int = None, cursor: str = None):
+        '''
+        Sends a formated retrieve all message for one page of the
+        messages sent to and by the user. Returns the list of messages
+        and the cursor of the next page (None after the last page).
+        Returns None if the page cannot be retrieved.
+
+        :param since: Only messages with a timestamp after since.
+        :param limit: The maximum number of messages in the page.
+        :param cursor: The cursor returned with the previous page.
+        '''
+        try:
+            server_msg = self._request(dsp.format_all, since, limit, cursor)
+            server_data = dsp.read_data(server_msg)
+            c.check_msg_type(dsp.get_msg_type(server_data))
+            return dsp.get_server_messages(server_data), dsp.get_cursor(server_data)
+        except c.ErrorMessage:
+            print(f'ERROR: {dsp.get_server_message(server_data)}')
+        except dsp.DSProtocolError as dsp_error:
+            print(f'ERROR: {dsp_error}')
+        return None
+
+    def iter_all(self, since=None, page_size: int = 100):
+        '''
+        Generator over all messages sent to and by the user, oldest
+        first. Pages of page_size messages are only retrieved when the
+        previous page has been consumed, so the whole history is never
+        held in memory at once.
+
+        :param since: Only messages with a timestamp after since.
+        :param page_size: The number of messages retrieved per request.
+        '''
+        page = self.retrieve_page(since=since, limit=page_size)
+        while page is not None:
+            inbox, cursor = page
+            yield from inbox
+            if cursor is None:
+                return
+            page = self.retrieve_page(limit=page_size, cursor=cursor)
+
+    def wait_new(self, timeout: float = 25) -> list:
+        '''
+        Long-poll version of retrieve_new for clients that cannot keep a
+        subscription open. The server answers as soon as a new message
+        arrives, or with an empty list after timeout seconds.
+
+        :param timeout: Seconds the server may wait for a new message.
+        '''
+        request_timeout = self.timeout
+        if request_timeout is not None:
+            # the response may take up to timeout seconds on top of the usual delay
+            self._set_timeout(request_timeout + timeout)
+        try:
+            return self.get_inbox(self._request(dsp.format_wait, timeout))
         except dsp.DSProtocolError as dsp_error:
             print(f'ERROR: {dsp_error}')
             return None
+        finally:
+            self._set_timeout(request_timeout)
+
+    def _set_timeout(self, timeout) -> None:
+        '''
+        Sets the response timeout of this and of the next connections.
+        '''
+        self.timeout = timeout
+        if self.dsp_conn is not None:
+            self.dsp_conn.socket.settimeout(timeout)
+
+    def subscribe(self):
+        '''
+        Generator that yields the list of new messages every time the
+        server pushes some. The subscription uses its own connection, so
+        the session connection stays free for sending. Ends when the
+        subscription connection closes or stop_subscription() is called.
+        '''
+        # pushes may be hours apart, the subscription never times out
+        listener = DirectMessenger(self.dsuserver, self.username, self.password,
+                                   self.connect_timeout, None, self.port)
+        self._listener = listener
+        try:
+            if not listener.start_session():
+                return
+            inbox = listener.get_inbox(listener._request(dsp.format_subscribe))
+            while inbox is not None:
+                if inbox:
+                    yield inbox
+                server_msg = dsp.read_frame(listener.dsp_conn)
+                if not server_msg:
+                    break
+                inbox = listener.get_inbox(server_msg)
+        except (dsp.DSProtocolError, OSError, ValueError, AttributeError):
+            # AttributeError: the connection was closed by stop_subscription()
+            pass
+        finally:
+            listener.close_socket()
+
+    def stop_subscription(self):
+        '''
+        Ends the generator returned by subscribe(), including one that is
+        blocked waiting for a push in another thread.
+        '''
+        listener = self._listener
+        self._listener = None
+        if listener is not None and listener.dsp_conn is not None:
+            try:
+                listener.dsp_conn.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
 
     def join(self):
         '''
         Joins a user to the server. Returns the join message
         received by the server if successful. None otherwise.
+        After a first join, the token is sent along (unless resume is
+        False): the server then re-attaches the existing session as long
+        as it has not expired, and falls back to a full join otherwise.
         '''
         try:
-            if self.token is None:
+            if self.token is None or not self.resume:
                 self.token = ""
 
             if c.check_valid_entry(self.username) and c.check_valid_entry(self.password):
@@ -140,7 +468,7 @@ class DirectMessenger:
                           dsp.format_join(user=self.username,
                                           password=self.password,
                                           token=self.token))
-                server_data = dsp.read_data(dsp.read_msg(self.dsp_conn))
+                server_data = dsp.read_data(dsp.read_frame(self.dsp_conn))
                 c.check_msg_type(dsp.get_msg_type(server_data))
                 active_token = dsp.get_token(server_data)
                 self.token = active_token
@@ -152,14 +480,24 @@ class DirectMessenger:
             print(f'ERROR: {dsp.get_server_message(server_data)}')
         except dsp.DSProtocolError as dsp_error:
             print(f"ERROR: {dsp_error}")
+        except OSError as error:
+            # socket.timeout when the server does not answer in time
+            print(f'ERROR: {error}')
 
     def init_socket(self):
         '''
-        Initilizes the socket and the protocol connection.
+        Initilizes the socket and the protocol connection. Gives up
+        after connect_timeout seconds.
         '''
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((self.dsuserver, 3001))
+            sock.settimeout(self.connect_timeout)
+            try:
+                sock.connect((self.dsuserver, self.port))
+            except Exception:
+                sock.close()
+                raise
+            sock.settimeout(self.timeout)
             self.dsp_conn = dsp.init(sock)
         except TypeError:
             print('ERROR: Parameter(s) of unexpected types.')
@@ -168,34 +506,105 @@ class DirectMessenger:
             print('ERROR: Connection refused.')
         except socket.gaierror as s:
             print(f'ERROR: Address-related error: {s}')
+        except socket.timeout:
+            print(f'ERROR: No answer from {self.dsuserver} after {self.connect_timeout} seconds.')
+        except OSError as error:
+            print(f'ERROR: Unable to connect: {error}')
         else:
             return True
         return False
 
-    def get_response(self):
+    def _request(self, format_msg, *args) -> bytes:
+        '''
+        Sends a message to the server on the session connection and
+        returns the raw server response. The connection stays open for
+        the next request. If the message could not be written because
+        the connection dropped, the user is reconnected and joined again,
+        then the message is sent once more. A message that was written
+        but not answered is only sent again if it is in RETRY_SAFE,
+        otherwise DeliveryUnknown is raised. A connection the server has
+        closed (restart, idle timeout) is replaced before writing, since
+        the write itself would still succeed. Raises dsp.DSProtocolError
+        if no session was ever started or the server cannot be reached again.
+
+        :param format_msg: The ds_protocol format function for the message.
+        It is called with the current token followed by args.
+        '''
+        for attempt in range(2):
+            if attempt or self._peer_closed():
+                if not self.token:
+                    raise dsp.DSProtocolError('Not connected to a server.')
+                if not self.reconnect():
+                    raise dsp.DSProtocolError('Connection to the server was lost.')
+            try:
+                dsp.write(self.dsp_conn, format_msg(self.token, *args))
+            except (dsp.DSProtocolError, OSError, ValueError):
+                continue
+            try:
+                server_msg = dsp.read_frame(self.dsp_conn)
+            except (OSError, ValueError):
+                # socket.timeout when the server does not answer in time
+                server_msg = b''
+            # An empty read means the server closed the connection
+            if server_msg:
+                return server_msg
+            # a late response would be read as the answer to the next request
+            self.close_socket()
+            if format_msg not in RETRY_SAFE:
+                raise DeliveryUnknown('No response from the server, the request may have been run.')
+        raise dsp.DSProtocolError('Connection to the server was lost.')
+
+    def _peer_closed(self) -> bool:
+        '''
+        Returns True if there is no connection or the server closed it:
+        the socket is readable without a request in flight and peeking
+        at it returns nothing (or fails).
+        '''
+        if self.dsp_conn is None:
+            return True
+        sock = self.dsp_conn.socket
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+            return bool(readable) and not sock.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            # ConnectionResetError, or the socket was closed
+            return True
+
+    def reconnect(self) -> bool:
+        '''
+        Opens a new connection and joins the user again after the
+        previous connection dropped. Returns True if the user
+        is joined again. False otherwise.
+        '''
+        self.close_socket()
+        return bool(self.init_socket() and self.join())
+
+    def get_response(self, server_msg: bytes):
         '''
         Returns True if the message is accepted by server
         and server message is type "ok". False otherwise.
+
+        :param server_msg: The raw server response.
         '''
         try:
-            server_data = dsp.read_data(dsp.read_msg(self.dsp_conn))
+            server_data = dsp.read_data(server_msg)
             c.check_msg_type(dsp.get_msg_type(server_data))
-            self.close_socket()
             return True
         except c.ErrorMessage:
             print(f'ERROR: {dsp.get_server_message(server_data)}')
             return False
 
-    def get_inbox(self):
+    def get_inbox(self, server_msg: bytes):
         '''
         Returns the list of messages received by the server
         if message recieved from server is of type "ok".
         Returns None if the server message type is "error".
+
+        :param server_msg: The raw server response.
         '''
         try:
-            server_data = dsp.read_data(dsp.read_msg(self.dsp_conn))
+            server_data = dsp.read_data(server_msg)
             c.check_msg_type(dsp.get_msg_type(server_data))
-            self.close_socket()
             inbox = dsp.get_server_messages(server_data)
             return inbox
         except c.ErrorMessage:
@@ -204,6 +613,15 @@ class DirectMessenger:
 
     def close_socket(self):
         '''
-        Call to close the socket.
+        Call to close the socket. The socket is only really closed
+        once the files made by dsp.init are closed too.
         '''
+        if self.dsp_conn is None:
+            return
+        for conn_file in (self.dsp_conn.send, self.dsp_conn.recv):
+            try:
+                conn_file.close()
+            except OSError:
+                pass
         self.dsp_conn.socket.close()
+        self.dsp_conn = None
@@ -12,6 +12,11 @@ import json
 from collections import namedtuple
 import socket
 
+try:
+    import orjson
+except ImportError:  # optional, the stdlib json module is used without it
+    orjson = None
+
 # Namedtuple to hold the values retrieved from json messages.
 DataTuple = namedtuple('DataTuple', ['type', 'response'])
 DSConnection = namedtuple('DSConnection', ['socket', 'send', 'recv', 'token', 'timestamp'])
@@ -23,6 +28,69 @@ class DSProtocolError(Exception):
     '''
 
 
+# Codec: frames are json documents followed by CRLF, handled as bytes
+# from the socket to the parser. Shared by the client and server.py.
+FRAME_END = b'\r\n'
+
+
+def _json_dumps(obj) -> bytes:
+    '''
+    Serialize obj to json bytes with the stdlib json module.
+    '''
+    # default arguments only, json.dumps reuses its cached encoder for them
+    return json.dumps(obj).encode()
+
+
+def _json_loads(data):
+    '''
+    Parse json bytes or str with the stdlib json module.
+    '''
+    if isinstance(data, (bytes, bytearray)):
+        try:
+            data = data.decode()
+        except UnicodeDecodeError as error:
+            # same error as for any other malformed frame
+            raise json.JSONDecodeError(f'Invalid UTF-8: {error.reason}', '', error.start)
+    return json.loads(data)
+
+
+def _orjson_dumps(obj) -> bytes:
+    '''
+    Serialize obj to json bytes with orjson, falling back to the stdlib
+    json module for what orjson refuses (e.g. integers over 64 bits).
+    '''
+    try:
+        return orjson.dumps(obj)
+    except TypeError:  # orjson.JSONEncodeError
+        return _json_dumps(obj)
+
+
+CODECS = {'json': (_json_dumps, _json_loads)}
+if orjson is not None:
+    CODECS['orjson'] = (_orjson_dumps, orjson.loads)
+CODEC = 'orjson' if orjson is not None else 'json'
+dumps, loads = CODECS[CODEC]
+
+
+def encode_frame(obj) -> bytes:
+    '''
+    Return obj as one frame: json bytes followed by the line ending.
+
+    :param obj: The dict to send.
+    '''
+    return dumps(obj) + FRAME_END
+
+
+def decode_frame(frame):
+    '''
+    Parse one frame (bytes or str, with or without its line ending).
+    Raises json.JSONDecodeError if the frame is not valid json.
+
+    :param frame: The raw frame.
+    '''
+    return loads(frame)
+
+
 def extract_json(json_msg: str) -> DataTuple:
     '''
     Call the json.loads function on a json string and
@@ -31,7 +99,7 @@ def extract_json(json_msg: str) -> DataTuple:
     :param json_msg: The json string message to extract data from.
     '''
     try:
-        json_obj = json.loads(json_msg)
+        json_obj = decode_frame(json_msg)
         response = json_obj['response']
         type = json_obj['response']['type']
     except json.JSONDecodeError:
@@ -51,8 +119,8 @@ def init(sock: socket) -> DSConnection:
     :param sock: Initialized socket.
     '''
     try:
-        f_send = sock.makefile('w')
-        f_recv = sock.makefile('r')
+        f_send = sock.makefile('wb')
+        f_recv = sock.makefile('rb')
     except Exception:
         raise DSProtocolError("Invalid socket connection")
     return DSConnection(
@@ -72,20 +140,46 @@ def write(ds_conn: DSConnection, send_to_server: dict):
     :param send_to_server: The json formatted message to be sent to the server.
     '''
     try:
-        json_msg = json.dumps(send_to_server)
-        ds_conn.send.write(json_msg + '\r\n')
+        ds_conn.send.write(encode_frame(send_to_server))
         ds_conn.send.flush()
     except Exception:
         raise DSProtocolError("Connection to write to server refused.")
 
 
+def write_many(ds_conn: DSConnection, send_to_server: list):
+    '''
+    Send several json messages to the server in one write, without
+    waiting for the responses in between (pipelining). The server
+    answers them in the same order.
+
+    :param ds_conn: The current DSConnection namedtuple that connects client to the server.
+    :param send_to_server: The list of json formatted messages to be sent to the server.
+    '''
+    try:
+        ds_conn.send.write(b''.join(encode_frame(msg) for msg in send_to_server))
+        ds_conn.send.flush()
+    except Exception:
+        raise DSProtocolError("Connection to write to server refused.")
+
+
+def read_frame(ds_conn: DSConnection) -> bytes:
+    '''
+    Receive a json formatted message from the server and return it as
+    bytes, without the line ending (b'' once the server closed the
+    connection). read_data accepts the bytes as they are.
+
+    :param ds_conn: The current DSConnection namedtuple that connects client to the server.
+    '''
+    return ds_conn.recv.readline().rstrip(b'\r\n')
+
+
 def response(ds_conn: DSConnection):
     '''
     Receive a json formatted message from the server and return it as a string
 
     :param ds_conn: The current DSConnection namedtuple that connects client to the server.
     '''
-    command_to_client = ds_conn.recv.readline()[:-1]
+    command_to_client = read_frame(ds_conn).decode(errors='replace')
     return command_to_client
 
 
@@ -121,6 +215,24 @@ def format_directmsg(user_token: str, dm_object):
     return msg_dict
 
 
+def format_directmsg_batch(user_token: str, dm_objects: list):
+    '''
+    Formats a dict message sending many direct messages at once. The
+    server stores them in one transaction and answers with one result
+    per message (see get_results).
+    Returns the formated dict.
+
+    :param user_token: The current token for the session.
+    :param dm_objects: A list of DirectMessage objects from the ds_messenger module
+    '''
+    batch_dict = {"token": user_token,
+                  "directmessages": [{"entry": dm_object.message,
+                                      "recipient": dm_object.recipient,
+                                      "timestamp": dm_object.timestamp}
+                                     for dm_object in dm_objects]}
+    return batch_dict
+
+
 def format_new(user_token: str):
     '''
     Formats a dict message for retreiving new messages.
@@ -132,17 +244,53 @@ def format_new(user_token: str):
     return new_dict
 
 
-def format_all(user_token: str):
+def format_all(user_token: str, since=None, limit: int = None, cursor: str = None):
     '''
     Formats a dict message for retreiving all messages.
-    Returns the formated dict.
+    Returns the formated dict. With since, limit or cursor the server
+    answers with one page of the messages and the cursor of the next page.
 
     :param user_token: The current token for the session.
+    :param since: Only messages with a timestamp after since.
+    :param limit: The maximum number of messages in the page.
+    :param cursor: The cursor returned with the previous page.
     '''
     all_dict = {"token": user_token, "directmessage": "all"}
+    if since is not None:
+        all_dict["since"] = since
+    if limit is not None:
+        all_dict["limit"] = limit
+    if cursor is not None:
+        all_dict["cursor"] = cursor
     return all_dict
 
 
+def format_wait(user_token: str, timeout: float):
+    '''
+    Formats a dict message for retreiving new messages that waits on the
+    server for up to timeout seconds when there are none yet (long-poll).
+    Returns the formated dict.
+
+    :param user_token: The current token for the session.
+    :param timeout: Seconds the server may wait for a new message.
+    '''
+    wait_dict = {"token": user_token, "directmessage": "new", "timeout": timeout}
+    return wait_dict
+
+
+def format_subscribe(user_token: str):
+    '''
+    Formats a dict message for subscribing to new messages. The server
+    answers with the current new messages, then pushes every new message
+    on the same connection as soon as it arrives.
+    Returns the formated dict.
+
+    :param user_token: The current token for the session.
+    '''
+    subscribe_dict = {"token": user_token, "directmessage": "subscribe"}
+    return subscribe_dict
+
+
 def format_join(user=None, password=None, token=None):
     '''
     Format a join message and return the message as join_dict
@@ -173,6 +321,25 @@ def get_server_messages(data: DataTuple):
     return data.response['messages']
 
 
+def get_cursor(data: DataTuple):
+    '''
+    Return the cursor of the next page of messages (None after the last page)
+
+    :param data: DataTuple of the server message "response" and "token".
+    '''
+    return data.response.get('cursor')
+
+
+def get_results(data: DataTuple):
+    '''
+    Return the per message results of a directmessages (batch) command,
+    one {'type': 'ok' or 'error', 'message': ...} dict per direct message
+
+    :param data: DataTuple of the server message "response" and "token".
+    '''
+    return data.response['results']
+
+
 def get_token(data: DataTuple):
     '''
     Return the current client token
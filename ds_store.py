@@ -0,0 +1,1532 @@
+'''
+ds_store.py
+
+Server-side storage engine for the DSU server.
+
+The whole store is loaded into memory once when it is opened. Every
+mutation is appended to a write-ahead log before it is applied, and a
+background thread periodically folds the logs into the json snapshots.
+The cost of a command therefore depends on the size of the change, not
+on the size of the store.
+
+There are two backends behind the same Store interface: JsonStore
+(described above) and SqliteStore (one SQLite database in WAL mode).
+
+Layout of the json store directory:
+    layout.json             version and number of users shards
+    users/users-NN.json     snapshot of the users of shard NN (+ .wal log)
+    posts.json              snapshot of all posts (+ .wal log)
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+
+import abc
+import base64
+import bisect
+import binascii
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+# Store backends of create_store
+BACKENDS = ('json', 'sqlite')
+SQLITE_PATH = 'dsu.sqlite3'
+LAYOUT_PATH = 'layout.json'
+LAYOUT_VERSION = 2
+SHARDS_DIR_PATH = 'users'
+DEFAULT_SHARDS = 16
+
+# Files of the single users.json layout, see migrate_legacy_store
+LEGACY_USERS_PATH = 'users.json'
+LEGACY_WAL_PATH = 'store.wal'
+LEGACY_COMPACTING_WAL_PATH = 'store.wal.compacting'
+
+log = logging.getLogger('dsu.store')
+
+
+class StoreError(Exception):
+    '''
+    Error for when the store is used before it is opened or the
+    files on disk cannot be read.
+    '''
+
+
+def _new_user(password: str) -> dict:
+    '''
+    Returns an empty user record.
+
+    :param password: The password of the new user.
+    '''
+    return {'password': password,
+            'bio': {"entry": "", "timestamp": ""},
+            'posts': [],
+            'messages': []}
+
+
+def _timestamp_key(message: dict) -> float:
+    '''
+    Sort key of a message, its timestamp as a number.
+    '''
+    return float(message['timestamp'])
+
+
+def _view(message: dict) -> dict:
+    '''
+    Returns a stored message in the form sent to clients.
+    '''
+    if 'from' in message:
+        return {'from': message['from'], 'message': message['message'],
+                'timestamp': message['timestamp']}
+    return {'recipient': message['recipient'], 'message': message['message'],
+            'timestamp': message['timestamp']}
+
+
+def _in_range(message: dict, first: float = None, last: float = None) -> bool:
+    '''
+    Returns True if the timestamp of message is between first and
+    last (inclusive, None for no bound).
+    '''
+    timestamp = _timestamp_key(message)
+    return (first is None or timestamp >= first) and (last is None or timestamp <= last)
+
+
+def _page(posts: list, offset: int = 0, limit: int = None) -> list:
+    '''
+    Returns a copy of the posts from offset, at most limit of them
+    (all of them if limit is None).
+    '''
+    return posts[offset:] if limit is None else posts[offset:offset + limit]
+
+
+def _encode_cursor(timestamp: float, skip: int) -> str:
+    '''
+    Returns the opaque cursor of the page starting after the skip-th
+    message with the given timestamp.
+    '''
+    return base64.urlsafe_b64encode(json.dumps([timestamp, skip]).encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    '''
+    Returns the (timestamp, skip) position of a cursor made by
+    _encode_cursor. Raises ValueError if the cursor is invalid.
+    '''
+    try:
+        timestamp, skip = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(timestamp), int(skip)
+    except (binascii.Error, json.JSONDecodeError, TypeError, ValueError, AttributeError) as error:
+        raise ValueError('Invalid cursor.') from error
+
+
+class MessageIndex:
+    '''
+    Per-user indexes over the live users document: the unread messages
+    by id (their position in the messages of the user, which are only
+    ever appended to) and the history sorted by timestamp (already in
+    the form sent to clients). Reading new messages costs O(unread)
+    and reading all messages needs no sort.
+    '''
+    def __init__(self):
+        self._unread = {}
+        self._history = {}
+
+    def build(self, users: dict) -> None:
+        '''
+        Indexes every message of users. Called once when the store opens.
+        '''
+        self._unread = {}
+        self._history = {}
+        for username, user in users.items():
+            self._unread[username] = {message_id: message
+                                      for message_id, message in enumerate(user['messages'])
+                                      if message['status'] == 'new'}
+            self._history[username] = sorted((_view(message) for message in user['messages']),
+                                             key=_timestamp_key)
+
+    def add(self, username: str, message_id: int, message: dict) -> None:
+        '''
+        Indexes a message just stored for username with id message_id.
+        '''
+        if message['status'] == 'new':
+            self._unread.setdefault(username, {})[message_id] = message
+        # Server timestamps only grow, so this is an append in practice
+        bisect.insort(self._history.setdefault(username, []), _view(message),
+                      key=_timestamp_key)
+
+    def unread(self, username: str) -> dict:
+        '''
+        Returns the stored unread messages of username by id.
+        '''
+        return self._unread.get(username, {})
+
+    def take_unread(self, username: str, first: float = None, last: float = None,
+                    ids: list = None) -> list:
+        '''
+        Removes the unread messages of username with a timestamp
+        between first and last (inclusive, None for no bound), or only
+        those with an id in ids if given, from the index and returns them.
+        '''
+        unread = self._unread.get(username, {})
+        if ids is not None:
+            return [unread.pop(message_id) for message_id in ids if message_id in unread]
+        if first is None and last is None:
+            return list(self._unread.pop(username, {}).values())
+        taken = [message_id for message_id, message in unread.items()
+                 if _in_range(message, first, last)]
+        return [unread.pop(message_id) for message_id in taken]
+
+    def history(self, username: str) -> list:
+        '''
+        Returns the messages of username sorted by timestamp. The list
+        is owned by the index, callers must copy it before keeping it.
+        '''
+        return self._history.get(username, [])
+
+
+def _apply_users(users: dict, record: dict, index: MessageIndex = None) -> None:
+    '''
+    Applies a single log record to a users document.
+
+    Every user record remembers the sequence number of the last log
+    record applied to it, so replaying a record that is already part
+    of the snapshot is a no-op. A direct message is logged in the shard
+    of the sender and in the shard of the recipient; each shard only
+    applies the side of the users it holds. A batch of direct messages
+    from one sender ('dms') is a single record in each shard, so a shard
+    applies its side entirely or not at all; a side missing after a
+    crash is completed from the sender record (see JsonStore._roll_forward).
+
+    :param users: The users document ({username: user record}).
+    :param record: The log record to apply.
+    :param index: The MessageIndex to keep up to date (live state only).
+    '''
+    seq = record['seq']
+    op = record['op']
+    username = record['user']
+
+    if op == 'join':
+        if username not in users:
+            user = _new_user(record['password'])
+            user['seq'] = seq
+            users[username] = user
+        return
+
+    if op in ('dm', 'dms'):
+        items = record['messages'] if op == 'dms' else [record]
+        # checked before any side is updated, a message to oneself adds both copies
+        names = {username} | {item['recipient'] for item in items}
+        fresh = {name for name in names
+                 if name in users and seq > users[name].get('seq', 0)}
+        for item in items:
+            if username in fresh:
+                users[username]['messages'].append({'message': item['entry'],
+                                                    'recipient': item['recipient'],
+                                                    'timestamp': item['timestamp'],
+                                                    'status': 'sent'})
+                if index is not None:
+                    index.add(username, len(users[username]['messages']) - 1,
+                              users[username]['messages'][-1])
+            if item['recipient'] in fresh:
+                recipient = users[item['recipient']]
+                recipient['messages'].append({'message': item['entry'],
+                                              'from': username,
+                                              'timestamp': item['timestamp'],
+                                              'status': 'new'})
+                if index is not None:
+                    index.add(item['recipient'], len(recipient['messages']) - 1,
+                              recipient['messages'][-1])
+        for name in fresh:
+            users[name]['seq'] = seq
+        return
+
+    user = users.get(username)
+    if user is None or seq <= user.get('seq', 0):
+        return
+    if op == 'bio':
+        user['bio'] = {'entry': record['entry'], 'timestamp': record['timestamp']}
+    elif op == 'post':
+        user['posts'].insert(0, {'user': username,
+                                 'entry': record['entry'],
+                                 'timestamp': record['timestamp']})
+    elif op == 'read':
+        # first/last limit the read to a page of the history (see read_messages_page),
+        # ids to the messages delivered by a push (see mark_read)
+        first = record.get('first')
+        last = record.get('last')
+        ids = record.get('ids')
+        if index is not None:
+            unread = index.take_unread(username, first, last, ids)
+        elif ids is not None:
+            unread = [user['messages'][message_id] for message_id in ids
+                      if message_id < len(user['messages'])]
+        else:
+            unread = [message for message in user['messages'] if _in_range(message, first, last)]
+        for message in unread:
+            if message['status'] == 'new':
+                message['status'] = 'read'
+    user['seq'] = seq
+
+
+def _apply_posts(posts: dict, record: dict, index: MessageIndex = None) -> None:
+    '''
+    Applies a single log record to the posts document
+    ({'posts': [...], 'seq': n}). Only 'post' records change it.
+    The index argument is unused, it keeps the signature of _apply_users.
+    '''
+    if record['op'] == 'post' and record['seq'] > posts.get('seq', 0):
+        posts['posts'].insert(0, {'user': record['user'],
+                                  'entry': record['entry'],
+                                  'timestamp': record['timestamp']})
+        posts['seq'] = record['seq']
+
+
+def _replay(path: Path, apply, doc: dict, records: list = None):
+    '''
+    Applies every record of the log at path to doc with the apply
+    function. Returns the highest sequence number found and the number
+    of records applied. records, if given, gets every record applied.
+
+    A torn last line (the server died in the middle of a write) is
+    cut off the log, every complete record before it is kept.
+    '''
+    last_seq = 0
+    count = 0
+    if not path.exists():
+        return last_seq, count
+    good_size = 0
+    with path.open('rb') as wal_file:
+        for line in wal_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            apply(doc, record)
+            if records is not None:
+                records.append(record)
+            last_seq = max(last_seq, record['seq'])
+            count += 1
+            good_size += len(line)
+    if good_size != path.stat().st_size:
+        os.truncate(path, good_size)
+    return last_seq, count
+
+
+def _atomic_dump(obj, path: Path) -> None:
+    '''
+    Writes obj as json to a temporary file and renames it over path,
+    so readers never see a half written snapshot.
+    '''
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as tmp_file:
+        json.dump(obj, tmp_file)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: Path):
+    '''
+    Loads and returns the json document at path.
+    '''
+    try:
+        with path.open('r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (OSError, json.JSONDecodeError) as error:
+        raise StoreError(f'Unable to read {path}: {error}') from error
+
+
+def shard_of(username: str, shards: int) -> int:
+    '''
+    Returns the shard holding username. Stable across runs (unlike
+    hash()), so a user always lands in the same file.
+
+    :param username: The user to look up.
+    :param shards: The number of shards of the store.
+    '''
+    return zlib.crc32(username.encode('utf-8')) % shards
+
+
+class TimedLock:
+    '''
+    A threading.Lock that reports how long every acquire() waited to
+    observer('lock_wait', seconds), see Store.observer.
+
+    :param observer: The function called with the waits, or None.
+    '''
+    def __init__(self, observer=None):
+        self._lock = threading.Lock()
+        self.observer = observer
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        '''
+        Acquires the lock like threading.Lock.acquire.
+        '''
+        if self.observer is None:
+            return self._lock.acquire(blocking, timeout)
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        self.observer('lock_wait', time.perf_counter() - start)
+        return acquired
+
+    def release(self) -> None:
+        '''
+        Releases the lock.
+        '''
+        self._lock.release()
+
+    def locked(self) -> bool:
+        '''
+        True while the lock is held.
+        '''
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class Partition:
+    '''
+    One snapshot file and its write-ahead log, guarded by its own lock.
+    The store is made of one partition per users shard plus one for
+    the posts.
+
+    :param snapshot_path: The json snapshot of the partition.
+    :param empty: Returns the document of a new, empty partition.
+    :param apply: The function applying a log record to the document.
+    :param index: The MessageIndex kept over the document, or None.
+    :param observer: Called with ('lock_wait', seconds) and ('write',
+    seconds) for the lock waits and the log writes, or None.
+    '''
+    def __init__(self, snapshot_path: Path, empty, apply, index: MessageIndex = None,
+                 observer=None):
+        self.snapshot_path = snapshot_path
+        self.wal_path = snapshot_path.with_suffix('.wal')
+        self.compacting_path = snapshot_path.with_suffix('.wal.compacting')
+        self.empty = empty
+        self.apply = apply
+        self.index = index
+        self.doc = empty()
+        self.observer = observer
+        self.lock = TimedLock(observer)
+        self.wal_records = 0
+        self._wal = None
+        self._compact_lock = threading.Lock()
+
+    def open(self, replayed: list = None) -> int:
+        '''
+        Loads the snapshot (created if missing) and replays the log.
+        Returns the highest sequence number found. replayed, if given,
+        gets every record replayed. Call with self.lock held.
+        '''
+        if not self.snapshot_path.exists():
+            _atomic_dump(self.empty(), self.snapshot_path)
+        doc = _read_json(self.snapshot_path)
+        if self.apply is _apply_posts:
+            seqs = [doc.get('seq', 0)]
+        else:
+            seqs = [user.get('seq', 0) for user in doc.values()]
+        compacting_seq, _ = _replay(self.compacting_path, self.apply, doc, replayed)
+        wal_seq, self.wal_records = _replay(self.wal_path, self.apply, doc, replayed)
+        self.doc = doc
+        if self.index is not None:
+            self.index.build(doc)
+        self._wal = self.wal_path.open('a', encoding='utf-8')
+        return max(seqs + [compacting_seq, wal_seq])
+
+    @property
+    def is_open(self) -> bool:
+        '''
+        True between open() and close().
+        '''
+        return self._wal is not None
+
+    def append(self, record: dict, fsync: bool = False) -> None:
+        '''
+        Appends a record to the log and applies it to the document.
+        Call with self.lock held.
+        '''
+        if self._wal is None:
+            raise StoreError('The store is not open.')
+        start = time.perf_counter()
+        self._wal.write(json.dumps(record) + '\n')
+        self._wal.flush()
+        if fsync:
+            os.fsync(self._wal.fileno())
+        if self.observer is not None:
+            self.observer('write', time.perf_counter() - start)
+        self.apply(self.doc, record, self.index)
+        self.wal_records += 1
+
+    def compact(self) -> None:
+        '''
+        Folds the log into the snapshot file.
+
+        The log is rotated under the partition lock, which only costs
+        a rename. The snapshot is then rebuilt from the files on disk,
+        without holding the lock, so commands keep running meanwhile.
+        '''
+        with self._compact_lock:
+            with self.lock:
+                if self._wal is None:
+                    return
+                if not self.compacting_path.exists():
+                    if self.wal_records == 0:
+                        return
+                    self._wal.close()
+                    os.replace(self.wal_path, self.compacting_path)
+                    self._wal = self.wal_path.open('a', encoding='utf-8')
+                    self.wal_records = 0
+
+            doc = _read_json(self.snapshot_path)
+            _replay(self.compacting_path, self.apply, doc)
+            _atomic_dump(doc, self.snapshot_path)
+            self.compacting_path.unlink()
+
+    def close(self) -> None:
+        '''
+        Closes the log. Call compact() first to fold it.
+        '''
+        with self.lock:
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+
+
+class Store(abc.ABC):
+    '''
+    Storage interface of the DSU server. The server and the flask
+    views only use these methods, so backends can be swapped at
+    startup (see create_store). A backend that does not implement
+    every abstract method cannot be created.
+
+    Messages are returned in the form sent to clients: {'from' or
+    'recipient', 'message', 'timestamp'}, sorted by timestamp.
+
+    observer, when set, is called with ('lock_wait', seconds) every time
+    the store waited for a lock and with ('write', seconds) for every
+    write to disk (the server feeds them to its metrics).
+    '''
+    observer = None
+
+    def _observe(self, event: str, seconds: float) -> None:
+        '''
+        Passes an event to the observer, if one is set.
+        '''
+        observer = self.observer
+        if observer is not None:
+            observer(event, seconds)
+
+    def file_sizes(self) -> dict:
+        '''
+        Returns {path relative to store_dir: size in bytes} for every
+        file of the store.
+        '''
+        sizes = {}
+        for path in sorted(self.store_dir.rglob('*')):
+            try:
+                if path.is_file():
+                    sizes[path.relative_to(self.store_dir).as_posix()] = path.stat().st_size
+            except FileNotFoundError:
+                pass  # replaced by a compaction meanwhile
+        return sizes
+
+    @abc.abstractmethod
+    def open(self) -> None:
+        '''
+        Creates the store if it does not exist and gets it ready for use.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        '''
+        Flushes everything to disk and releases the files.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_user(self, username: str):
+        '''
+        Returns a copy of the user record for username (password, bio,
+        posts and stored messages), or None if the user does not exist.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_profile(self, username: str, offset: int = 0, limit: int = None):
+        '''
+        Returns {'bio': ..., 'posts': [...]} for username, or None if
+        the user does not exist. Only the posts from offset (newest
+        first) are returned, at most limit of them if limit is given.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_posts(self, offset: int = 0, limit: int = None) -> list:
+        '''
+        Returns the posts from offset, newest first, at most limit of
+        them if limit is given (all of them by default).
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_or_create_user(self, username: str, password: str):
+        '''
+        Returns {'password': ...} for username. If the user does not
+        exist, it is created and None is returned.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_bio(self, username: str, entry: str, timestamp: str) -> bool:
+        '''
+        Updates the bio of username. Returns False if the user does not exist.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def create_post(self, username: str, entry: str, timestamp: str) -> bool:
+        '''
+        Adds a post of username. Returns False if the user does not exist.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def send_message(self, entry: str, username: str, recipient: str, timestamp: str) -> bool:
+        '''
+        Stores a direct message from username to recipient. Returns
+        False if either user does not exist.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def send_messages(self, username: str, messages: list) -> list:
+        '''
+        Stores direct messages from username in one transaction.
+        messages is a list of (entry, recipient, timestamp). Returns one
+        bool per message, False if its recipient (or username) does not
+        exist; all the other messages are stored together.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_all_messages(self, username: str):
+        '''
+        Returns every message of username and marks the new ones as
+        read. Returns False if the user does not exist.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_messages_page(self, username: str, since=None, limit: int = None, cursor: str = None):
+        '''
+        Returns one page of the messages of username and the cursor of
+        the next page (None after the last page), see
+        JsonStore.read_messages_page. Returns False if the user does
+        not exist.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read_new_messages(self, username: str):
+        '''
+        Returns the new messages received by username and marks them as
+        read. Returns False if the user does not exist.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def peek_new_messages(self, username: str):
+        '''
+        Returns the new messages received by username sorted by
+        timestamp and the list of their ids, in the same order, without
+        marking them as read (see mark_read). Returns False if the user
+        does not exist.
+        '''
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mark_read(self, username: str, ids: list) -> None:
+        '''
+        Marks the new messages of username with the given ids as read,
+        once the messages returned by peek_new_messages were delivered.
+        Messages stored since the peek are left new, whatever their
+        timestamp.
+        '''
+        raise NotImplementedError
+
+
+class JsonStore(Store):
+    '''
+    In-memory users/posts store backed by json snapshots plus
+    append-only write-ahead logs.
+
+    Users are spread over shards by a hash of their name
+    (store/users/users-NN.json), each shard with its own log and lock,
+    so commands of unrelated users do not wait for each other. The
+    posts have their own partition (store/posts.json).
+
+    :param store_dir: Directory holding the snapshots and the logs.
+    :param posts_file: File name of the posts snapshot.
+    :param shards: Number of users shards of a new store. An existing
+    store keeps the number it was created with (store/layout.json).
+    :param compact_every: Number of log records of a partition that
+    triggers a compaction.
+    :param compact_interval: Seconds between compactions when a log is not empty.
+    :param fsync: fsync the log after every record (slower, survives power loss).
+    '''
+    def __init__(self, store_dir='store', posts_file='posts.json', shards=DEFAULT_SHARDS,
+                 compact_every=1000, compact_interval=60.0, fsync=False):
+        self.store_dir = Path(store_dir)
+        self.posts_path = self.store_dir / posts_file
+        self.layout_path = self.store_dir / LAYOUT_PATH
+        self.shards = shards
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self.fsync = fsync
+
+        self._shards = []
+        self._posts = Partition(self.posts_path, lambda: {'posts': []}, _apply_posts,
+                                observer=self._observe)
+        self._seq = 0
+        self._seq_lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._compact_event = threading.Event()
+        self._closed = threading.Event()
+        self._compactor = None
+
+    def open(self) -> None:
+        '''
+        Creates the store directory and snapshot files if they do not
+        exist, loads the snapshots, replays the logs and starts the
+        background compaction thread. Does nothing if already open.
+
+        Raises StoreError if the directory still has the single
+        users.json layout (see migrate_legacy_store).
+        '''
+        with self._open_lock:
+            if self._posts.is_open:
+                return
+            self.store_dir.mkdir(parents=True, exist_ok=True)
+            if self.layout_path.exists():
+                self.shards = _read_json(self.layout_path)['shards']
+            elif (self.store_dir / LEGACY_USERS_PATH).exists():
+                raise StoreError(f'{self.store_dir} uses the single users.json layout, '
+                                 f'convert it with: python migrate_store.py {self.store_dir}')
+            else:
+                (self.store_dir / SHARDS_DIR_PATH).mkdir(exist_ok=True)
+                _atomic_dump({'version': LAYOUT_VERSION, 'shards': self.shards}, self.layout_path)
+
+            self._shards = [Partition(self._shard_path(number), dict, _apply_users, MessageIndex(),
+                                      self._observe)
+                            for number in range(self.shards)]
+            seq = 0
+            replayed = {partition: [] for partition in self._shards}
+            for partition in self._shards + [self._posts]:
+                with partition.lock:
+                    seq = max(seq, partition.open(replayed.get(partition)))
+            self._seq = seq
+            self._roll_forward(replayed)
+
+        self._closed.clear()
+        self._compactor = threading.Thread(target=self._compact_loop, daemon=True)
+        self._compactor.start()
+
+    def close(self) -> None:
+        '''
+        Stops the compaction thread, folds the logs into the snapshots
+        and closes the logs.
+        '''
+        if self._compactor is None:
+            return
+        self._closed.set()
+        self._compact_event.set()
+        self._compactor.join()
+        self._compactor = None
+        self.compact()
+        for partition in self._shards + [self._posts]:
+            partition.close()
+
+    def compact(self) -> None:
+        '''
+        Folds the write-ahead log of every partition into its snapshot.
+        '''
+        for partition in self._shards + [self._posts]:
+            partition.compact()
+
+    def _compact_loop(self) -> None:
+        '''
+        Body of the compaction thread.
+        '''
+        while not self._closed.is_set():
+            self._compact_event.wait(self.compact_interval)
+            self._compact_event.clear()
+            if self._closed.is_set():
+                break
+            try:
+                self.compact()
+            except (OSError, StoreError):
+                log.exception('store compaction failed')
+
+    def _roll_forward(self, replayed: dict) -> None:
+        '''
+        Completes the direct messages that a crash left logged in the
+        shard of their sender but not in the shard of a recipient.
+        replayed maps every users shard to the records open() replayed.
+
+        The sender shard is logged first and its record holds every
+        message of the batch, so it is the commit record: a recipient
+        whose seq is still below it never got its side, which is
+        appended to its shard now under the same seq.
+        '''
+        for sender_shard, records in replayed.items():
+            for record in records:
+                if record['op'] not in ('dm', 'dms') or self._shard(record['user']) is not sender_shard:
+                    continue
+                items = record['messages'] if record['op'] == 'dms' else [record]
+                missing = {}
+                for item in items:
+                    shard = self._shard(item['recipient'])
+                    user = shard.doc.get(item['recipient'])
+                    if shard is not sender_shard and user is not None \
+                            and user.get('seq', 0) < record['seq']:
+                        missing.setdefault(shard, []).append(item)
+                for shard, shard_items in missing.items():
+                    log.warning('completing direct messages %d of %s after a crash',
+                                record['seq'], record['user'])
+                    part = dict(record, messages=shard_items) if record['op'] == 'dms' else record
+                    with shard.lock:
+                        shard.append(part, self.fsync)
+
+    def _shard_path(self, number: int) -> Path:
+        '''
+        Returns the snapshot path of a users shard.
+        '''
+        return self.store_dir / SHARDS_DIR_PATH / f'users-{number:02d}.json'
+
+    def _shard(self, username: str) -> Partition:
+        '''
+        Returns the users shard holding username.
+        '''
+        if not self._shards:
+            raise StoreError('The store is not open.')
+        return self._shards[shard_of(username, len(self._shards))]
+
+    @contextlib.contextmanager
+    def _locked(self, *partitions):
+        '''
+        Holds the locks of partitions. Locks are always taken in the same
+        order (users shards by number, then posts) so commands touching
+        two partitions cannot deadlock.
+        '''
+        order = self._shards + [self._posts]
+        unique = sorted(set(partitions), key=order.index)
+        with contextlib.ExitStack() as stack:
+            for partition in unique:
+                stack.enter_context(partition.lock)
+            yield
+
+    def _log(self, op: str, username: str, partitions, **fields) -> None:
+        '''
+        Appends a record to the log of every partition it touches and
+        applies it, in the order of partitions (the sender shard first,
+        see _roll_forward). Must be called with the locks of partitions
+        held, which keeps the records of each log in sequence order.
+        '''
+        with self._seq_lock:
+            self._seq += 1
+            record = {'seq': self._seq, 'op': op, 'user': username, **fields}
+        for partition in dict.fromkeys(partitions):
+            partition.append(record, self.fsync)
+            if partition.wal_records >= self.compact_every:
+                self._compact_event.set()
+
+    def get_user(self, username: str):
+        '''
+        Returns a copy of the user record for username, or None if
+        the user does not exist.
+        '''
+        shard = self._shard(username)
+        with shard.lock:
+            user = shard.doc.get(username)
+            if user is None:
+                return None
+            return {'password': user['password'],
+                    'bio': dict(user['bio']),
+                    'posts': list(user['posts']),
+                    'messages': [dict(message) for message in user['messages']]}
+
+    def get_profile(self, username: str, offset: int = 0, limit: int = None):
+        '''
+        Returns the public part (bio and the posts from offset, at most
+        limit of them) of the user record for username, or None if the
+        user does not exist. Only the page is copied under the lock.
+        '''
+        shard = self._shard(username)
+        with shard.lock:
+            user = shard.doc.get(username)
+            if user is None:
+                return None
+            return {'bio': dict(user['bio']), 'posts': _page(user['posts'], offset, limit)}
+
+    def get_posts(self, offset: int = 0, limit: int = None) -> list:
+        '''
+        Returns the posts from offset, newest first, at most limit of
+        them if limit is given.
+        '''
+        with self._posts.lock:
+            return _page(self._posts.doc['posts'], offset, limit)
+
+    def get_or_create_user(self, username: str, password: str):
+        '''
+        Returns the user record for username. If the user does not
+        exist, it is created and None is returned.
+        '''
+        shard = self._shard(username)
+        with shard.lock:
+            user = shard.doc.get(username)
+            if user is not None:
+                return {'password': user['password']}
+            self._log('join', username, [shard], password=password)
+            return None
+
+    def update_bio(self, username: str, entry: str, timestamp: str) -> bool:
+        '''
+        Updates the bio of username. Returns False if the user does not exist.
+        '''
+        shard = self._shard(username)
+        with shard.lock:
+            if username not in shard.doc:
+                return False
+            self._log('bio', username, [shard], entry=entry, timestamp=timestamp)
+            return True
+
+    def create_post(self, username: str, entry: str, timestamp: str) -> bool:
+        '''
+        Adds a post to the posts of username and to the list of all
+        posts. Returns False if the user does not exist.
+        '''
+        shard = self._shard(username)
+        with self._locked(shard, self._posts):
+            if username not in shard.doc:
+                return False
+            self._log('post', username, [shard, self._posts], entry=entry, timestamp=timestamp)
+            return True
+
+    def send_message(self, entry: str, username: str, recipient: str, timestamp: str) -> bool:
+        '''
+        Stores a direct message from username to recipient. Returns
+        False if either user does not exist.
+        '''
+        sender_shard = self._shard(username)
+        recipient_shard = self._shard(recipient)
+        with self._locked(sender_shard, recipient_shard):
+            if username not in sender_shard.doc or recipient not in recipient_shard.doc:
+                return False
+            self._log('dm', username, [sender_shard, recipient_shard],
+                      recipient=recipient, entry=entry, timestamp=timestamp)
+            return True
+
+    def send_messages(self, username: str, messages: list) -> list:
+        '''
+        Stores direct messages from username as one 'dms' log record.
+        The sender shard logs every message, each other shard only the
+        messages to the users it holds. Returns one bool per message,
+        False if its recipient (or username) does not exist.
+
+        The batch is atomic across shards: the sender shard is logged
+        first, and if the server dies before every recipient shard was
+        logged, open() completes them from the sender record. A batch
+        whose sender record is not in the log is not stored at all.
+        '''
+        sender_shard = self._shard(username)
+        shards = {recipient: self._shard(recipient) for _, recipient, _ in messages}
+        with self._locked(sender_shard, *shards.values()):
+            if username not in sender_shard.doc:
+                return [False] * len(messages)
+            results = [recipient in shards[recipient].doc for _, recipient, _ in messages]
+            items = [{'recipient': recipient, 'entry': entry, 'timestamp': timestamp}
+                     for (entry, recipient, timestamp), ok in zip(messages, results) if ok]
+            if not items:
+                return results
+            with self._seq_lock:
+                self._seq += 1
+                seq = self._seq
+            for shard in dict.fromkeys([sender_shard, *(shards[item['recipient']] for item in items)]):
+                if shard is not sender_shard:
+                    shard_items = [item for item in items if shards[item['recipient']] is shard]
+                else:
+                    shard_items = items
+                shard.append({'seq': seq, 'op': 'dms', 'user': username,
+                              'messages': shard_items}, self.fsync)
+                if shard.wal_records >= self.compact_every:
+                    self._compact_event.set()
+            return results
+
+    def read_all_messages(self, username: str):
+        '''
+        Returns every message sent and received by username sorted by
+        timestamp and marks the new ones as read. Returns False if the
+        user does not exist.
+        '''
+        shard = self._shard(username)
+        with shard.lock:
+            if username not in shard.doc:
+                return False
+            result = list(shard.index.history(username))
+            if shard.index.unread(username):
+                self._log('read', username, [shard])
+        return result
+
+    def read_messages_page(self, username: str, since=None, limit: int = None, cursor: str = None):
+        '''
+        Returns one page of the messages sent and received by username,
+        sorted by timestamp, and the cursor of the next page (None after
+        the last page). The new messages of the page are marked as read.
+        Returns False if the user does not exist. Raises ValueError if
+        the cursor is invalid.
+
+        :param since: Only messages with a timestamp after since.
+        :param limit: At most limit messages (None for all of them).
+        :param cursor: The cursor returned with the previous page. Takes
+        precedence over since.
+        '''
+        position = _decode_cursor(cursor) if cursor is not None else None
+        shard = self._shard(username)
+        with shard.lock:
+            if username not in shard.doc:
+                return False
+            history = shard.index.history(username)
+            if position is not None:
+                start = bisect.bisect_left(history, position[0], key=_timestamp_key) + position[1]
+            elif since is not None:
+                start = bisect.bisect_right(history, float(since), key=_timestamp_key)
+            else:
+                start = 0
+            end = len(history) if limit is None else min(len(history), start + limit)
+            page = history[start:end]
+            next_cursor = None
+            if page:
+                first = _timestamp_key(page[0])
+                last = _timestamp_key(page[-1])
+                if end < len(history):
+                    skip = end - bisect.bisect_left(history, last, key=_timestamp_key)
+                    next_cursor = _encode_cursor(last, skip)
+                unread = shard.index.unread(username).values()
+                if any(_in_range(message, first, last) for message in unread):
+                    self._log('read', username, [shard], first=first, last=last)
+        return page, next_cursor
+
+    def read_new_messages(self, username: str):
+        '''
+        Returns the new messages received by username sorted by
+        timestamp and marks them as read. Returns False if the user
+        does not exist.
+        '''
+        shard = self._shard(username)
+        with shard.lock:
+            if username not in shard.doc:
+                return False
+            result = [_view(message) for message in shard.index.unread(username).values()]
+            if result:
+                self._log('read', username, [shard])
+        return sorted(result, key=_timestamp_key)
+
+    def peek_new_messages(self, username: str):
+        '''
+        Returns the new messages received by username sorted by
+        timestamp and their ids (positions in the messages of the
+        user), without marking them as read. Returns False if the user
+        does not exist.
+        '''
+        shard = self._shard(username)
+        with shard.lock:
+            if username not in shard.doc:
+                return False
+            unread = sorted(shard.index.unread(username).items(),
+                            key=lambda item: _timestamp_key(item[1]))
+        return [_view(message) for _, message in unread], [message_id for message_id, _ in unread]
+
+    def mark_read(self, username: str, ids: list) -> None:
+        '''
+        Marks the new messages of username with the given ids (returned
+        by peek_new_messages) as read.
+        '''
+        shard = self._shard(username)
+        with shard.lock:
+            unread = shard.index.unread(username)
+            ids = [message_id for message_id in ids if message_id in unread]
+            if ids:
+                self._log('read', username, [shard], ids=ids)
+
+
+def migrate_legacy_store(store_dir='store', shards: int = DEFAULT_SHARDS) -> int:
+    '''
+    Converts a store directory with the single users.json layout (and
+    the store.wal log of that layout, if any) to the sharded layout.
+    The old users.json is kept as users.json.migrated. Returns the
+    number of users migrated.
+
+    Raises StoreError if the directory has no users.json or is
+    already sharded.
+
+    :param store_dir: The store directory to convert.
+    :param shards: The number of users shards to create.
+    '''
+    store_dir = Path(store_dir)
+    users_path = store_dir / LEGACY_USERS_PATH
+    if (store_dir / LAYOUT_PATH).exists():
+        raise StoreError(f'{store_dir} already uses the sharded layout.')
+    if not users_path.exists():
+        raise StoreError(f'{users_path} does not exist.')
+
+    users = _read_json(users_path)
+    posts_path = store_dir / 'posts.json'
+    posts = _read_json(posts_path) if posts_path.exists() else {'posts': []}
+
+    def apply_both(doc, record):
+        _apply_users(doc[0], record)
+        _apply_posts(doc[1], record)
+
+    legacy_logs = [store_dir / LEGACY_COMPACTING_WAL_PATH, store_dir / LEGACY_WAL_PATH]
+    for log_path in legacy_logs:
+        _replay(log_path, apply_both, (users, posts))
+
+    (store_dir / SHARDS_DIR_PATH).mkdir(exist_ok=True)
+    buckets = [{} for _ in range(shards)]
+    for username, user in users.items():
+        buckets[shard_of(username, shards)][username] = user
+    for number, bucket in enumerate(buckets):
+        _atomic_dump(bucket, store_dir / SHARDS_DIR_PATH / f'users-{number:02d}.json')
+    _atomic_dump(posts, posts_path)
+    # The layout file is written last: until it exists the old files still rule
+    _atomic_dump({'version': LAYOUT_VERSION, 'shards': shards}, store_dir / LAYOUT_PATH)
+
+    os.replace(users_path, users_path.with_name(LEGACY_USERS_PATH + '.migrated'))
+    for log_path in legacy_logs:
+        if log_path.exists():
+            log_path.unlink()
+    return len(users)
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    bio TEXT NOT NULL DEFAULT '',
+    bio_timestamp TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    ts REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'new'
+);
+CREATE INDEX IF NOT EXISTS messages_inbox ON messages (recipient, status, ts);
+CREATE INDEX IF NOT EXISTS messages_sent ON messages (sender, ts);
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    entry TEXT NOT NULL,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS posts_user ON posts (username, id);
+'''
+
+# Every message of a user in history order: sent rows come before the
+# received copy of the same message (like the json store does for
+# messages sent to oneself)
+_SQLITE_HISTORY = '''
+SELECT kind, peer, message, timestamp, ts, id, status FROM (
+    SELECT 0 AS kind, recipient AS peer, message, timestamp, ts, id, status
+    FROM messages WHERE sender = :user
+    UNION ALL
+    SELECT 1 AS kind, sender AS peer, message, timestamp, ts, id, status
+    FROM messages WHERE recipient = :user
+)
+'''
+
+
+def _sqlite_view(row) -> dict:
+    '''
+    Returns a history row of _SQLITE_HISTORY in the form sent to clients.
+    '''
+    kind, peer, message, timestamp = row[:4]
+    if kind:
+        return {'from': peer, 'message': message, 'timestamp': timestamp}
+    return {'recipient': peer, 'message': message, 'timestamp': timestamp}
+
+
+class SqliteStore(Store):
+    '''
+    Users/posts store in a SQLite database in WAL mode, so readers
+    never wait for the writer. Messages are indexed by recipient,
+    status and timestamp: reading the new messages of a user does
+    not scan the rest of the inbox.
+
+    Connections are pooled: a command takes one for the length of its
+    transaction, so there are never more connections than commands
+    running at the same time. Writes run in a BEGIN IMMEDIATE
+    transaction, which makes the existence checks and the insert of a
+    command atomic. Reads of the history run in a plain transaction and
+    only take the write lock to mark the new messages they returned.
+
+    :param store_dir: Directory holding the database.
+    :param db_file: File name of the database.
+    :param synchronous: SQLite synchronous pragma, NORMAL is durable
+    up to the last checkpoint in WAL mode, FULL survives power loss.
+    '''
+    def __init__(self, store_dir='store', db_file=SQLITE_PATH, synchronous='NORMAL'):
+        self.store_dir = Path(store_dir)
+        self.db_path = self.store_dir / db_file
+        self.synchronous = synchronous
+        self._idle = []
+        self._pool_lock = threading.Lock()
+        self._opened = False
+
+    def open(self) -> None:
+        '''
+        Creates the store directory and the database if they do not
+        exist. Does nothing if already open.
+        '''
+        if self._opened:
+            return
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        try:
+            connection = self._connect()
+            connection.executescript(SQLITE_SCHEMA)
+        except sqlite3.Error as error:
+            raise StoreError(f'Unable to open {self.db_path}: {error}') from error
+        self._idle.append(connection)
+        self._opened = True
+
+    def close(self) -> None:
+        '''
+        Closes the idle connections. Commands still running close
+        theirs when they are done.
+        '''
+        with self._pool_lock:
+            self._opened = False
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+
+    def _connect(self) -> sqlite3.Connection:
+        '''
+        Opens a new connection to the database.
+        '''
+        # autocommit mode, transactions are explicit (see _transaction)
+        connection = sqlite3.connect(self.db_path, isolation_level=None,
+                                     check_same_thread=False, timeout=10.0)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(f'PRAGMA synchronous={self.synchronous}')
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self, write: bool = False):
+        '''
+        Runs the block in a transaction on a pooled connection and
+        yields the connection. Readers see one snapshot of the database,
+        writers hold the write lock for the whole block. The transaction
+        is rolled back if the block or the commit fails.
+        '''
+        with self._pool_lock:
+            if not self._opened:
+                raise StoreError('The store is not open.')
+            connection = self._idle.pop() if self._idle else None
+        if connection is None:
+            connection = self._connect()
+        try:
+            start = time.perf_counter()
+            connection.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            if write:
+                self._observe('lock_wait', time.perf_counter() - start)
+            try:
+                yield connection
+                start = time.perf_counter()
+                connection.execute('COMMIT')
+            except BaseException:
+                # also when COMMIT failed (SQLITE_BUSY, disk full): the transaction
+                # is still open and the connection goes back to the pool
+                try:
+                    if connection.in_transaction:
+                        connection.execute('ROLLBACK')
+                except sqlite3.Error:
+                    connection.close()
+                    connection = None
+                raise
+            if write:
+                self._observe('write', time.perf_counter() - start)
+        finally:
+            if connection is not None:  # None: closed after a failed ROLLBACK
+                with self._pool_lock:
+                    if self._opened:
+                        self._idle.append(connection)
+                    else:
+                        connection.close()
+
+    def _exists(self, connection, username: str) -> bool:
+        '''
+        Returns True if username has a row in users.
+        '''
+        return connection.execute('SELECT 1 FROM users WHERE username = ?',
+                                  (username,)).fetchone() is not None
+
+    def _mark_rows_read(self, rows: list) -> None:
+        '''
+        Marks the new received messages among history rows of
+        _SQLITE_HISTORY as read, in a write transaction of its own.
+        Messages stored since the rows were read are left new.
+        '''
+        unread = [(row[5],) for row in rows if row[0] and row[6] == 'new']
+        if unread:
+            with self._transaction(write=True) as connection:
+                connection.executemany('UPDATE messages SET status = \'read\' '
+                                       'WHERE id = ? AND status = \'new\'', unread)
+
+    def _user_posts(self, connection, username: str, offset: int = 0, limit: int = None) -> list:
+        '''
+        Returns the posts of username from offset, newest first, at
+        most limit of them if limit is given.
+        '''
+        rows = connection.execute('SELECT entry, timestamp FROM posts WHERE username = ? '
+                                  'ORDER BY id DESC LIMIT ? OFFSET ?',
+                                  (username, -1 if limit is None else limit, offset))
+        return [{'user': username, 'entry': entry, 'timestamp': timestamp}
+                for entry, timestamp in rows]
+
+    def get_user(self, username: str):
+        '''
+        Returns a copy of the user record for username, or None if
+        the user does not exist.
+        '''
+        with self._transaction() as connection:
+            row = connection.execute('SELECT password, bio, bio_timestamp FROM users '
+                                     'WHERE username = ?', (username,)).fetchone()
+            if row is None:
+                return None
+            rows = connection.execute(
+                'SELECT 0, recipient, message, timestamp, \'sent\', id FROM messages WHERE sender = :user '
+                'UNION ALL SELECT 1, sender, message, timestamp, status, id FROM messages '
+                'WHERE recipient = :user ORDER BY 6, 1', {'user': username}).fetchall()
+            posts = self._user_posts(connection, username)
+        messages = []
+        for kind, peer, message, timestamp, status, _ in rows:
+            stored = _sqlite_view((kind, peer, message, timestamp))
+            stored['status'] = status
+            messages.append(stored)
+        return {'password': row[0],
+                'bio': {'entry': row[1], 'timestamp': row[2]},
+                'posts': posts,
+                'messages': messages}
+
+    def get_profile(self, username: str, offset: int = 0, limit: int = None):
+        '''
+        Returns the public part (bio and the posts from offset, at most
+        limit of them) of the user record for username, or None if the
+        user does not exist.
+        '''
+        with self._transaction() as connection:
+            row = connection.execute('SELECT bio, bio_timestamp FROM users WHERE username = ?',
+                                     (username,)).fetchone()
+            if row is None:
+                return None
+            return {'bio': {'entry': row[0], 'timestamp': row[1]},
+                    'posts': self._user_posts(connection, username, offset, limit)}
+
+    def get_posts(self, offset: int = 0, limit: int = None) -> list:
+        '''
+        Returns the posts from offset, newest first, at most limit of
+        them if limit is given.
+        '''
+        with self._transaction() as connection:
+            rows = connection.execute('SELECT username, entry, timestamp FROM posts '
+                                      'ORDER BY id DESC LIMIT ? OFFSET ?',
+                                      (-1 if limit is None else limit, offset)).fetchall()
+        return [{'user': username, 'entry': entry, 'timestamp': timestamp}
+                for username, entry, timestamp in rows]
+
+    def get_or_create_user(self, username: str, password: str):
+        '''
+        Returns the user record for username. If the user does not
+        exist, it is created and None is returned.
+        '''
+        with self._transaction(write=True) as connection:
+            row = connection.execute('SELECT password FROM users WHERE username = ?',
+                                     (username,)).fetchone()
+            if row is not None:
+                return {'password': row[0]}
+            connection.execute('INSERT INTO users (username, password) VALUES (?, ?)',
+                               (username, password))
+            return None
+
+    def update_bio(self, username: str, entry: str, timestamp: str) -> bool:
+        '''
+        Updates the bio of username. Returns False if the user does not exist.
+        '''
+        with self._transaction(write=True) as connection:
+            cursor = connection.execute('UPDATE users SET bio = ?, bio_timestamp = ? '
+                                        'WHERE username = ?', (entry, timestamp, username))
+            return cursor.rowcount > 0
+
+    def create_post(self, username: str, entry: str, timestamp: str) -> bool:
+        '''
+        Adds a post of username. Returns False if the user does not exist.
+        '''
+        with self._transaction(write=True) as connection:
+            if not self._exists(connection, username):
+                return False
+            connection.execute('INSERT INTO posts (username, entry, timestamp) VALUES (?, ?, ?)',
+                               (username, entry, timestamp))
+            return True
+
+    def send_message(self, entry: str, username: str, recipient: str, timestamp: str) -> bool:
+        '''
+        Stores a direct message from username to recipient. Returns
+        False if either user does not exist.
+        '''
+        with self._transaction(write=True) as connection:
+            if not (self._exists(connection, username) and self._exists(connection, recipient)):
+                return False
+            connection.execute('INSERT INTO messages (sender, recipient, message, timestamp, ts) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (username, recipient, entry, timestamp, float(timestamp)))
+            return True
+
+    def send_messages(self, username: str, messages: list) -> list:
+        '''
+        Stores direct messages from username in one write transaction.
+        Returns one bool per message, False if its recipient (or
+        username) does not exist.
+        '''
+        with self._transaction(write=True) as connection:
+            if not self._exists(connection, username):
+                return [False] * len(messages)
+            known = {recipient: self._exists(connection, recipient)
+                     for recipient in {recipient for _, recipient, _ in messages}}
+            results = [known[recipient] for _, recipient, _ in messages]
+            connection.executemany('INSERT INTO messages (sender, recipient, message, timestamp, ts) '
+                                   'VALUES (?, ?, ?, ?, ?)',
+                                   [(username, recipient, entry, timestamp, float(timestamp))
+                                    for (entry, recipient, timestamp), ok in zip(messages, results)
+                                    if ok])
+            return results
+
+    def read_all_messages(self, username: str):
+        '''
+        Returns every message sent and received by username sorted by
+        timestamp and marks the new ones as read. Returns False if the
+        user does not exist.
+        '''
+        with self._transaction() as connection:
+            if not self._exists(connection, username):
+                return False
+            rows = connection.execute(_SQLITE_HISTORY + ' ORDER BY ts, id, kind',
+                                      {'user': username}).fetchall()
+        self._mark_rows_read(rows)
+        return [_sqlite_view(row) for row in rows]
+
+    def read_messages_page(self, username: str, since=None, limit: int = None, cursor: str = None):
+        '''
+        Returns one page of the messages sent and received by username,
+        sorted by timestamp, and the cursor of the next page (None after
+        the last page). Same paging rules as JsonStore.read_messages_page.
+        Raises ValueError if the cursor is invalid.
+        '''
+        position = _decode_cursor(cursor) if cursor is not None else None
+        if position is not None:
+            where, params, skip = 'ts >= :start', {'start': position[0]}, position[1]
+        elif since is not None:
+            where, params, skip = 'ts > :start', {'start': float(since)}, 0
+        else:
+            where, params, skip = '1', {}, 0
+        params.update(user=username, limit=-1 if limit is None else limit + 1, skip=skip)
+        with self._transaction() as connection:
+            if not self._exists(connection, username):
+                return False
+            rows = connection.execute(_SQLITE_HISTORY + f' WHERE {where} ORDER BY ts, id, kind '
+                                      'LIMIT :limit OFFSET :skip', params).fetchall()
+            more = limit is not None and len(rows) > limit
+            rows = rows[:limit] if more else rows
+        next_cursor = None
+        if more:
+            last = rows[-1][4]
+            # rows skipped by the cursor have its timestamp
+            skipped = skip if position is not None and position[0] == last else 0
+            next_cursor = _encode_cursor(last, skipped + sum(row[4] == last for row in rows))
+        self._mark_rows_read(rows)
+        return [_sqlite_view(row) for row in rows], next_cursor
+
+    def read_new_messages(self, username: str):
+        '''
+        Returns the new messages received by username sorted by
+        timestamp and marks them as read. Returns False if the user
+        does not exist.
+        '''
+        with self._transaction(write=True) as connection:
+            if not self._exists(connection, username):
+                return False
+            rows = connection.execute('SELECT id, sender, message, timestamp FROM messages '
+                                      'WHERE recipient = ? AND status = \'new\' ORDER BY ts, id',
+                                      (username,)).fetchall()
+            if rows:
+                connection.execute('UPDATE messages SET status = \'read\' '
+                                   'WHERE recipient = ? AND status = \'new\'', (username,))
+        return [{'from': sender, 'message': message, 'timestamp': timestamp}
+                for _, sender, message, timestamp in rows]
+
+    def peek_new_messages(self, username: str):
+        '''
+        Returns the new messages received by username sorted by
+        timestamp and their ids (rowids), without marking them as read.
+        Returns False if the user does not exist.
+        '''
+        with self._transaction() as connection:
+            if not self._exists(connection, username):
+                return False
+            rows = connection.execute('SELECT id, sender, message, timestamp FROM messages '
+                                      'WHERE recipient = ? AND status = \'new\' ORDER BY ts, id',
+                                      (username,)).fetchall()
+        return ([{'from': sender, 'message': message, 'timestamp': timestamp}
+                 for _, sender, message, timestamp in rows], [row[0] for row in rows])
+
+    def mark_read(self, username: str, ids: list) -> None:
+        '''
+        Marks the new messages of username with the given ids
+        (returned by peek_new_messages) as read.
+        '''
+        if not ids:
+            return
+        with self._transaction(write=True) as connection:
+            connection.executemany('UPDATE messages SET status = \'read\' WHERE id = ? '
+                                   'AND recipient = ? AND status = \'new\'',
+                                   [(message_id, username) for message_id in ids])
+
+
+def create_store(backend: str = 'json', store_dir='store') -> Store:
+    '''
+    Returns a (not yet opened) store of the given backend.
+
+    :param backend: One of BACKENDS.
+    :param store_dir: Directory of the store files.
+    '''
+    if backend == 'json':
+        return JsonStore(store_dir)
+    if backend == 'sqlite':
+        return SqliteStore(store_dir)
+    raise ValueError(f'Unknown store backend: {backend}')
@@ -0,0 +1,282 @@
+'''
+loadgen.py
+
+Load generator for the DSU server. Simulates users that each keep a
+DirectMessenger session: they join, send direct messages to random
+other users at a given rate and poll "new" and "all" like a4.py does.
+Reports the throughput and the p50/p95/p99 latency of every command.
+
+By default a DSUServer is started in a child process on a free port
+with a fresh store, so the clients and the server do not share the
+GIL. --server HOST:PORT runs against a running server instead.
+
+Workloads come from PROFILES and are repeatable: every user draws its
+recipients and the gaps between its messages from a random generator
+seeded with --seed and its number. --json prints a json document (and
+--output writes it to a file) to compare runs between releases.
+
+    python loadgen.py [--profile NAME] [--users N] [--duration S] [--dm-rate R]
+                      [--new-every S] [--all-every S] [--seed N]
+                      [--engine threaded|asyncio] [--store json|sqlite]
+                      [--server HOST:PORT] [--json] [--output FILE]
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import argparse
+import json
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import ds_protocol as dsp
+from ds_messenger import DirectMessenger
+
+# users: simulated users, duration: seconds of load after every user joined,
+# dm_rate: direct messages per second per user (exponential gaps),
+# new_every / all_every: seconds between two "new" / "all" polls of a user
+PROFILES = {
+    'smoke': {'users': 5, 'duration': 5.0, 'dm_rate': 1.0, 'new_every': 1.0, 'all_every': 5.0},
+    'chat': {'users': 50, 'duration': 30.0, 'dm_rate': 0.2, 'new_every': 1.0, 'all_every': 30.0},
+    'busy': {'users': 100, 'duration': 30.0, 'dm_rate': 2.0, 'new_every': 1.0, 'all_every': 10.0},
+    'pollers': {'users': 200, 'duration': 30.0, 'dm_rate': 0.05, 'new_every': 0.5, 'all_every': 60.0},
+}
+COMMANDS = ('join', 'dm_send', 'dm_new', 'dm_all')
+PASSWORD = 'loadgen'
+
+
+def percentile(values: list, fraction: float) -> float:
+    '''
+    Returns the nearest-rank percentile of sorted values (0 if empty).
+    '''
+    if not values:
+        return 0.0
+    rank = max(1, int(fraction * len(values) + 0.999999))
+    return values[min(rank, len(values)) - 1]
+
+
+class Recorder:
+    '''
+    Collects the latency of every command sent by the simulated users.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = {command: [] for command in COMMANDS}
+        self._errors = dict.fromkeys(COMMANDS, 0)
+
+    def record(self, command: str, seconds: float, ok: bool) -> None:
+        '''
+        Adds one command that took seconds, ok is False if it failed.
+        '''
+        with self._lock:
+            self._latencies[command].append(seconds)
+            if not ok:
+                self._errors[command] += 1
+
+    def summary(self, duration: float) -> dict:
+        '''
+        Returns {command: count, errors, per_second and the p50/p95/p99
+        and max latency in milliseconds} for a run of duration seconds.
+        '''
+        with self._lock:
+            summary = {}
+            for command in COMMANDS:
+                latencies = sorted(self._latencies[command])
+                summary[command] = {
+                    'count': len(latencies),
+                    'errors': self._errors[command],
+                    'per_second': len(latencies) / duration if duration else 0.0,
+                    'p50_ms': percentile(latencies, 0.50) * 1000,
+                    'p95_ms': percentile(latencies, 0.95) * 1000,
+                    'p99_ms': percentile(latencies, 0.99) * 1000,
+                    'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+                }
+            return summary
+
+
+def _timed(recorder: Recorder, command: str, function, *args):
+    '''
+    Calls function(*args) and records its latency. DirectMessenger
+    returns False or None when a command fails.
+    '''
+    start = time.perf_counter()
+    result = function(*args)
+    recorder.record(command, time.perf_counter() - start, result is not False and result is not None)
+    return result
+
+
+def simulate_user(number: int, names: list, profile: dict, server: tuple, seed: int,
+                  barrier: threading.Barrier, clock: dict, recorder: Recorder) -> None:
+    '''
+    Body of the thread of one simulated user. Joins, waits for every
+    other user to have joined, then runs its schedule of messages and
+    polls until the end of the run (it returns once the duration of
+    the profile has passed, even if its last event came earlier).
+    '''
+    rng = random.Random(f'{seed}-{number}')
+    host, port = server
+    messenger = DirectMessenger(host, names[number], PASSWORD, port=port)
+    joined = _timed(recorder, 'join', messenger.start_session)
+    barrier.wait()
+    if not joined:
+        return
+    others = [name for name in names if name != names[number]] or names
+    start = clock['start']
+    deadline = start + profile['duration']
+    next_dm = start + rng.expovariate(profile['dm_rate']) if profile['dm_rate'] > 0 else float('inf')
+    # the polls of the users are spread over their interval, like clients started at random times
+    next_new = start + rng.uniform(0, profile['new_every'])
+    next_all = start + rng.uniform(0, profile['all_every'])
+    try:
+        while True:
+            due = min(next_dm, next_new, next_all)
+            if due >= deadline:
+                # run() measures the run until the last user is done: stop at the deadline, not before
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                break
+            time.sleep(max(0.0, due - time.monotonic()))
+            if due == next_dm:
+                _timed(recorder, 'dm_send', messenger.send,
+                       f'load message {rng.random():.6f}', rng.choice(others))
+                next_dm += rng.expovariate(profile['dm_rate'])
+            elif due == next_new:
+                _timed(recorder, 'dm_new', messenger.retrieve_new)
+                next_new += profile['new_every']
+            else:
+                _timed(recorder, 'dm_all', messenger.retrieve_all)
+                next_all += profile['all_every']
+    finally:
+        messenger.close_socket()
+
+
+def run(profile: dict, server: tuple, seed: int) -> dict:
+    '''
+    Runs the workload of profile against server (host, port) and
+    returns the duration of the run and the summary of every command.
+    '''
+    users = profile['users']
+    names = [f'loaduser{number}' for number in range(users)]
+    recorder = Recorder()
+    clock = {}
+    barrier = threading.Barrier(users, action=lambda: clock.update(start=time.monotonic()))
+    threads = [threading.Thread(target=simulate_user, daemon=True,
+                                args=(number, names, profile, server, seed, barrier, clock, recorder))
+               for number in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - clock['start']
+    return {'duration': duration, 'commands': recorder.summary(duration)}
+
+
+def start_local_server(engine: str, store: str):
+    '''
+    Starts a DSUServer with a new store in a child process on a free
+    port. Returns the process, the (host, port) of the server and the
+    store directory, to be removed once the process is stopped.
+    '''
+    store_dir = tempfile.mkdtemp(prefix='dsu-loadgen-')
+    process = subprocess.Popen([sys.executable, __file__, '--run-server', '--engine', engine,
+                                '--store', store, '--store-dir', store_dir],
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if not line:
+        process.wait()
+        shutil.rmtree(store_dir, ignore_errors=True)
+        raise RuntimeError('The local DSU server did not start.')
+    return process, ('127.0.0.1', int(line)), store_dir
+
+
+def run_server(engine: str, store: str, store_dir: str) -> None:
+    '''
+    Body of the child process of start_local_server: serves on a free
+    port and prints it on stdout once the server is listening.
+    '''
+    from server import DSUServer  # only the child process needs the server (and flask)
+    server = DSUServer('127.0.0.1', 0, engine, store_backend=store, store_dir=f'{store_dir}/store')
+
+    def announce():
+        server.listening.wait()
+        print(server.port, flush=True)
+    threading.Thread(target=announce, daemon=True).start()
+    server.start_server()
+
+
+def print_report(report: dict) -> None:
+    '''
+    Prints the summary of a run as a table.
+    '''
+    settings = report['settings']
+    print(f"profile {report['profile']}: {settings['users']} users, {settings['dm_rate']} dm/s each, "
+          f"new every {settings['new_every']} s, all every {settings['all_every']} s, "
+          f"seed {report['seed']}, server {report['server']}")
+    print(f"{report['duration']:.1f} s")
+    print(f"  {'command':8} {'count':>8} {'errors':>7} {'per s':>9} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for command, stats in report['commands'].items():
+        print(f"  {command:8} {stats['count']:8} {stats['errors']:7} {stats['per_second']:9.1f} "
+              f"{stats['p50_ms']:8.2f} {stats['p95_ms']:8.2f} {stats['p99_ms']:8.2f} {stats['max_ms']:8.2f}")
+
+
+def parse_args(argv):
+    '''Command line options of the load generator, the workload options override the profile'''
+    parser = argparse.ArgumentParser(description = 'Load generator for the DSU server')
+    parser.add_argument('--profile', choices = sorted(PROFILES), default = 'smoke')
+    parser.add_argument('--users', type = int, help = 'simulated users')
+    parser.add_argument('--duration', type = float, help = 'seconds of load after every user joined')
+    parser.add_argument('--dm-rate', type = float, help = 'direct messages per second per user')
+    parser.add_argument('--new-every', type = float, help = 'seconds between two "new" polls of a user')
+    parser.add_argument('--all-every', type = float, help = 'seconds between two "all" polls of a user')
+    parser.add_argument('--seed', type = int, default = 1, help = 'seed of the workload')
+    parser.add_argument('--engine', choices = ('threaded', 'asyncio'), default = 'threaded', help = 'engine of the local server')
+    parser.add_argument('--store', choices = ('json', 'sqlite'), default = 'json', help = 'store backend of the local server')
+    parser.add_argument('--server', help = 'HOST:PORT of a running server instead of a local one')
+    parser.add_argument('--json', action = 'store_true', help = 'print the report as json')
+    parser.add_argument('--output', help = 'also write the json report to this file')
+    parser.add_argument('--run-server', action = 'store_true', help = argparse.SUPPRESS)
+    parser.add_argument('--store-dir', help = argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    if args.run_server:
+        run_server(args.engine, args.store, args.store_dir)
+        sys.exit()
+
+    profile = dict(PROFILES[args.profile])
+    for field in profile:
+        if getattr(args, field) is not None:
+            profile[field] = getattr(args, field)
+
+    process = store_dir = None
+    if args.server:
+        host, _, port = args.server.rpartition(':')
+        server = (host, int(port))
+        server_name = args.server
+    else:
+        process, server, store_dir = start_local_server(args.engine, args.store)
+        server_name = f'local {args.engine}/{args.store}'
+    try:
+        result = run(profile, server, args.seed)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    report = {'profile': args.profile, 'settings': profile, 'seed': args.seed, 'server': server_name,
+              'codec': dsp.CODEC, 'python': platform.python_version(), **result}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,160 @@
+'''
+metrics.py
+
+Counters, latency histograms and gauges of the DSU server, rendered
+in the Prometheus text format (served on /metrics by server.py).
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import bisect
+import threading
+
+# upper bounds (seconds) of the latency histogram buckets, +Inf is implicit
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value) -> str:
+    '''
+    Escapes a label value for the Prometheus text format.
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: dict) -> str:
+    '''
+    Returns labels as {name="value",...}, or '' without labels.
+    '''
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+class Histogram:
+    '''
+    Cumulative histogram of observed values. Not thread-safe on its
+    own, Metrics updates it with its lock held.
+
+    :param buckets: Sorted upper bounds of the buckets.
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        '''
+        Adds value to the histogram.
+        '''
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: dict = None) -> list:
+        '''
+        Returns the _bucket, _sum and _count lines of the histogram.
+        '''
+        labels = labels or {}
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{_labels({**labels, "le": bound})} {cumulative}')
+        lines.append(f'{name}_sum{_labels(labels)} {self.sum}')
+        lines.append(f'{name}_count{_labels(labels)} {self.count}')
+        return lines
+
+
+class Metrics:
+    '''
+    Thread-safe registry of the server metrics:
+
+    - per command type: request count, error count and latency histogram
+      (observe_command)
+    - named latency histograms, e.g. the store lock waits (observe)
+    - gauges read when the metrics are rendered (gauge)
+
+    :param prefix: Prefix of every metric name.
+    '''
+    def __init__(self, prefix='dsu'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._commands = {}  # command -> [count, errors, Histogram]
+        self._histograms = {}  # name -> (help, Histogram)
+        self._gauges = {}  # name -> (help, function)
+
+    def histogram(self, name: str, help_text: str) -> None:
+        '''
+        Registers the histogram prefix_name_seconds, filled by observe(name, ...).
+        '''
+        with self._lock:
+            self._histograms.setdefault(name, (help_text, Histogram()))
+
+    def gauge(self, name: str, help_text: str, function) -> None:
+        '''
+        Registers the gauge prefix_name. function is called on every
+        render and returns a number, or a list of (labels dict, number).
+        '''
+        with self._lock:
+            self._gauges[name] = (help_text, function)
+
+    def observe(self, name: str, seconds: float) -> None:
+        '''
+        Adds seconds to the histogram registered as name. Observations
+        of names that were not registered are ignored.
+        '''
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is not None:
+                histogram[1].observe(seconds)
+
+    def observe_command(self, command: str, seconds: float, error: bool = False) -> None:
+        '''
+        Counts one command of type command that took seconds to handle.
+        '''
+        with self._lock:
+            stats = self._commands.get(command)
+            if stats is None:
+                stats = self._commands[command] = [0, 0, Histogram()]
+            stats[0] += 1
+            if error:
+                stats[1] += 1
+            stats[2].observe(seconds)
+
+    def render(self) -> str:
+        '''
+        Returns every metric in the Prometheus text format.
+        '''
+        with self._lock:
+            commands = sorted(self._commands.items())
+            lines = [f'# HELP {self.prefix}_commands_total Commands handled, by command type.',
+                     f'# TYPE {self.prefix}_commands_total counter']
+            lines += [f'{self.prefix}_commands_total{_labels({"command": command})} {stats[0]}'
+                      for command, stats in commands]
+            lines += [f'# HELP {self.prefix}_command_errors_total Commands answered with an error, by command type.',
+                      f'# TYPE {self.prefix}_command_errors_total counter']
+            lines += [f'{self.prefix}_command_errors_total{_labels({"command": command})} {stats[1]}'
+                      for command, stats in commands]
+            lines += [f'# HELP {self.prefix}_command_seconds Time to handle a command, by command type.',
+                      f'# TYPE {self.prefix}_command_seconds histogram']
+            for command, stats in commands:
+                lines += stats[2].render(f'{self.prefix}_command_seconds', {'command': command})
+            for name, (help_text, histogram) in sorted(self._histograms.items()):
+                lines += [f'# HELP {self.prefix}_{name}_seconds {help_text}',
+                          f'# TYPE {self.prefix}_{name}_seconds histogram']
+                lines += histogram.render(f'{self.prefix}_{name}_seconds')
+            gauges = sorted(self._gauges.items())
+        # gauges may take locks of their own, they are read without holding ours
+        for name, (help_text, function) in gauges:
+            lines += [f'# HELP {self.prefix}_{name} {help_text}',
+                      f'# TYPE {self.prefix}_{name} gauge']
+            value = function()
+            if isinstance(value, list):
+                lines += [f'{self.prefix}_{name}{_labels(labels)} {number}' for labels, number in value]
+            else:
+                lines.append(f'{self.prefix}_{name} {value}')
+        return '\n'.join(lines) + '\n'
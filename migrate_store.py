@@ -0,0 +1,34 @@
+'''
+migrate_store.py
+
+Converts a server store directory from the single users.json layout
+to the sharded layout of ds_store.py (one users-NN.json file per
+shard). Run it once, with the server stopped:
+
+    python migrate_store.py [store_dir] [--shards N]
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import argparse
+import sys
+import ds_store
+
+
+def parse_args(argv):
+    '''Command line options of the migration tool'''
+    parser = argparse.ArgumentParser(description = 'Convert a DSU server store to the sharded layout')
+    parser.add_argument('store_dir', nargs = '?', default = 'store', help = 'store directory of the server')
+    parser.add_argument('--shards', type = int, default = ds_store.DEFAULT_SHARDS, help = 'number of users shards to create')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    try:
+        count = ds_store.migrate_legacy_store(args.store_dir, args.shards)
+    except ds_store.StoreError as e:
+        print(f'Migration failed: {e}')
+        sys.exit(1)
+    print(f'Migrated {count} users to {args.shards} shards in {args.store_dir}')
@@ -1,22 +1,46 @@
 import socket
 import threading
+import asyncio
+import argparse
 import json
+import logging
 from pathlib import Path
 import sys
-from flask import Flask, render_template, redirect, url_for
+from flask import Flask, Response, render_template, redirect, request, url_for
 from datetime import datetime
 import string
+import hashlib
+from collections import OrderedDict
 import secrets
+import time
+from ds_store import BACKENDS, SQLITE_PATH, JsonStore, SqliteStore, StoreError
+from ds_protocol import decode_frame, encode_frame
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics
+import ds_logging
 
-USERS_PATH = 'users.json'
 POSTS_PATH = 'posts.json'
 STORE_DIR_PATH = 'store'
-DEBUG = True ##SET THIS TO FALSE IF YOU DONT WANT DEBUGGING OUTPUT
+DM_OPTIONS = {'new': ('timeout',), 'all': ('since', 'limit', 'cursor')} ##optional fields of the directmessage commands
+MAX_WAIT = 60 ##longest a long-poll "new" command may wait for messages, in seconds
+MAX_BATCH = 1000 ##most direct messages a "directmessages" command may hold
+SESSION_TTL = 300 ##seconds the token of a closed connection can still be resumed, default for DSUServer(session_ttl=)
+SESSION_SWEEP_INTERVAL = 60 ##seconds between two sweeps of the expired sessions
+MAX_FRAME_SIZE = 1024 * 1024 ##longest command (in bytes) a client may send, default for DSUServer(max_frame_size=)
+RECV_SIZE = 65536
+ENGINES = ('threaded', 'asyncio') ##threaded = one thread per client, asyncio = one event loop for every client
+LOG_LEVEL = 'INFO' ##DEBUG logs every frame and response (see --log-level and --log-frames-every)
+PAGE_SIZE = 20 ##posts per page of the flask views when no ?limit= is given
+MAX_PAGE_SIZE = 100 ##largest ?limit= of the flask views
+MAX_PAGE = 100000 ##largest ?page= of the flask views, keeps the OFFSET of a store query in range
+PAGE_CACHE_SIZE = 256 ##rendered flask pages kept in memory, see PageCache
 
+log = logging.getLogger('dsu.server')
+frame_log = logging.getLogger(ds_logging.FRAMES_LOGGER) ##one record per frame and per response, can be sampled
 
-##The server uses two json files to store data:
-##users - bio's, posts
-##posts - just the posts for each user and timestamp 
+
+##The server stores its data through the Store interface of ds_store.py, the backend is picked at startup (--store):
+##json (default) - users sharded over store/users/users-NN.json, posts in store/posts.json. Loaded into memory at startup, changes are appended to .wal logs and folded back into the json files in the background
+##sqlite - one SQLite database (store/dsu.sqlite3) with indexed users, messages and posts tables
 
 ##user schema:
 #{user_name: {'bio':{'entry':, 'timestamp':}, 'posts':[{'entry':, 'timestamp':}]} }
@@ -34,435 +58,859 @@ def _generate_random_string(n:int) -> str:
     alphanums = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphanums) for _ in range(n))
 
-users_file_lock = threading.Lock()
-posts_file_lock = threading.Lock()
+def _is_timestamp(value):
+    '''True if value is a number or a string holding one (timestamps are sent as strings by the server)'''
+    if type(value) not in (int, float, str):
+        return False
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+def _command_kind(command):
+    '''Name of the command type, as counted by the metrics: join, bio, post, directmessage_send/new/all/subscribe, directmessages or invalid'''
+    if type(command) is not dict:
+        return 'invalid'
+    for kind in ('join', 'bio', 'post'):
+        if kind in command:
+            return kind
+    if 'directmessage' in command:
+        args = command['directmessage']
+        if type(args) is dict:
+            return 'directmessage_send'
+        if args in ('new', 'all', 'subscribe'):
+            return f'directmessage_{args}'
+        return 'invalid'
+    if 'directmessages' in command:
+        return 'directmessages'
+    return 'invalid'
+
+
+class FrameTooLarge(Exception):
+    '''Raised when a client sends more than max_frame_size bytes without a line ending'''
+
+
+class LineFramer:
+    '''Splits the bytes received on a connection into CRLF delimited frames (a bare LF is accepted too).
+    A command split over several reads is kept in the buffer until its line ending arrives, and a read holding several commands returns all of them.'''
+
+    def __init__(self, max_frame_size = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._scanned = 0 ##bytes of the buffer already known to hold no line ending
+
+    def feed(self, data):
+        '''Add the bytes of one read to the buffer and return the list of complete frames (without their line ending)'''
+        self._buffer += data
+        frames = []
+        start = 0
+        end = self._buffer.find(b'\n', self._scanned)
+        while True:
+            if end == -1:
+                break
+            frame_end = end - 1 if end > start and self._buffer[end - 1] == 13 else end ##13 is \r, not counted in the frame size
+            if frame_end - start > self.max_frame_size:
+                raise FrameTooLarge(f'Message exceeds the maximum frame size of {self.max_frame_size} bytes.')
+            frames.append(bytes(self._buffer[start:frame_end]))
+            start = end + 1
+            end = self._buffer.find(b'\n', start)
+        del self._buffer[:start]
+        self._scanned = len(self._buffer)
+        pending = len(self._buffer) - self._buffer.endswith(b'\r') ##the \r of a CRLF split over two reads
+        if pending > self.max_frame_size:
+            raise FrameTooLarge(f'Message exceeds the maximum frame size of {self.max_frame_size} bytes.')
+        return frames
+
+
+class Waiter:
+    '''Returned by handle_command instead of a response for the commands that wait for direct messages.
+    subscribe: the connection gets every new message pushed to it from now on ("directmessage": "subscribe").
+    otherwise: long-poll, the new messages are returned as soon as there is one, or an empty list after timeout seconds ("directmessage": "new" with a "timeout").'''
+
+    def __init__(self, username, timeout = None, subscribe = False):
+        self.username = username
+        self.timeout = timeout
+        self.subscribe = subscribe
+
+
+class SessionTable:
+    '''Thread-safe token -> username table shared by every connection (both engines).
+    A session stays valid while a connection uses it. Once its last connection closes, the token can be resumed
+    by a join on a new connection ("token" field of the join command) for ttl seconds, without looking the user up in the store.
+    Expired sessions are dropped by sweep(), which the server runs every SESSION_SWEEP_INTERVAL seconds.'''
+
+    def __init__(self, ttl = SESSION_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._sessions = {} ##token -> [username, connections using it, expiry time once it has none]
+
+    def __contains__(self, token):
+        with self._lock:
+            session = self._sessions.get(token)
+            return session is not None and (session[1] > 0 or session[2] > time.monotonic())
+
+    def __getitem__(self, token):
+        with self._lock:
+            return self._sessions[token][0]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def create(self, username):
+        '''Start a session for username on the calling connection and return its token'''
+        token = generate_token()
+        with self._lock:
+            self._sessions[token] = [username, 1, None]
+        return token
+
+    def resume(self, token, username):
+        '''Attach the calling connection to the session of token. Returns False if there is no such session for username or it expired'''
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None or session[0] != username:
+                return False
+            if session[1] == 0 and session[2] <= time.monotonic():
+                del self._sessions[token]
+                return False
+            session[1] += 1
+            session[2] = None
+            return True
+
+    def detach(self, token):
+        '''Called when a connection using token closes. The session expires ttl seconds after its last connection closed'''
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is None:
+                return
+            session[1] -= 1
+            if session[1] <= 0:
+                session[1] = 0
+                session[2] = time.monotonic() + self.ttl
+
+    def sweep(self):
+        '''Drop the expired sessions. Returns how many were dropped'''
+        now = time.monotonic()
+        with self._lock:
+            expired = [token for token, (_, connections, expiry) in self._sessions.items() if connections == 0 and expiry <= now]
+            for token in expired:
+                del self._sessions[token]
+        return len(expired)
+
+
+class PageCache:
+    '''Thread-safe LRU cache of the rendered flask pages: key -> (etag, html). The first item of a key is its group,
+    'posts' for the pages of /posts and ('user', username) for the pages of /user/<username>.
+    The server invalidates a group whenever a post or a bio of it changes, so a cached page is never stale and serving it
+    does not touch the store (or its locks) at all. Holds at most size pages.'''
+
+    def __init__(self, size = PAGE_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._versions = {} ##group -> invalidations so far, a page rendered before an invalidation of its group is not kept
+
+    def version(self, group):
+        '''Version of group, read before rendering a page of it and passed to put()'''
+        with self._lock:
+            return self._versions.get(group, 0)
+
+    def get(self, key):
+        '''The (etag, html) of key, or None if it is not cached'''
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def put(self, key, version, html):
+        '''Cache html as the page of key unless its group was invalidated since version was read. Returns (etag, html)'''
+        page = (hashlib.blake2b(html.encode(), digest_size = 16).hexdigest(), html)
+        with self._lock:
+            if self._versions.get(key[0], 0) == version:
+                self._pages[key] = page
+                self._pages.move_to_end(key)
+                while len(self._pages) > self.size:
+                    self._pages.popitem(last = False)
+        return page
+
+    def invalidate(self, *groups):
+        '''Drop every cached page of groups'''
+        with self._lock:
+            for group in groups:
+                self._versions[group] = self._versions.get(group, 0) + 1
+            for key in [key for key in self._pages if key[0] in groups]:
+                del self._pages[key]
+
+
 class DSUServer:
     
-    def __init__(self, host = '127.0.0.1', port = 3001):
+    def __init__(self, host = '127.0.0.1', port = 3001, engine = 'threaded', backlog = 128, max_connections = 1024, max_frame_size = MAX_FRAME_SIZE, store_backend = 'json', session_ttl = SESSION_TTL, store_dir = STORE_DIR_PATH):
+        if engine not in ENGINES:
+            raise ValueError(f'Unknown server engine {engine}, expected one of {ENGINES}')
+        if store_backend not in BACKENDS:
+            raise ValueError(f'Unknown store backend {store_backend}, expected one of {BACKENDS}')
         self.host = host
-        self.port = port
-        self.sessions = {} ##token -> user 
+        self.port = port ##0 picks a free port, self.port is set to it once self.listening is set
+        self.listening = threading.Event()
+        self.engine = engine
+        self.backlog = backlog ##size of the listen() queue for connections not accepted yet
+        self.max_connections = max_connections ##connections over this limit get an error response and are closed
+        self.max_frame_size = max_frame_size ##clients sending a longer command get an error response and are disconnected
+        self.sessions = SessionTable(session_ttl) ##token -> user, see SessionTable
+        self.pages = PageCache() ##rendered pages of the flask app, invalidated by _update_bio and _create_post
+        self._stopped = threading.Event()
         self.clients = []
+        self.subscribers = {} ##username -> callbacks waiting for the new messages of that user (subscribe and long-poll)
+        self.subscribers_lock = threading.Lock()
+        if store_backend == 'sqlite':
+            self.store = SqliteStore(Path(store_dir), SQLITE_PATH)
+        else:
+            self.store = JsonStore(Path(store_dir), POSTS_PATH) ##loaded once, users sharded over store/users/, see ds_store.py
+        self.metrics = Metrics() ##served on /metrics by the flask app
+        self.metrics.histogram('decode', 'Time to parse the json of a command.')
+        self.metrics.histogram('lock_wait', 'Time the store waited for a lock (a users shard or the posts with the json store, the write lock with sqlite).')
+        self.metrics.histogram('write', 'Time of a write to disk by the store (a log append with the json store, a commit with sqlite).')
+        self.metrics.gauge('active_connections', 'Connected clients.', lambda: len(self.clients))
+        self.metrics.gauge('sessions', 'Sessions in use or resumable.', lambda: len(self.sessions))
+        self.metrics.gauge('store_file_bytes', 'Size of the store files.', lambda: [({'file': name}, size) for name, size in self.store.file_sizes().items()])
+        self.store.observer = self.metrics.observe
     
     def handle_client(self, client_socket, client_address):
 
-        '''Handle requests from a single client'''
+        '''Handle requests from a single client (threaded engine). The socket is added to self.clients by the accept loop.'''
         current_user_token = None   
-        self.clients.append(client_socket)
+        framer = LineFramer(self.max_frame_size)
+        send_lock = threading.Lock() ##pushes to a subscribed connection are sent by its pusher thread
+        subscriptions = []
+        after_send = [] ##run once the responses of a read were sent, e.g. to mark the delivered messages as read
+        closed = threading.Event() ##stops the pusher threads of the connection
         try:
             while True:
-                data = client_socket.recv(4096)
-                if DEBUG:
-                    print(f"Message received by server: {repr(data)}")
-                direct_message_read = False
-                direct_message_sent = False
-                msg = data.decode().strip() 
-                if not msg:
-                    if DEBUG:
-                        print("Connection closed.")
+                data = client_socket.recv(RECV_SIZE)
+                if not data:
+                    log.debug('connection closed', extra = {'fields': {'peer': client_address}})
                     break
                 try:
-                    command = json.loads(msg.strip())
-                except json.JSONDecodeError:
-                    message = 'Incorrectly formatted JSON message.'
-                    status = 'error'
-                else: 
-                    message = ""
+                    frames = framer.feed(data)
+                except FrameTooLarge as e:
+                    with send_lock:
+                        client_socket.sendall(self._frame_error_response(e))
+                    break
+                ##every complete command of this read is answered with a single sendall
+                responses = []
+                for frame in frames:
+                    resp, current_user_token = self._handle_frame(frame, current_user_token)
+                    if isinstance(resp, Waiter):
+                        resp = self._wait_threaded(resp, client_socket, send_lock, subscriptions, after_send, closed)
+                    if resp is not None:
+                        responses.append(self._encode(resp))
+                if responses:
+                    with send_lock:
+                        client_socket.sendall(b''.join(responses))
+                for callback in after_send:
+                    callback()
+                after_send.clear()
+        except (ConnectionResetError, BrokenPipeError):
+            log.debug('connection reset', extra = {'fields': {'peer': client_address}})
+        except Exception as e:
+            log.error('error handling client', exc_info = e, extra = {'fields': {'peer': client_address}})
+        finally:
+            self._end_session(current_user_token)
+            closed.set()
+            for username, callback in subscriptions:
+                self._unsubscribe(username, callback)
+                callback() ##wakes the pusher thread up so it sees closed
+            client_socket.close()
+            self.clients.remove(client_socket)
+
+    def _wait_threaded(self, waiter, client_socket, send_lock, subscriptions, after_send, closed):
+
+        '''Run a Waiter on the threaded engine. Returns the response to send right away.
+        The messages of the response are marked as read by an after_send callback, once the response was sent.'''
+        wake = threading.Event()
+        if waiter.subscribe:
+            self._subscribe(waiter.username, wake.set)
+            subscriptions.append((waiter.username, wake.set))
+            messages, ids = self._peek_new_messages(waiter.username)
+            after_send.append(lambda: self._mark_read(waiter.username, ids))
+            ##started once the subscribe response was sent, so pushes never come before it
+            pusher = threading.Thread(target = self._push_threaded, args = (waiter.username, wake, closed, client_socket, send_lock), daemon = True)
+            after_send.append(pusher.start)
+            return self._inbox_response(messages)
+
+        self._subscribe(waiter.username, wake.set)
+        try:
+            messages, ids = self._peek_new_messages(waiter.username)
+            if not messages and wake.wait(waiter.timeout):
+                messages, ids = self._peek_new_messages(waiter.username)
+        finally:
+            self._unsubscribe(waiter.username, wake.set)
+        after_send.append(lambda: self._mark_read(waiter.username, ids))
+        return self._inbox_response(messages)
+
+    def _push_threaded(self, username, wake, closed, client_socket, send_lock):
+
+        '''Body of the thread pushing the new messages of username to a subscribed connection (threaded engine).
+        A slow subscriber only holds up this thread, never the connections storing the messages. Messages are marked as read once they were sent.'''
+        while True:
+            wake.wait()
+            wake.clear()
+            if closed.is_set():
+                return
+            messages, ids = self._peek_new_messages(username)
+            if not messages:
+                continue
+            try:
+                with send_lock:
+                    client_socket.sendall(self._encode(self._inbox_response(messages)))
+            except OSError:
+                return
+            self._mark_read(username, ids)
+
+    async def handle_stream(self, reader, writer):
+
+        '''Handle requests from a single client (asyncio engine). Same commands as handle_client, but runs as a task on the event loop instead of a thread.'''
+        client_address = writer.get_extra_info('peername')
+        current_user_token = None
+        if len(self.clients) >= self.max_connections:
+            writer.write(self._connection_limit_response())
+            await writer.drain()
+            writer.close()
+            return
+        self.clients.append(writer)
+        framer = LineFramer(self.max_frame_size)
+        subscriptions = []
+        pushers = []
+        after_send = [] ##run once the responses of a read were sent, see handle_client
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    log.debug('connection closed', extra = {'fields': {'peer': client_address}})
+                    break
+                try:
+                    frames = framer.feed(data)
+                except FrameTooLarge as e:
+                    writer.write(self._frame_error_response(e))
+                    await writer.drain()
+                    break
+                responses = []
+                for frame in frames:
+                    resp, current_user_token = self._handle_frame(frame, current_user_token)
+                    if isinstance(resp, Waiter):
+                        resp = await self._wait_asyncio(resp, writer, subscriptions, pushers, after_send)
+                    if resp is not None:
+                        responses.append(self._encode(resp))
+                if responses:
+                    writer.write(b''.join(responses))
+                    await writer.drain()
+                for callback in after_send:
+                    callback()
+                after_send.clear()
+        except (ConnectionResetError, BrokenPipeError):
+            log.debug('connection reset', extra = {'fields': {'peer': client_address}})
+        except Exception as e:
+            log.error('error handling client', exc_info = e, extra = {'fields': {'peer': client_address}})
+        finally:
+            self._end_session(current_user_token)
+            for username, callback in subscriptions:
+                self._unsubscribe(username, callback)
+            for pusher in pushers:
+                pusher.cancel()
+            writer.close()
+            self.clients.remove(writer)
+
+    async def _wait_asyncio(self, waiter, writer, subscriptions, pushers, after_send):
+
+        '''Run a Waiter on the asyncio engine. Returns the response to send right away.
+        The messages of the response are marked as read by an after_send callback, once the response was sent.'''
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        def deliver():
+            loop.call_soon_threadsafe(wake.set)
+
+        if waiter.subscribe:
+            async def push():
+                while True:
+                    await wake.wait()
+                    wake.clear()
+                    messages, ids = self._peek_new_messages(waiter.username)
+                    if messages:
+                        writer.write(self._encode(self._inbox_response(messages)))
+                        await writer.drain()
+                        self._mark_read(waiter.username, ids)
+            self._subscribe(waiter.username, deliver)
+            subscriptions.append((waiter.username, deliver))
+            messages, ids = self._peek_new_messages(waiter.username)
+            after_send.append(lambda: self._mark_read(waiter.username, ids))
+            ##started once the subscribe response was sent, so pushes never come before it
+            after_send.append(lambda: pushers.append(asyncio.create_task(push())))
+            return self._inbox_response(messages)
+
+        self._subscribe(waiter.username, deliver)
+        try:
+            messages, ids = self._peek_new_messages(waiter.username)
+            if not messages:
+                try:
+                    await asyncio.wait_for(wake.wait(), waiter.timeout)
+                    messages, ids = self._peek_new_messages(waiter.username)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._unsubscribe(waiter.username, deliver)
+        after_send.append(lambda: self._mark_read(waiter.username, ids))
+        return self._inbox_response(messages)
+
+    def _handle_frame(self, frame, current_user_token):
+        '''Run the command in one frame (as returned by LineFramer.feed). Returns the response (None for a blank line, which is ignored) and the token of the connection.'''
+        frame_log.debug('frame received', extra = {'fields': {'frame': ds_logging.Redacted(frame)}})
+        msg = frame.strip()
+        if not msg:
+            return None, current_user_token
+        return self.handle_command(msg, current_user_token)
+
+    def _encode(self, resp):
+        return encode_frame(resp)
+
+    def _inbox_response(self, messages):
+        return {'response': {'type': 'ok', 'messages': messages}}
+
+    def _subscribe(self, username, callback):
+        '''Call callback() as soon as a new message of username is stored. It is called from the thread storing the message
+        and must return right away: it only wakes up the connection of the subscriber, which reads and sends the messages itself.'''
+        with self.subscribers_lock:
+            self.subscribers.setdefault(username, []).append(callback)
+
+    def _unsubscribe(self, username, callback):
+        with self.subscribers_lock:
+            callbacks = self.subscribers.get(username, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self.subscribers.pop(username, None)
+
+    def _notify(self, username):
+        '''Wake the subscribers of username up after a new message was stored for it. The messages stay new until a subscriber sent them.'''
+        with self.subscribers_lock:
+            callbacks = list(self.subscribers.get(username, []))
+        for callback in callbacks:
+            callback()
+
+    def handle_command(self, msg, current_user_token):
+
+        '''Run a single json command (bytes or str) sent by a client. current_user_token is the token of the user joined on that connection (None if nobody joined yet). Returns the response dict and the (possibly new) token of the connection.'''
+        direct_message_read = False
+        direct_message_sent = False
+        batch_results = None
+        waiter = None
+        paged = False
+        start = time.perf_counter()
+        kind = 'invalid'
+        try:
+            command = decode_frame(msg)
+        except json.JSONDecodeError:
+            message = 'Incorrectly formatted JSON message.'
+            status = 'error'
+        else: 
+            self.metrics.observe('decode', time.perf_counter() - start)
+            kind = _command_kind(command)
+            message = ""
+            status = "error"
+
+            if 'join' in command:
+
+                if len(command) != 1: 
                     status = "error"
-                    
-                    if 'join' in command:
-                        
-                        if len(command) != 1: 
-                            status = "error"
-                            message = "Incorrectly formatted join command."
-                        elif len(command['join']) > 3:
-                            status = "error"
-                            message = "Extra fields provided to join command object."
-                        elif not all(field in command['join'] for field in ['username', 'password', 'token']):
-                            status = "error"
-                            message = "Missing required fields for join command object."
-                        elif current_user_token:
-                            status = "error"
-                            message = "User already joined on the active session."
-                        else:
-                            ##execute join command
-                            
-                            uname = command['join']['username']
-                            password = command['join']['password']
-                            token = command['join']['token']
-                            
-                            fetched_user = self._get_or_create_new_user(uname, password)
-
-                            current_user_token = generate_token()
-                            if not fetched_user:
-                                message = f'Welcome to ICS32 Distributed Social, {uname}!'
-                                status = 'ok'
-                                self.sessions[current_user_token] = uname
+                    message = "Incorrectly formatted join command."
+                elif len(command['join']) > 3:
+                    status = "error"
+                    message = "Extra fields provided to join command object."
+                elif not all(field in command['join'] for field in ['username', 'password', 'token']):
+                    status = "error"
+                    message = "Missing required fields for join command object."
+                elif current_user_token:
+                    status = "error"
+                    message = "User already joined on the active session."
+                else:
+                    ##execute join command
+
+                    uname = command['join']['username']
+                    password = command['join']['password']
+                    token = command['join']['token']
+
+                    if type(token) is str and token and self.sessions.resume(token, uname): ##resumed session of a previous connection, no store lookup
+                        current_user_token = token
+                        status = "ok"
+                        message = f'Welcome back, {uname}!'
+                    else:
+                        fetched_user = self._get_or_create_new_user(uname, password)
+
+                        if not fetched_user:
+                            message = f'Welcome to ICS32 Distributed Social, {uname}!'
+                            status = 'ok'
+                            current_user_token = self.sessions.create(uname)
+
 
-                                
-                            else:
-                                if fetched_user['password'] != password:
-                                    status = "error"
-                                    message = f'Incorrect password for the user {uname}'
-                                    current_user_token = None
-                                    
-                                else:
-                                    status = "ok"
-                                    message = f'Welcome back, {uname}!'
-                                    self.sessions[current_user_token] = uname
-
-
-                    elif 'bio' in command:
-                        if 'token' not in command:
-                        
-                            message = "Missing token."
-                            status = "error"
-                            #print('Missing token')
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted bio command."
-                            status = "error"
-                            #print('Incorrectly formatted command')
-                        elif len(command['bio']) > 2:
-                            message = "Extra fields provided to bio command object."
-                            status = "error"
-                            #print('Incorrect number of fields')
-                        elif not all(field in command['bio'] for field in ['entry', 'timestamp']):
-                            status = "error"
-                            message = "Missing required fields for bio command object."
-                        
                         else:
-                            entry = command['bio']['entry']
-                            #timestamp = command['bio']['timestamp']
-                            
-                            timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
-                            token = command['token']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                self._update_bio(current_user, entry, timestamp)
-                                message = f"Bio for {current_user} updated."
-                                status = 'ok'
+                            if fetched_user['password'] != password:
+                                status = "error"
+                                message = f'Incorrect password for the user {uname}'
+                                current_user_token = None
+
                             else:
-                                message = 'Invalid user token.'
-                                status = 'error'
+                                status = "ok"
+                                message = f'Welcome back, {uname}!'
+                                current_user_token = self.sessions.create(uname)
 
-                    elif 'post' in command:
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted post command."
-                            status = 'error'
-                        elif len(command['post']) > 2:
-                            message = "Extra fields provided to post command object."
-                            status = 'error'
-                        elif not all(field in command['post'] for field in ['entry', 'timestamp']):
-                            message = "Missing required fields for post command."
-                            status = 'error'
-                        else:
-                            entry = command['post']['entry']
-                            #timestamp = command['post']['timestamp'] COMMENTED OUT TO SHOW HOW IT COULD USE YOUR PROVIDED TIMESTAMP
-                            
-                            timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
-                            token = command['token']
-                            if token == current_user_token and token in self.sessions:
-                                current_user = self.sessions[token]
-                                self._create_post(current_user, entry, timestamp)
-                                message = f'Post created by {current_user}'
+
+            elif 'bio' in command:
+                if 'token' not in command:
+
+                    message = "Missing token."
+                    status = "error"
+                elif len(command) != 2:
+                    message = "Incorrectly formatted bio command."
+                    status = "error"
+                elif len(command['bio']) > 2:
+                    message = "Extra fields provided to bio command object."
+                    status = "error"
+                elif not all(field in command['bio'] for field in ['entry', 'timestamp']):
+                    status = "error"
+                    message = "Missing required fields for bio command object."
+
+                else:
+                    entry = command['bio']['entry']
+                    #timestamp = command['bio']['timestamp']
+
+                    timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
+                    token = command['token']
+                    if token == current_user_token and token in self.sessions:
+                        current_user = self.sessions[token]
+                        self._update_bio(current_user, entry, timestamp)
+                        message = f"Bio for {current_user} updated."
+                        status = 'ok'
+                    else:
+                        message = 'Invalid user token.'
+                        status = 'error'
+
+            elif 'post' in command:
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2:
+                    message = "Incorrectly formatted post command."
+                    status = 'error'
+                elif len(command['post']) > 2:
+                    message = "Extra fields provided to post command object."
+                    status = 'error'
+                elif not all(field in command['post'] for field in ['entry', 'timestamp']):
+                    message = "Missing required fields for post command."
+                    status = 'error'
+                else:
+                    entry = command['post']['entry']
+                    #timestamp = command['post']['timestamp'] COMMENTED OUT TO SHOW HOW IT COULD USE YOUR PROVIDED TIMESTAMP
+
+                    timestamp = str((datetime.now().timestamp())) ##SERVER GENERATES A TIMESTAMP in this format
+                    token = command['token']
+                    if token == current_user_token and token in self.sessions:
+                        current_user = self.sessions[token]
+                        self._create_post(current_user, entry, timestamp)
+                        message = f'Post created by {current_user}'
+                        status = 'ok'
+                    else:
+                        message = 'Invalid user token.'
+                        status = 'error'
+
+            ###direct message handling
+            elif 'directmessage' in command:
+
+                args = command['directmessage']
+                options = {key: value for key, value in command.items() if key not in ('token', 'directmessage')}
+                allowed_options = DM_OPTIONS.get(args, ()) if type(args) is str else ()
+
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif any(key not in allowed_options for key in options):
+                    message = "Incorrectly formatted directmessage command."
+                    status = 'error'
+                elif 'timeout' in options and (type(options['timeout']) not in (int, float) or options['timeout'] < 0):
+                    message = "Invalid timeout for directmessage command."
+                    status = 'error'
+                elif 'limit' in options and (type(options['limit']) is not int or options['limit'] < 1):
+                    message = "Invalid limit for directmessage command."
+                    status = 'error'
+                elif 'since' in options and not _is_timestamp(options['since']):
+                    message = "Invalid since for directmessage command."
+                    status = 'error'
+                elif 'cursor' in options and type(options['cursor']) is not str:
+                    message = "Invalid cursor for directmessage command."
+                    status = 'error'
+                elif args not in ['all', 'new', 'subscribe'] and not (type(args) is dict and len(args) == 3):
+                    message = "Incorrect fields provided to directmessage command object."
+                    status = 'error'
+                elif type(args) is dict and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
+                    message = "Missing required fields for directmessage command."
+                    status = 'error'
+                else:
+                    token = command['token']
+
+                    if type(args) is dict:
+                        recipient = args['recipient']
+                        #timestamp = args['timestamp']
+                        timestamp = str((datetime.now().timestamp()))
+                        entry = args['entry']
+                        if token == current_user_token and token in self.sessions:
+                            current_user = self.sessions[token]
+                            direct_message_sent = True
+
+                            if self._send_message(entry,current_user, recipient, timestamp):
+                                message = f'Direct message sent'
                                 status = 'ok'
                             else:
-                                message = 'Invalid user token.'
+                                message = f'Unable to send direct message'
                                 status = 'error'
-
-                    ###direct message handling
-                    elif 'directmessage' in command:
-                        
-                        args = command['directmessage']
-
-                        if 'token' not in command:
-                            message = 'Missing token.'
-                            status = 'error'
-                        elif len(command) != 2:
-                            message = "Incorrectly formatted directmessage command."
-                            status = 'error'
-                        elif args not in ['all', 'new'] and not (type(args) is dict and len(args) == 3):
-                            message = "Incorrect fields provided to directmessage command object."
-                            status = 'error'
-                        elif type(args) is dict and not all(field in command['directmessage'] for field in ['entry', 'timestamp', 'recipient']):
-                            message = "Missing required fields for directmessage command."
-                            status = 'error'
                         else:
-                            token = command['token']
-                            
-                            if type(args) is dict:
-                                recipient = args['recipient']
-                                #timestamp = args['timestamp']
-                                timestamp = str((datetime.now().timestamp()))
-                                entry = args['entry']
-                                print(token, current_user_token, self.sessions)
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
-                                    direct_message_sent = True
-                                    
-                                    if self._send_message(entry,current_user, recipient, timestamp):
-                                        message = f'Direct message sent'
-                                        status = 'ok'
-                                    else:
-                                        message = f'Unable to send direct message'
-                                        status = 'error'
-                                else:
-                                    message = 'Invalid user token.'
-                                    status = 'error'
-                            elif args == 'all':
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
-                                    direct_message_read = True
-                                    message = self._read_all_messages(current_user)
-                                    status = 'ok'
-                                else:
-                                    message = f'Invalid user token.'
-                                    status = 'error'
-                            elif args == 'new':
-                                if token == current_user_token and token in self.sessions:
-                                    current_user = self.sessions[token]
+                            message = 'Invalid user token.'
+                            status = 'error'
+                    elif args == 'all':
+                        if token == current_user_token and token in self.sessions:
+                            current_user = self.sessions[token]
+                            if options: ##since/limit/cursor: one page, plus the cursor of the next one
+                                try:
+                                    message, cursor = self._read_messages_page(current_user, **options)
                                     direct_message_read = True
-                                    message = self._read_new_messages(current_user)
+                                    paged = True
                                     status = 'ok'
-                                else:
-                                    message = f'Invalid user token.'
+                                except ValueError as e:
+                                    message = str(e)
                                     status = 'error'
-
                             else:
-                                message = 'Invalid argument for directmessage field.'
-                                status = 'error'
+                                direct_message_read = True
+                                message = self._read_all_messages(current_user)
+                                status = 'ok'
+                        else:
+                            message = f'Invalid user token.'
+                            status = 'error'
+                    elif args == 'new':
+                        if token == current_user_token and token in self.sessions:
+                            current_user = self.sessions[token]
+                            direct_message_read = True
+                            if 'timeout' in options: ##long-poll, answered by the engine once messages arrive
+                                waiter = Waiter(current_user, timeout = min(options['timeout'], MAX_WAIT))
+                            else:
+                                message = self._read_new_messages(current_user)
+                            status = 'ok'
+                        else:
+                            message = f'Invalid user token.'
+                            status = 'error'
+                    elif args == 'subscribe':
+                        if token == current_user_token and token in self.sessions:
+                            current_user = self.sessions[token]
+                            waiter = Waiter(current_user, subscribe = True)
+                            status = 'ok'
+                        else:
+                            message = f'Invalid user token.'
+                            status = 'error'
 
                     else:
-                        message = 'Invalid command.'
+                        message = 'Invalid argument for directmessage field.'
                         status = 'error'
-                if DEBUG:
-                    print(f'Server sending the following message: "{message}"')
-                if direct_message_read:
-                    resp = {'response': {'type':status, 'messages': message} }
-                elif direct_message_sent:
-                    resp = {'response': {'type':status, 'message': message} }
-                elif status == 'ok':
-                    resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
+
+            ###batch of direct messages, validated item by item then stored in one transaction
+            elif 'directmessages' in command:
+                items = command['directmessages']
+                if 'token' not in command:
+                    message = 'Missing token.'
+                    status = 'error'
+                elif len(command) != 2 or type(items) is not list:
+                    message = "Incorrectly formatted directmessages command."
+                    status = 'error'
+                elif not items or len(items) > MAX_BATCH:
+                    message = f"A directmessages command holds 1 to {MAX_BATCH} direct messages."
+                    status = 'error'
+                elif not (command['token'] == current_user_token and command['token'] in self.sessions):
+                    message = 'Invalid user token.'
+                    status = 'error'
                 else:
-                    resp = {'response': {'type':status, 'message': message}}
-                json_response = json.dumps(resp).encode()
-                client_socket.sendall(json_response + b'\r\n')
-            if current_user_token and current_user_token in self.sessions:
-                del self.sessions[current_user_token]
-        except Exception as e:
-            print(f"Error handling client {client_address}: {e}")
-        finally:
-            client_socket.close()
-            self.clients.remove(client_socket)
+                    current_user = self.sessions[command['token']]
+                    batch_results = [self._check_batch_item(item) for item in items]
+                    valid = [i for i, result in enumerate(batch_results) if result is None]
+                    timestamp = str((datetime.now().timestamp()))
+                    sent = self._send_messages(current_user, [(items[i]['entry'], items[i]['recipient'], timestamp) for i in valid])
+                    for i, ok in zip(valid, sent):
+                        batch_results[i] = {'type': 'ok', 'message': 'Direct message sent'} if ok else {'type': 'error', 'message': 'Unable to send direct message'}
+                    message = f'{sum(sent)} of {len(items)} direct messages sent'
+                    status = 'ok'
+
+            else:
+                message = 'Invalid command.'
+                status = 'error'
+        self.metrics.observe_command(kind, time.perf_counter() - start, status == 'error')
+        if waiter:
+            return waiter, current_user_token
+        frame_log.debug('response', extra = {'fields': {'command': kind, 'status': status, 'message': message}})
+        if direct_message_read:
+            resp = {'response': {'type':status, 'messages': message} }
+            if paged:
+                resp['response']['cursor'] = cursor
+        elif direct_message_sent:
+            resp = {'response': {'type':status, 'message': message} }
+        elif batch_results is not None:
+            resp = {'response': {'type':status, 'message': message, 'results': batch_results} }
+        elif status == 'ok':
+            resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
+        else:
+            resp = {'response': {'type':status, 'message': message}}
+        return resp, current_user_token
+
+    def _end_session(self, current_user_token):
+        '''Detach a closed connection from its session, which can be resumed for a while (see SessionTable)'''
+        if current_user_token:
+            self.sessions.detach(current_user_token)
+
+    def _sweep_sessions(self):
+        '''Body of the thread dropping the expired sessions'''
+        while not self._stopped.wait(SESSION_SWEEP_INTERVAL):
+            self.sessions.sweep()
+
+    def _frame_error_response(self, error):
+        resp = {'response': {'type': 'error', 'message': str(error)}}
+        return encode_frame(resp)
+
+    def _connection_limit_response(self):
+        resp = {'response': {'type': 'error', 'message': 'Server is at its connection limit, try again later.'}}
+        return encode_frame(resp)
             
     
 
     def _send_message(self, entry, username, recipient, timestamp = ''):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-            
-            fetched_sender = existing_users.get(username, None)
-            fetched_user = existing_users.get(recipient, None)
-            if not fetched_sender:
-                return False
-            if not fetched_user:
-                return False
-            
-            else:
-                with users_path.open('w') as user_file:
-                    fetched_sender['messages'].append({'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'})
-                    fetched_user['messages'].append({'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'new'})
-                    existing_users[recipient] = fetched_user
-                    existing_users[username] = fetched_sender
-                    json.dump(existing_users, user_file)
+        if not self.store.send_message(entry, username, recipient, timestamp):
+            return False
+        self._notify(recipient)
         return True
 
-    def _read_all_messages(self, username):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if 'from' in message:
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                else:
-                    mod_message = {'recipient': message['recipient'], 'message': message['message'], 'timestamp': message['timestamp']}
-                result.append(mod_message)
-                if message['status'] == 'new':
-                    message['status'] = 'read'
+    def _send_messages(self, username, messages):
+        '''Store a batch of (entry, recipient, timestamp) direct messages from username in one transaction and notify each recipient once. Returns one bool per message'''
+        if not messages:
+            return []
+        results = self.store.send_messages(username, messages)
+        for recipient in {recipient for (_, recipient, _), ok in zip(messages, results) if ok}:
+            self._notify(recipient)
+        return results
 
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    existing_users[username] = fetched_user
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+    def _check_batch_item(self, item):
+        '''Returns the error result of an item of a directmessages command, or None if it is a well formed direct message'''
+        if type(item) is not dict or len(item) != 3:
+            return {'type': 'error', 'message': "Incorrect fields provided to directmessage command object."}
+        if not all(field in item for field in ['entry', 'timestamp', 'recipient']):
+            return {'type': 'error', 'message': "Missing required fields for directmessage command."}
+        if type(item['entry']) is not str or type(item['recipient']) is not str:
+            return {'type': 'error', 'message': "Invalid entry or recipient for directmessage command."}
+        return None
+
+    def _read_all_messages(self, username):
+        return self.store.read_all_messages(username)
 
     
+    def _read_messages_page(self, username, since = None, limit = None, cursor = None):
+        return self.store.read_messages_page(username, since, limit, cursor)
+
     def _read_new_messages(self, username):
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if message['status'] == 'new':
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                    result.append(mod_message)
-                    message['status'] = 'read'
-            
-            
-            else:
-                with users_path.open('w') as user_file:
-                    existing_users[username] = fetched_user
-                    
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+        return self.store.read_new_messages(username)
 
+    def _peek_new_messages(self, username):
+        '''The new messages of username and their ids, left new until _mark_read is called with the ids once they were sent'''
+        return self.store.peek_new_messages(username) or ([], [])
 
+    def _mark_read(self, username, ids):
+        '''Mark the messages with ids (returned by _peek_new_messages) as read'''
+        if ids:
+            self.store.mark_read(username, ids)
 
 
     def _get_user(self, username):
 
         '''Gets the user object associated with the username. This function is never called.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-                fetched_user = existing_users.get(username, None)
-                return fetched_user
+        return self.store.get_user(username)
     
 
 
     def _get_or_create_new_user(self, username, password):
 
-        '''Read from the user file and get the username associated with the username. If it doesnt exist, create a new user.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            if fetched_user:
-                return fetched_user
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    fetched_user = existing_users.get(username, None)
-                    if fetched_user: ##double check that no user exists
-                        return False
-                    else:
-                        existing_users.update({username: {'password': password, 'bio': {"entry": "", "timestamp": ""}, 'posts': [], 'messages':[]}})
-                    json.dump(existing_users, user_file)
+        '''Get the user associated with the username from the store. If it doesnt exist, create a new user (and return None).'''
+        return self.store.get_or_create_user(username, password)
             
     
     
     def _update_bio(self,username, entry, timestamp):
 
         '''Update the bio associated with the username.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            with users_path.open('w') as user_file:
-                
-                fetched_user = existing_users.get(username, None)
-                if not fetched_user: ##double check that no user exists
-                    return False
-                else:
-                    fetched_user['bio'] = {'entry':entry, 'timestamp':timestamp}
-                    
-                json.dump(existing_users, user_file)
+        updated = self.store.update_bio(username, entry, timestamp)
+        if updated:
+            self.pages.invalidate(('user', username))
+        return updated
 
     
     def _create_post(self, username, entry, timestamp):
         '''Create a post for the user (username). Add the post to the user's posts and add the post to the list of all posts'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-
-            fetched_user = existing_users.get(username, None)
-            
-            with users_path.open('w') as user_file:
-                fetched_user = existing_users.get(username, None)
-                if not fetched_user: ##double check that user exists
-                    return False
-                else:
-                    fetched_user['posts'].insert(0, {'user': username, 'entry':entry, 'timestamp':timestamp})
-                    
-                json.dump(existing_users, user_file)
-        with posts_file_lock:
-            existing_posts = None
-            posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-            with posts_path.open('r') as posts_file:
-                existing_posts = json.load(posts_file)['posts']
-            
-            existing_posts.insert(0, {'user':username, 'entry':entry, 'timestamp':timestamp})
-
-            with posts_path.open('w') as posts_file:
-                json.dump({"posts":existing_posts}, posts_file)
+        created = self.store.create_post(username, entry, timestamp)
+        if created:
+            self.pages.invalidate('posts', ('user', username))
+        return created
         
     def _create_storage_system(self):
-        '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" with two files posts.json and users.json'''
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-        store_path = Path('.') / Path(STORE_DIR_PATH)
-        store_path.mkdir(exist_ok=True)
-        if not users_path.exists():
-            with users_path.open('w') as json_file:
-                json.dump({}, json_file, indent=4)
-        if not posts_path.exists():
-            with posts_path.open('w') as json_file:
-                json.dump({'posts':[]}, json_file, indent=4)
+        '''Creates the local storage system if it doesnt already exist and opens it. Everything lives in a directory called "store", the files depend on the store backend (see the top of this file)'''
+        self.store.open()
 
     def start_server(self):
         
         '''Starts the server (hence the name of the method :))'''
         self._create_storage_system() #does nothing if the server store files exists already
+        threading.Thread(target = self._sweep_sessions, daemon = True).start()
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
-                srv.bind((self.host, self.port))
-                srv.listen(5)
-                if DEBUG:
-                    print("DSUserver is listening on port", self.port)
-                while True:
-                    connection, address = srv.accept()
-                    client_handler = threading.Thread(target = self.handle_client, args = (connection,address))
-                    client_handler.start()
+            if self.engine == 'asyncio':
+                asyncio.run(self._serve_asyncio())
+            else:
+                self._serve_threaded()
         except KeyboardInterrupt as e:
-            if DEBUG:
-                print(f'Server shutting down...')
+            log.info('server shutting down')
         finally:
             for conn in self.clients:
                 conn.close()
             self.clients = []
-            if DEBUG:
-                print('Disconnected all clients.')
+            self._stopped.set()
+            self.store.close()
+            log.info('disconnected all clients')
+
+    def _serve_threaded(self):
+        '''Accept loop of the threaded engine, one thread per client'''
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
+            srv.bind((self.host, self.port))
+            srv.listen(self.backlog)
+            self.port = srv.getsockname()[1]
+            self.listening.set()
+            log.info('DSUserver is listening', extra = {'fields': {'port': self.port, 'engine': 'threaded'}})
+            while True:
+                connection, address = srv.accept()
+                if len(self.clients) >= self.max_connections:
+                    connection.sendall(self._connection_limit_response())
+                    connection.close()
+                    continue
+                self.clients.append(connection)
+                client_handler = threading.Thread(target = self.handle_client, args = (connection,address))
+                client_handler.start()
+
+    async def _serve_asyncio(self):
+        '''Accept loop of the asyncio engine, every client is a task on the same event loop'''
+        srv = await asyncio.start_server(self.handle_stream, self.host, self.port, backlog = self.backlog)
+        self.port = srv.sockets[0].getsockname()[1]
+        self.listening.set()
+        log.info('DSUserver is listening', extra = {'fields': {'port': self.port, 'engine': 'asyncio'}})
+        async with srv:
+            await srv.serve_forever()
 
         
 
@@ -477,60 +925,110 @@ def index():
     # Display the latest messages from the TCP server in the browser
     return redirect(url_for('posts'))
 
+def _page_args():
+    '''page (from 1) and limit query parameters of the paginated views, invalid values fall back to the defaults
+    and both are clamped (page to MAX_PAGE, limit to MAX_PAGE_SIZE)'''
+    page = min(max(1, request.args.get('page', 1, type = int)), MAX_PAGE)
+    limit = min(max(1, request.args.get('limit', PAGE_SIZE, type = int)), MAX_PAGE_SIZE)
+    return page, limit
+
+def _cached_page(key, render):
+    '''Serve the page of key from the page cache, render() it on a miss (render returns None for a page that does not exist).
+    The response carries the ETag of the page and is a 304 without body when the client sent it back in If-None-Match'''
+    pages = app.config['DSU_PAGES']
+    page = pages.get(key)
+    if page is None:
+        version = pages.version(key[0])
+        html = render()
+        if html is None:
+            return "User not found..."
+        page = pages.put(key, version, html)
+    etag, html = page
+    response = Response(html, content_type = 'text/html; charset=utf-8')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache' ##browsers keep the page but ask again with If-None-Match
+    return response.make_conditional(request)
+
 @app.route('/posts') #UNCOMMENT IF YOU WANT
 def posts():
-    with posts_file_lock:
-        existing_posts = None
-        posts_path = Path('.') / STORE_DIR_PATH / Path(POSTS_PATH)
-        with posts_path.open('r') as posts_file:
-            existing_posts = json.load(posts_file)['posts']
+    page, limit = _page_args()
 
-    return render_template('index.html', posts = existing_posts)
+    def render():
+        existing_posts = app.config['DSU_STORE'].get_posts((page - 1) * limit, limit + 1) ##one more post tells if there is a next page
+        return render_template('index.html', posts = existing_posts[:limit], page = page, limit = limit, has_next = len(existing_posts) > limit)
+    return _cached_page(('posts', page, limit), render)
 
 @app.route('/user/<string:username>') #UNCOMMENT IF YOU WANT
 def user_profile(username):
-    with users_file_lock:
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        existing_users = None
-        with users_path.open('r') as user_file:
-            existing_users = json.load(user_file)
-
-        fetched_user = existing_users.get(username, None)
-        #print(fetched_user['posts'])
-        if fetched_user:
-            user = {'username': username, 'bio': fetched_user['bio']['entry'], 'biots': fetched_user['bio']['timestamp'], 'posts': fetched_user['posts'] }
-            return render_template('user_profile.html', user = user)
-        else:
-            return "User not found..."
+    page, limit = _page_args()
+
+    def render():
+        fetched_user = app.config['DSU_STORE'].get_profile(username, (page - 1) * limit, limit + 1)
+        if not fetched_user:
+            return None
+        user = {'username': username, 'bio': fetched_user['bio']['entry'], 'biots': fetched_user['bio']['timestamp'], 'posts': fetched_user['posts'][:limit] }
+        return render_template('user_profile.html', user = user, page = page, limit = limit, has_next = len(fetched_user['posts']) > limit)
+    return _cached_page((('user', username), page, limit), render)
+
+
+@app.route('/metrics')
+def metrics_page():
+    '''Metrics of the DSU server in the Prometheus text format'''
+    return Response(app.config['DSU_METRICS'].render(), content_type = METRICS_CONTENT_TYPE)
 
 
 def run_flask_server(host = '127.0.0.1', port = 3002):
     app.run(host = host, port = port)
 
 
-def run_servers(host = '127.0.0.1', port1 = 3001, port2 = 3002):
+def run_servers(host = '127.0.0.1', port1 = 3001, port2 = 3002, engine = 'threaded', backlog = 128, max_connections = 1024, max_frame_size = MAX_FRAME_SIZE, store_backend = 'json', session_ttl = SESSION_TTL):
+
+    server = DSUServer(host, port1, engine, backlog, max_connections, max_frame_size, store_backend, session_ttl)
+    try:
+        server._create_storage_system() ##the flask views read from the same in-memory store
+    except StoreError as e:
+        log.error(f'Unable to open the store: {e}')
+        return
+    app.config['DSU_STORE'] = server.store
+    app.config['DSU_METRICS'] = server.metrics
+    app.config['DSU_PAGES'] = server.pages
 
     #UNCOMMENT THE FOLLOWING LINES TO RUN THE FLASK SERVER
     flask_thread = threading.Thread(target=run_flask_server, daemon=True, args = (host, port2))
     flask_thread.start()
 
     try:
-        server = DSUServer(host, port1)
         server.start_server()
     except Exception as e:
-        print(f'Server raised the following error:{e}')
+        log.error('Server raised the following error', exc_info = e)
     
 
 
+def parse_args(argv):
+    '''Command line options. The two ports are positional, like before: python server.py [port1] [port2] [options]'''
+    parser = argparse.ArgumentParser(description = 'ICS32 Distributed Social server')
+    parser.add_argument('port1', nargs = '?', type = int, default = 3001, help = 'port of the DSU (TCP) server')
+    parser.add_argument('port2', nargs = '?', type = int, default = 3002, help = 'port of the flask web server')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--engine', choices = ENGINES, default = 'threaded', help = 'threaded: one thread per client, asyncio: one event loop for every client')
+    parser.add_argument('--backlog', type = int, default = 128, help = 'listen() backlog for connections not accepted yet')
+    parser.add_argument('--max-connections', type = int, default = 1024, help = 'clients connected at the same time, extra connections are refused')
+    parser.add_argument('--max-frame-size', type = int, default = MAX_FRAME_SIZE, help = 'longest command in bytes a client may send')
+    parser.add_argument('--session-ttl', type = float, default = SESSION_TTL, help = 'seconds a client may resume its session after its connection closed')
+    parser.add_argument('--log-level', choices = ds_logging.LOG_LEVELS, default = LOG_LEVEL, help = 'DEBUG also logs every frame received and every response')
+    parser.add_argument('--log-format', choices = ds_logging.LOG_FORMATS, default = 'text', help = 'text lines or one json object per line')
+    parser.add_argument('--log-file', default = None, help = 'append the logs to this file instead of stderr')
+    parser.add_argument('--log-frames-every', type = int, default = 1, help = 'with DEBUG, log only one frame/response of every N')
+    parser.add_argument('--store', choices = BACKENDS, default = 'json', help = 'json: in-memory json files with write-ahead logs, sqlite: SQLite database in WAL mode')
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
-    host = '127.0.0.1'
-    port1 = 3001
-    port2 = 3002
-    if len(sys.argv) >= 2:
-        port1 = int(sys.argv[1])
-    if len(sys.argv) >= 3:
-        port2 = int(sys.argv[2])
-   
-    run_servers(host,port1,port2)
+    args = parse_args(sys.argv[1:])
+    log_listener = ds_logging.configure(args.log_level, args.log_format, args.log_file, args.log_frames_every)
+    try:
+        run_servers(args.host, args.port1, args.port2, args.engine, args.backlog, args.max_connections, args.max_frame_size, args.store, args.session_ttl)
+    finally:
+        log_listener.stop() ##writes the records still queued
 
 
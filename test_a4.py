@@ -0,0 +1,117 @@
+'''
+test_a4.py
+
+Tests the parts of a4.py that do not need a display: when new
+messages are taken from the inbox queue and when the server is polled,
+which messages the chat pane renders, and the NetworkWorker.
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import queue
+import threading
+import time
+import a4
+
+
+def test_no_file_loaded_keeps_inbox():
+    '''
+    Tests that connecting without a file loaded neither polls the
+    server nor takes the pushed messages off the queue, and that they
+    are all handed over once a file is loaded.
+    '''
+    inbox_queue = queue.Queue()
+    inbox_queue.put([{'from': 'alice', 'message': 'hi', 'timestamp': '1.0'}])
+    inbox_queue.put([{'from': 'alice', 'message': 'again', 'timestamp': '2.0'}])
+    assert not a4.needs_poll(is_loaded=False, listening=False, poll_in_flight=False)
+    assert a4.take_inbox(inbox_queue, is_loaded=False) == []
+    assert inbox_queue.qsize() == 2
+
+    assert [message['message'] for message in a4.take_inbox(inbox_queue, is_loaded=True)] == [
+        'hi', 'again']
+    assert inbox_queue.empty()
+    assert a4.take_inbox(inbox_queue, is_loaded=True) == []
+
+
+def test_needs_poll():
+    '''
+    Tests that the server is polled only with a file loaded, without
+    a listener and without a poll in flight.
+    '''
+    assert a4.needs_poll(is_loaded=True, listening=False, poll_in_flight=False)
+    assert not a4.needs_poll(is_loaded=True, listening=True, poll_in_flight=False)
+    assert not a4.needs_poll(is_loaded=True, listening=False, poll_in_flight=True)
+
+
+def test_appended_messages():
+    '''
+    Tests that only the messages added since the conversation was
+    shown are rendered, also after older messages were loaded in
+    front, and that another conversation is rendered again.
+    '''
+    shown = [object() for _ in range(150)]
+    first = a4.page_start(len(shown))
+    assert first == 150 - a4.RENDER_PAGE
+    new = [object(), object()]
+    assert a4.appended_messages(shown, first, shown + new) == (new, first)
+    assert a4.appended_messages(shown, first, list(shown)) == ([], first)
+
+    older = [object() for _ in range(10)]
+    assert a4.appended_messages(shown, first, older + shown + new) == (new, first + 10)
+
+    assert a4.appended_messages(shown, first, shown[:-1]) is None
+    # the first rendered message was replaced: not the same conversation
+    assert a4.appended_messages(shown, 0, [object()] + shown[1:]) is None
+    assert a4.appended_messages([], 0, new) is None
+
+
+def test_page_start():
+    '''
+    Tests the pages of messages rendered when scrolling up.
+    '''
+    assert a4.page_start(0) == 0
+    assert a4.page_start(a4.RENDER_PAGE - 1) == 0
+    assert a4.page_start(a4.RENDER_PAGE + 5) == 5
+
+
+def wait_for_results(worker, count, timeout=5.0):
+    '''
+    Calls process_results, like the main thread does every
+    NETWORK_CHECK_MS, until only count jobs are in flight.
+    '''
+    deadline = time.monotonic() + timeout
+    while len(worker.in_flight) > count:
+        assert time.monotonic() < deadline
+        worker.process_results()
+        time.sleep(0.01)
+
+
+def test_network_worker():
+    '''
+    Tests that the jobs of the NetworkWorker run in order off the
+    calling thread, that their callbacks run in process_results, and
+    that a job that raises hands None to its callback.
+    '''
+    worker = a4.NetworkWorker()
+    results = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow(value):
+        started.set()
+        release.wait(5)
+        return value
+
+    def fail():
+        raise OSError('network down')
+
+    worker.submit('Slow', slow, 1, callback=results.append)
+    worker.submit('Failing', fail, callback=results.append)
+    worker.submit('Fast', lambda: 3, callback=results.append)
+    assert started.wait(5)
+    worker.process_results()
+    assert worker.in_flight == ['Slow', 'Failing', 'Fast'] and results == []
+    release.set()
+    wait_for_results(worker, 0)
+    assert results == [1, None, 3]
@@ -0,0 +1,47 @@
+'''
+test_ds_logging.py
+
+Tests the functionality of ds_logging.py. No server needs to be running.
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import json
+import logging
+import ds_logging as dsl
+
+
+def test_redacted():
+    '''
+    Tests that tokens and passwords are masked in logged frames.
+    '''
+    frame = b'{"join": {"username": "alice", "password": "secret", "token": "abc"}}'
+    assert str(dsl.Redacted(frame)) == \
+        '{"join": {"username": "alice", "password": "***", "token": "***"}}'
+    assert 'abc' not in repr(dsl.Redacted(b'{"token":"abc","directmessage":"new"}'))
+
+
+def test_sample_filter():
+    '''
+    Tests that SampleFilter keeps one record of every N.
+    '''
+    sample = dsl.SampleFilter(3)
+    record = logging.LogRecord('dsu', logging.DEBUG, __file__, 1, 'frame', None, None)
+    assert [sample.filter(record) for _ in range(7)] == [True, False, False,
+                                                         True, False, False, True]
+
+
+def test_structured_formatter():
+    '''
+    Tests the text and json lines written for a record with fields.
+    '''
+    record = logging.LogRecord('dsu.server', logging.INFO, __file__, 1,
+                               'listening on %s', ('port',), None)
+    record.fields = {'port': 3001}
+    assert dsl.StructuredFormatter().format(record).endswith(
+        'INFO dsu.server listening on port port=3001')
+    entry = json.loads(dsl.StructuredFormatter(as_json=True).format(record))
+    assert entry['message'] == 'listening on port'
+    assert entry['port'] == 3001
+    assert entry['level'] == 'INFO'
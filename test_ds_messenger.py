@@ -9,6 +9,10 @@ Stephanie Lee
 stephl25@uci.edu
 
 '''
+import json
+import socket
+import threading
+import time
 import ds_messenger as dsm
 
 
@@ -101,6 +105,105 @@ def test_init_socket_exceptions():
     assert dm_test_obj_4.init_socket() is False
 
 
+def test_request_timeout():
+    '''
+    Tests that a server that accepts the connection but never answers
+    makes the session fail after timeout seconds instead of hanging.
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as silent_server:
+        silent_server.bind(('127.0.0.1', 0))
+        silent_server.listen()
+        dm_test_obj = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest",
+                                          timeout=0.3, port=silent_server.getsockname()[1])
+        start = time.monotonic()
+        assert not dm_test_obj.start_session()
+        assert time.monotonic() - start < 5
+        dm_test_obj.close_socket()
+
+
+def test_no_resend_after_timeout(tmp_path):
+    '''
+    Tests that a direct message whose response timed out is not sent
+    again (the server may have stored it) but kept in the outbox, while
+    the next request reconnects and goes through.
+    '''
+    frames = []
+
+    def slow_server(listener):
+        for _ in range(2):
+            connection, _ = listener.accept()
+            with connection, connection.makefile('rb') as reader:
+                for line in reader:
+                    frames.append(json.loads(line))
+                    if 'join' in frames[-1]:
+                        response = {'type': 'ok', 'message': 'joined', 'token': 'slow-token'}
+                    else:
+                        time.sleep(0.6)  # longer than the client timeout
+                        response = {'type': 'ok', 'message': 'stored'}
+                    try:
+                        connection.sendall(json.dumps({'response': response}).encode() + b'\r\n')
+                    except OSError:
+                        break
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        threading.Thread(target=slow_server, args=(listener,), daemon=True).start()
+        dm_test_obj = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest",
+                                          timeout=0.3, port=listener.getsockname()[1],
+                                          outbox=tmp_path / 'outbox')
+        assert dm_test_obj.start_session()
+        assert dm_test_obj.send("only once", "temp_user") is False
+        assert [dm.message for dm in dm_test_obj.outbox.load()] == ["only once"]
+        time.sleep(0.5)
+        assert [frame.get('directmessage', {}).get('entry') for frame in frames
+                if 'directmessage' in frame] == ["only once"]
+        # the next request is written on a new connection
+        assert dm_test_obj.retrieve_all() is None
+        assert sum('join' in frame for frame in frames) == 2
+        dm_test_obj.close_socket()
+
+
+def test_send_after_server_restart():
+    '''
+    Tests that a message sent after the server closed the session
+    connection (restart) is sent on a new connection instead of being
+    written to the dead one and lost.
+    '''
+    frames = []
+    restarted = threading.Event()
+
+    def restarting_server(listener):
+        for number in range(2):
+            connection, _ = listener.accept()
+            with connection, connection.makefile('rb') as reader:
+                for line in reader:
+                    frames.append((number, json.loads(line)))
+                    if 'join' in frames[-1][1]:
+                        response = {'type': 'ok', 'message': 'joined', 'token': f'token-{number}'}
+                    else:
+                        response = {'type': 'ok', 'message': 'stored'}
+                    connection.sendall(json.dumps({'response': response}).encode() + b'\r\n')
+                    if number == 0 and 'directmessage' in frames[-1][1]:
+                        break  # the server goes down after the first message
+            restarted.set()
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        threading.Thread(target=restarting_server, args=(listener,), daemon=True).start()
+        dm_test_obj = dsm.DirectMessenger("127.0.0.1", "restart_user", "pwd",
+                                          timeout=2, port=listener.getsockname()[1])
+        assert dm_test_obj.start_session()
+        assert dm_test_obj.send("first", "temp_user") is True
+        assert restarted.wait(5)
+        time.sleep(0.1)
+        assert dm_test_obj.send("second", "temp_user") is True
+        assert [(number, frame['directmessage']['entry']) for number, frame in frames
+                if 'directmessage' in frame] == [(0, "first"), (1, "second")]
+        dm_test_obj.close_socket()
+
+
 def test_send():
     '''
     Tests send() function of ds_messenger.py
@@ -122,6 +225,74 @@ def test_send():
     assert is_ok is True
 
 
+def test_send_many():
+    '''
+    Tests send_many() function of ds_messenger.py
+    '''
+    receiver = dsm.DirectMessenger("127.0.0.1", "temp_user", "temp_password")
+    receiver.start_session()
+    receiver.retrieve_new()
+
+    sender = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest")
+    sender.start_session()
+    count = dsm.PIPELINE_WINDOW * 2 + 5
+    messages = [(f"bulk {i}", "temp_user") for i in range(count)]
+    results = sender.send_many(messages + [("to nobody", "")])
+    assert results == [True] * count + [False]
+
+    inbox = receiver.retrieve_new()
+    assert [msg['message'] for msg in inbox] == [message for message, _ in messages]
+    sender.close_socket()
+    receiver.close_socket()
+
+
+def test_send_batch():
+    '''
+    Tests send_batch() function of ds_messenger.py
+    '''
+    receiver = dsm.DirectMessenger("127.0.0.1", "temp_user", "temp_password")
+    receiver.start_session()
+    receiver.retrieve_new()
+
+    sender = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest")
+    assert sender.send_batch([("too early", "temp_user")]) == [False]
+    sender.start_session()
+    messages = [(f"fan-out {i}", "temp_user") for i in range(300)]
+    results = sender.send_batch(messages + [("to nobody", "no_such_user_dm")])
+    assert results == [True] * 300 + [False]
+    assert sender.send_batch([]) == []
+
+    inbox = receiver.retrieve_new()
+    assert [msg['message'] for msg in inbox] == [message for message, _ in messages]
+    sender.close_socket()
+    receiver.close_socket()
+
+
+def test_outbox(tmp_path):
+    '''
+    Tests that messages that cannot be delivered are kept in the
+    outbox and sent by resend_outbox()
+    '''
+    # establishing a user to send to
+    receiver = dsm.DirectMessenger("127.0.0.1", "outbox_user", "outbox_password")
+    receiver.start_session()
+    receiver.close_socket()
+
+    outbox_path = tmp_path / "outbox.jsonl"
+    sender = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest",
+                                 outbox=outbox_path)
+    # not joined yet, nothing can be delivered
+    assert sender.send_many([("first", "outbox_user"), ("second", "outbox_user")]) == [False, False]
+    assert sender.send("third", "outbox_user") is False
+    assert [dm.message for dm in sender.outbox.load()] == ["first", "second", "third"]
+
+    sender.start_session()
+    assert sender.resend_outbox() == 3
+    assert len(sender.outbox) == 0
+    assert sender.resend_outbox() == 0
+    sender.close_socket()
+
+
 def test_retrieve_new():
     '''
     Tests retrieve_new() function of ds_messenger.py
@@ -190,6 +361,142 @@ def test_get_response_exception():
     dm_test_obj_1.send("A message to a non-existent user", "A non-existent user")
 
 
+def test_connection_reuse():
+    '''
+    Tests that the session connection stays open between requests
+    and is re-established when it drops.
+    '''
+    dm_test_obj_2 = dsm.DirectMessenger("127.0.0.1", "reuse_user", "reuse_password")
+    dm_test_obj_2.start_session()
+    dm_test_obj_2.close_socket()
+
+    dm_test_obj_1 = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest")
+    dm_test_obj_1.start_session()
+    session_conn = dm_test_obj_1.dsp_conn
+    assert isinstance(dm_test_obj_1.retrieve_new(), list)
+    assert dm_test_obj_1.send("Reusing the connection", "reuse_user") is True
+    assert dm_test_obj_1.dsp_conn is session_conn
+
+    # simulate the server dropping the connection
+    session_conn.socket.shutdown(socket.SHUT_RDWR)
+    assert isinstance(dm_test_obj_1.retrieve_all(), list)
+    assert dm_test_obj_1.dsp_conn is not session_conn
+
+    # closed by the client, the next request reconnects
+    dm_test_obj_1.close_socket()
+    assert dm_test_obj_1.dsp_conn is None
+    assert isinstance(dm_test_obj_1.retrieve_new(), list)
+    dm_test_obj_1.close_socket()
+
+
+def test_session_resume():
+    '''
+    Tests that joining again on a new connection resumes the session
+    of the previous connection, unless resume is off.
+    '''
+    dm_test_obj_1 = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest")
+    dm_test_obj_1.start_session()
+    first_token = dm_test_obj_1.token
+    dm_test_obj_1.close_socket()
+    assert dm_test_obj_1.start_session() == 'Welcome back, testingdm!'
+    assert dm_test_obj_1.token == first_token
+    assert isinstance(dm_test_obj_1.retrieve_new(), list)
+
+    # the token of another user is not resumed, the password is checked instead
+    dm_test_obj_2 = dsm.DirectMessenger("127.0.0.1", "reuse_user", "wrong password")
+    dm_test_obj_2.token = first_token
+    assert dm_test_obj_2.start_session() is None
+
+    dm_test_obj_3 = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest", resume=False)
+    dm_test_obj_3.start_session()
+    second_token = dm_test_obj_3.token
+    dm_test_obj_3.close_socket()
+    dm_test_obj_3.start_session()
+    assert dm_test_obj_3.token not in (first_token, second_token)
+    dm_test_obj_3.close_socket()
+    dm_test_obj_1.close_socket()
+
+
+def test_wait_new():
+    '''
+    Tests wait_new() returns as soon as a message arrives and
+    returns an empty list once the timeout expires.
+    '''
+    dm_test_obj_1 = dsm.DirectMessenger("127.0.0.1", "waiting_user", "wait_password")
+    dm_test_obj_1.start_session()
+    dm_test_obj_1.retrieve_new()
+    assert dm_test_obj_1.wait_new(0.2) == []
+
+    dm_test_obj_2 = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest")
+    dm_test_obj_2.start_session()
+    sender = threading.Timer(0.2, dm_test_obj_2.send, ("Wake up", "waiting_user"))
+    sender.start()
+    inbox = dm_test_obj_1.wait_new(10)
+    sender.join()
+    assert [msg['message'] for msg in inbox] == ["Wake up"]
+    dm_test_obj_1.close_socket()
+    dm_test_obj_2.close_socket()
+
+
+def test_subscribe():
+    '''
+    Tests that subscribe() yields the messages pushed by the server
+    and ends after stop_subscription().
+    '''
+    dm_test_obj_1 = dsm.DirectMessenger("127.0.0.1", "subscribed_user", "sub_password")
+    dm_test_obj_1.start_session()
+    dm_test_obj_1.retrieve_new()
+
+    dm_test_obj_2 = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest")
+    dm_test_obj_2.start_session()
+    sender = threading.Timer(0.2, dm_test_obj_2.send, ("Pushed to you", "subscribed_user"))
+    sender.start()
+    pushes = dm_test_obj_1.subscribe()
+    inbox = next(pushes)
+    sender.join()
+    assert [msg['message'] for msg in inbox] == ["Pushed to you"]
+    assert inbox[0]['from'] == "testingdm"
+
+    dm_test_obj_1.stop_subscription()
+    assert list(pushes) == []
+    # pushed messages are not new anymore
+    assert dm_test_obj_1.retrieve_new() == []
+    dm_test_obj_1.close_socket()
+    dm_test_obj_2.close_socket()
+
+
+def test_paged_retrieval():
+    '''
+    Tests retrieve_page() and iter_all() return the same history as
+    retrieve_all(), page by page.
+    '''
+    dm_test_obj_1 = dsm.DirectMessenger("127.0.0.1", "paged_user", "paged_password")
+    dm_test_obj_1.start_session()
+    dm_test_obj_2 = dsm.DirectMessenger("127.0.0.1", "testingdm", "using unittest")
+    dm_test_obj_2.start_session()
+    for number in range(5):
+        assert dm_test_obj_2.send(f"Page message {number}", "paged_user") is True
+
+    history = dm_test_obj_1.retrieve_all()
+    assert len(history) >= 5
+    assert list(dm_test_obj_1.iter_all(page_size=2)) == history
+
+    inbox, cursor = dm_test_obj_1.retrieve_page(limit=2)
+    assert inbox == history[:2]
+    assert cursor is not None
+    inbox, cursor = dm_test_obj_1.retrieve_page(limit=2, cursor=cursor)
+    assert inbox == history[2:4]
+
+    # incremental: only the messages after a timestamp
+    inbox, cursor = dm_test_obj_1.retrieve_page(since=history[-2]['timestamp'])
+    assert inbox == history[-1:]
+    assert cursor is None
+
+    assert dm_test_obj_1.retrieve_page(cursor="not a cursor") is None
+    dm_test_obj_1.close_socket()
+    dm_test_obj_2.close_socket()
+
+
 def test_direct_message_class():
     '''
     Tests the functionality of the DirectMessage class is
@@ -218,4 +525,8 @@ if __name__ == "__main__":
     test_retrieve_new()
     test_retrieve_all()
     test_get_inbox_exception()
+    test_connection_reuse()
+    test_wait_new()
+    test_subscribe()
+    test_paged_retrieval()
     test_direct_message_class()
@@ -7,6 +7,7 @@ Stephanie Lee
 stephl25@uci.edu
 
 '''
+import json
 import socket
 import pytest
 import ds_protocol as dsp
@@ -162,6 +163,25 @@ def test_get_server_messages():
         assert server_messages == []
 
 
+@pytest.mark.parametrize('codec', sorted(dsp.CODECS))
+def test_codecs(codec):
+    '''
+    Tests that every codec turns dicts into bytes and back, and
+    rejects malformed frames with json.JSONDecodeError.
+    '''
+    dumps, loads = dsp.CODECS[codec]
+    msg = {"token": "2wed45ede45654edf456",
+           "directmessage": {"entry": "Héllo ✓", "recipient": "bob", "timestamp": 1.5}}
+    frame = dumps(msg) + dsp.FRAME_END
+    assert isinstance(frame, bytes)
+    assert loads(frame) == msg
+    assert loads(frame.decode()) == msg
+    assert dsp.decode_frame(dsp.encode_frame(msg)) == msg
+    for bad_frame in (b'{"token": ', b'\xff\xfe'):
+        with pytest.raises(json.JSONDecodeError):
+            loads(bad_frame)
+
+
 def test_format_join():
     '''
     Tests the format_join() method in ds_protocol.py makes a
@@ -189,6 +209,14 @@ def test_format_all():
     assert returned_dict == {"token": '2wed45ede45654edf456', "directmessage": "all"}
     assert isinstance(returned_dict, dict)
 
+    # paged variants
+    returned_dict = dsp.format_all('2wed45ede45654edf456', since='1700000000.5', limit=50)
+    assert returned_dict == {"token": '2wed45ede45654edf456', "directmessage": "all",
+                             "since": '1700000000.5', "limit": 50}
+    returned_dict = dsp.format_all('2wed45ede45654edf456', limit=50, cursor='WzEuMCwgMV0=')
+    assert returned_dict == {"token": '2wed45ede45654edf456', "directmessage": "all",
+                             "limit": 50, "cursor": 'WzEuMCwgMV0='}
+
 
 def test_format_new():
     '''
@@ -200,6 +228,26 @@ def test_format_new():
     assert isinstance(returned_dict, dict)
 
 
+def test_format_wait():
+    '''
+    Tests the format_wait() method in ds_protocol.py makes a
+    correctly formatted dict and has type dict.
+    '''
+    returned_dict = dsp.format_wait('2wed45ede45654edf456', 25)
+    assert returned_dict == {"token": '2wed45ede45654edf456', "directmessage": "new", "timeout": 25}
+    assert isinstance(returned_dict, dict)
+
+
+def test_format_subscribe():
+    '''
+    Tests the format_subscribe() method in ds_protocol.py makes a
+    correctly formatted dict and has type dict.
+    '''
+    returned_dict = dsp.format_subscribe('2wed45ede45654edf456')
+    assert returned_dict == {"token": '2wed45ede45654edf456', "directmessage": "subscribe"}
+    assert isinstance(returned_dict, dict)
+
+
 def test_format_directmsg():
     '''
     Tests the format_directmsg() method in ds_protocol.py makes a
@@ -214,11 +262,27 @@ def test_format_directmsg():
     assert isinstance(returned_dict, dict)
 
 
+def test_format_directmsg_batch():
+    '''
+    Tests the format_directmsg_batch() method in ds_protocol.py makes a
+    correctly formatted dict with one direct message per object.
+    '''
+    returned_dict = dsp.format_directmsg_batch('2wed45ede45654edf456',
+                                               [DirectMessage(), DirectMessage()])
+    direct_message = {"entry": 'Hello World!', "recipient": 'to send',
+                      "timestamp": 'random time stamp'}
+    assert returned_dict == {"token": '2wed45ede45654edf456',
+                             "directmessages": [direct_message, direct_message]}
+
+
 if __name__ == "__main__":
     test_format_join()
     test_format_all()
     test_format_new()
+    test_format_wait()
+    test_format_subscribe()
     test_format_directmsg()
+    test_format_directmsg_batch()
 
     test_init()
     test_ds_protocol_error_init()
@@ -0,0 +1,435 @@
+'''
+test_ds_store.py
+
+Tests the functionality of ds_store.py. Each test works on its own
+store directory (pytest tmp_path), no server needs to be running.
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import json
+import sqlite3
+import pytest
+import ds_store as dss
+
+
+def test_open_creates_store(tmp_path):
+    '''
+    Tests that open() creates the store directory, the layout file
+    and a snapshot per users shard plus the posts snapshot.
+    '''
+    store = dss.JsonStore(tmp_path / 'store', shards=4)
+    store.open()
+    with (tmp_path / 'store' / dss.LAYOUT_PATH).open('r', encoding='utf-8') as layout_file:
+        assert json.load(layout_file) == {'version': dss.LAYOUT_VERSION, 'shards': 4}
+    assert sorted(path.name for path in (tmp_path / 'store' / 'users').glob('*.json')) == [
+        'users-00.json', 'users-01.json', 'users-02.json', 'users-03.json']
+    assert (tmp_path / 'store' / 'posts.json').exists()
+    assert store.get_posts() == []
+    store.close()
+
+
+def test_messages_survive_restart(tmp_path):
+    '''
+    Tests that mutations are replayed from the log when the store
+    is opened again without a compaction.
+    '''
+    store = dss.JsonStore(tmp_path)
+    store.open()
+    assert store.get_or_create_user('alice', 'pwd') is None
+    assert store.get_or_create_user('bob', 'pwd') is None
+    assert store.get_or_create_user('alice', 'other') == {'password': 'pwd'}
+    assert store.send_message('hi bob', 'alice', 'bob', '1.0') is True
+    assert store.send_message('hi nobody', 'alice', 'nobody', '2.0') is False
+    assert store.create_post('alice', 'first post', '3.0') is True
+    assert store.update_bio('bob', 'bob bio', '4.0') is True
+
+    # simulate a crash: no close(), the snapshot is still empty
+    with store._shard('alice').snapshot_path.open('r', encoding='utf-8') as user_file:
+        assert json.load(user_file) == {}
+
+    reopened = dss.JsonStore(tmp_path)
+    reopened.open()
+    assert reopened.read_new_messages('bob') == [{'from': 'alice', 'message': 'hi bob',
+                                                  'timestamp': '1.0'}]
+    assert reopened.read_new_messages('bob') == []
+    assert reopened.get_posts() == [{'user': 'alice', 'entry': 'first post', 'timestamp': '3.0'}]
+    assert reopened.get_profile('bob')['bio'] == {'entry': 'bob bio', 'timestamp': '4.0'}
+    reopened.close()
+
+
+def test_compaction_is_idempotent(tmp_path):
+    '''
+    Tests that compaction folds the log into the snapshot and that
+    replaying a log already folded into the snapshot changes nothing.
+    '''
+    store = dss.JsonStore(tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pwd')
+    store.get_or_create_user('bob', 'pwd')
+    store.send_message('hi bob', 'alice', 'bob', '1.0')
+    store.create_post('bob', 'a post', '2.0')
+    shard = store._shard('bob')
+    wal = shard.wal_path.read_bytes()
+    store.close()
+
+    assert shard.wal_path.read_bytes() == b''
+    with shard.snapshot_path.open('r', encoding='utf-8') as user_file:
+        users = json.load(user_file)
+    assert len(users['bob']['messages']) == 1
+
+    # an interrupted compaction leaves the old log behind
+    shard.compacting_path.write_bytes(wal)
+    reopened = dss.JsonStore(tmp_path)
+    reopened.open()
+    assert len(reopened.read_all_messages('bob')) == 1
+    assert len(reopened.get_posts()) == 1
+    reopened.close()
+    assert not shard.compacting_path.exists()
+
+
+def test_torn_log_line(tmp_path):
+    '''
+    Tests that a partially written last record is dropped on open.
+    '''
+    store = dss.JsonStore(tmp_path, shards=1)
+    store.open()
+    store.get_or_create_user('alice', 'pwd')
+    store._shard('alice')._wal.write('{"seq": 2, "op": "jo')
+    store._shard('alice')._wal.flush()
+
+    reopened = dss.JsonStore(tmp_path)
+    reopened.open()
+    assert reopened.get_or_create_user('bob', 'pwd') is None
+    reopened.close()
+    with (tmp_path / 'users' / 'users-00.json').open('r', encoding='utf-8') as user_file:
+        assert sorted(json.load(user_file)) == ['alice', 'bob']
+
+
+def test_incomplete_backend():
+    '''
+    Tests that a Store backend missing a method cannot be created.
+    '''
+    class OpenOnly(dss.Store):
+        '''A backend that only implements open and close.'''
+        def open(self):
+            pass
+
+        def close(self):
+            pass
+
+    with pytest.raises(TypeError, match='read_new_messages'):
+        OpenOnly()
+    assert isinstance(dss.create_store('sqlite'), dss.Store)
+
+
+@pytest.mark.parametrize('backend', dss.BACKENDS)
+def test_message_index(tmp_path, backend):
+    '''
+    Tests that new and all messages come from the per-user index:
+    sorted by timestamp, and new messages are only returned once.
+    '''
+    store = dss.create_store(backend, tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pwd')
+    store.get_or_create_user('bob', 'pwd')
+    store.send_message('second', 'alice', 'bob', '20.0')
+    store.send_message('first', 'alice', 'bob', '3.5')
+    store.send_message('reply', 'bob', 'alice', '30.0')
+
+    assert [msg['message'] for msg in store.read_new_messages('bob')] == ['first', 'second']
+    assert store.read_new_messages('bob') == []
+    assert store.read_all_messages('bob') == [
+        {'from': 'alice', 'message': 'first', 'timestamp': '3.5'},
+        {'from': 'alice', 'message': 'second', 'timestamp': '20.0'},
+        {'recipient': 'alice', 'message': 'reply', 'timestamp': '30.0'}]
+    assert store.read_all_messages('nobody') is False
+    store.close()
+
+    # the index is rebuilt from the snapshot, read messages stay read
+    reopened = dss.create_store(backend, tmp_path)
+    reopened.open()
+    assert reopened.read_new_messages('bob') == []
+    assert len(reopened.read_all_messages('alice')) == 3
+    assert [msg['message'] for msg in reopened.read_new_messages('alice')] == []
+    reopened.close()
+
+
+@pytest.mark.parametrize('backend', dss.BACKENDS)
+def test_read_messages_page(tmp_path, backend):
+    '''
+    Tests paging through the history with limit/cursor and since, and
+    that only the new messages of a returned page are marked as read.
+    '''
+    store = dss.create_store(backend, tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pwd')
+    store.get_or_create_user('bob', 'pwd')
+    for number in range(5):
+        store.send_message(f'message {number}', 'alice', 'bob', f'{number + 1}.0')
+
+    page, cursor = store.read_messages_page('bob', limit=2)
+    assert [msg['message'] for msg in page] == ['message 0', 'message 1']
+    assert [msg['message'] for msg in store.read_new_messages('bob')] == [
+        'message 2', 'message 3', 'message 4']
+
+    page, cursor = store.read_messages_page('bob', limit=2, cursor=cursor)
+    assert [msg['message'] for msg in page] == ['message 2', 'message 3']
+    page, cursor = store.read_messages_page('bob', limit=2, cursor=cursor)
+    assert [msg['message'] for msg in page] == ['message 4']
+    assert cursor is None
+
+    page, cursor = store.read_messages_page('bob', since='3.0')
+    assert [msg['timestamp'] for msg in page] == ['4.0', '5.0']
+    assert store.read_messages_page('nobody', limit=1) is False
+    with pytest.raises(ValueError):
+        store.read_messages_page('bob', cursor='bad cursor')
+    store.close()
+
+
+def test_migrate_legacy_store(tmp_path):
+    '''
+    Tests that a store with the single users.json layout is refused by
+    open() and converted by migrate_legacy_store, including the records
+    still in its log.
+    '''
+    users = {'alice': {'password': 'pwd', 'bio': {'entry': '', 'timestamp': ''},
+                       'posts': [], 'messages': []},
+             'bob': {'password': 'pwd', 'bio': {'entry': '', 'timestamp': ''},
+                     'posts': [], 'messages': []}}
+    (tmp_path / 'users.json').write_text(json.dumps(users), encoding='utf-8')
+    (tmp_path / 'posts.json').write_text(json.dumps({'posts': []}), encoding='utf-8')
+    record = {'seq': 1, 'op': 'dm', 'user': 'alice', 'recipient': 'bob',
+              'entry': 'hi bob', 'timestamp': '1.0'}
+    (tmp_path / dss.LEGACY_WAL_PATH).write_text(json.dumps(record) + '\n', encoding='utf-8')
+
+    with pytest.raises(dss.StoreError):
+        dss.JsonStore(tmp_path).open()
+
+    assert dss.migrate_legacy_store(tmp_path, shards=4) == 2
+    assert (tmp_path / 'users.json.migrated').exists()
+    assert not (tmp_path / dss.LEGACY_WAL_PATH).exists()
+    with pytest.raises(dss.StoreError):
+        dss.migrate_legacy_store(tmp_path)
+
+    store = dss.JsonStore(tmp_path)
+    store.open()
+    assert store.shards == 4
+    assert store.read_new_messages('bob') == [{'from': 'alice', 'message': 'hi bob',
+                                               'timestamp': '1.0'}]
+    assert store.send_message('hi alice', 'bob', 'alice', '2.0') is True
+    assert len(store.read_all_messages('alice')) == 2
+    store.close()
+
+
+def test_sqlite_store(tmp_path):
+    '''
+    Tests the users, bio and posts of the sqlite backend and that
+    the data is still there after reopening the database.
+    '''
+    store = dss.SqliteStore(tmp_path)
+    store.open()
+    assert store.get_or_create_user('alice', 'pwd') is None
+    assert store.get_or_create_user('alice', 'other') == {'password': 'pwd'}
+    assert store.update_bio('alice', 'alice bio', '1.0') is True
+    assert store.update_bio('nobody', 'bio', '1.0') is False
+    assert store.create_post('alice', 'first post', '2.0') is True
+    assert store.create_post('alice', 'second post', '3.0') is True
+    assert store.create_post('nobody', 'post', '3.0') is False
+    assert store.send_message('hi', 'alice', 'nobody', '4.0') is False
+    store.close()
+
+    reopened = dss.SqliteStore(tmp_path)
+    reopened.open()
+    assert [post['entry'] for post in reopened.get_posts()] == ['second post', 'first post']
+    profile = reopened.get_profile('alice')
+    assert profile['bio'] == {'entry': 'alice bio', 'timestamp': '1.0'}
+    assert len(profile['posts']) == 2
+    assert reopened.get_profile('nobody') is None
+    assert reopened.get_user('alice')['messages'] == []
+    reopened.close()
+
+
+def test_sqlite_reads_do_not_take_write_lock(tmp_path):
+    '''
+    Tests that reading a history without new messages does not wait
+    for a writer, and that the new messages of a read are marked read
+    only after the rows were read.
+    '''
+    store = dss.SqliteStore(tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pwd')
+    store.get_or_create_user('bob', 'pwd')
+    store.send_message('hi bob', 'alice', 'bob', '1.0')
+    store.send_message('again', 'alice', 'bob', '2.0')
+    assert store.read_messages_page('bob', limit=1)[0] == [{'from': 'alice', 'message': 'hi bob',
+                                                            'timestamp': '1.0'}]
+    assert store.peek_new_messages('bob')[0] == [{'from': 'alice', 'message': 'again', 'timestamp': '2.0'}]
+    assert len(store.read_all_messages('bob')) == 2
+    with store._transaction(write=True) as connection:
+        assert len(store.read_all_messages('bob')) == 2
+        assert store.read_messages_page('alice', since='1.0')[0] == [
+            {'recipient': 'bob', 'message': 'again', 'timestamp': '2.0'}]
+    assert store.peek_new_messages('bob') == ([], [])
+    store.close()
+
+
+def test_sqlite_failed_commit(tmp_path):
+    '''
+    Tests that a connection whose COMMIT failed is rolled back before
+    it goes back to the pool, so the next command can use it.
+    '''
+    class FailingCommit(sqlite3.Connection):
+        '''Connection whose next COMMIT fails like a full disk.'''
+        fail = True
+
+        def execute(self, sql, *args):
+            if sql == 'COMMIT' and FailingCommit.fail:
+                FailingCommit.fail = False
+                raise sqlite3.OperationalError('database or disk is full')
+            return super().execute(sql, *args)
+
+    store = dss.SqliteStore(tmp_path)
+    store.open()
+    store.close()
+    store._connect = lambda: sqlite3.connect(store.db_path, isolation_level=None,
+                                             check_same_thread=False, factory=FailingCommit)
+    store._opened = True
+    with pytest.raises(sqlite3.OperationalError):
+        store.get_or_create_user('alice', 'pwd')
+    assert len(store._idle) == 1 and not store._idle[0].in_transaction
+    assert store.get_or_create_user('alice', 'pwd') is None
+    assert store.get_user('alice') is not None
+    store.close()
+
+
+@pytest.mark.parametrize('backend', dss.BACKENDS)
+def test_message_to_self(tmp_path, backend):
+    '''
+    Tests that a message sent to oneself shows up as sent and as received.
+    '''
+    store = dss.create_store(backend, tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pwd')
+    assert store.send_message('note', 'alice', 'alice', '1.0') is True
+    assert store.read_new_messages('alice') == [{'from': 'alice', 'message': 'note',
+                                                 'timestamp': '1.0'}]
+    assert store.read_all_messages('alice') == [
+        {'recipient': 'alice', 'message': 'note', 'timestamp': '1.0'},
+        {'from': 'alice', 'message': 'note', 'timestamp': '1.0'}]
+    store.close()
+
+
+@pytest.mark.parametrize('backend', dss.BACKENDS)
+def test_send_messages(tmp_path, backend):
+    '''
+    Tests that a batch of direct messages is stored in one go, with one
+    result per message, and survives a restart.
+    '''
+    store = dss.create_store(backend, tmp_path)
+    store.open()
+    for username in ('alice', 'bob', 'carol'):
+        store.get_or_create_user(username, 'pwd')
+    batch = [('hi bob', 'bob', '1.0'), ('hi nobody', 'nobody', '2.0'),
+             ('hi carol', 'carol', '3.0'), ('again', 'bob', '4.0'), ('note', 'alice', '5.0')]
+    assert store.send_messages('alice', batch) == [True, False, True, True, True]
+    assert store.send_messages('nobody', batch[:1]) == [False]
+    store.close()
+
+    store = dss.create_store(backend, tmp_path)
+    store.open()
+    assert store.read_new_messages('bob') == [{'from': 'alice', 'message': 'hi bob', 'timestamp': '1.0'},
+                                              {'from': 'alice', 'message': 'again', 'timestamp': '4.0'}]
+    assert store.read_new_messages('carol') == [{'from': 'alice', 'message': 'hi carol',
+                                                 'timestamp': '3.0'}]
+    assert [message['message'] for message in store.read_all_messages('alice')] == [
+        'hi bob', 'hi carol', 'again', 'note', 'note']
+    store.close()
+
+
+def test_send_messages_crash_between_shards(tmp_path):
+    '''
+    Tests that a batch the server died in the middle of logging (the
+    sender shard logged, a recipient shard not, or torn) is completed
+    on open, and only once.
+    '''
+    store = dss.JsonStore(tmp_path, shards=4)
+    store.open()
+    names = [f'user{number}' for number in range(20)]
+    sender = names[0]
+    recipients = [next(name for name in names if dss.shard_of(name, 4) == number)
+                  for number in range(4) if number != dss.shard_of(sender, 4)][:2]
+    for username in [sender, *recipients]:
+        store.get_or_create_user(username, 'pwd')
+    batch = [(f'hi {recipient}', recipient, f'{number}.0')
+             for number, recipient in enumerate(recipients, 1)]
+    assert store.send_messages(sender, batch) == [True, True]
+    # simulate a crash: the last recipient shard lost its record, the other one is torn
+    lost, torn = (store._shard(recipient).wal_path for recipient in recipients)
+    lost.write_bytes(b''.join(lost.read_bytes().splitlines(keepends=True)[:-1]))
+    torn.write_bytes(torn.read_bytes()[:-10])
+
+    for _ in range(2):
+        reopened = dss.JsonStore(tmp_path)
+        reopened.open()
+        for entry, recipient, timestamp in batch:
+            assert reopened.peek_new_messages(recipient)[0] == [{'from': sender, 'message': entry,
+                                                                 'timestamp': timestamp}]
+        assert len(reopened.read_all_messages(sender)) == 2
+        reopened.close()
+
+
+@pytest.mark.parametrize('backend', dss.BACKENDS)
+def test_posts_page(tmp_path, backend):
+    '''
+    Tests that the posts and the posts of a profile can be read one
+    page (offset, limit) at a time, newest first.
+    '''
+    store = dss.create_store(backend, tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pwd')
+    store.get_or_create_user('bob', 'pwd')
+    for number in range(5):
+        store.create_post('alice', f'post {number}', f'{number}.0')
+    store.create_post('bob', 'bob post', '9.0')
+    assert [post['entry'] for post in store.get_posts(0, 2)] == ['bob post', 'post 4']
+    assert [post['entry'] for post in store.get_posts(4, 2)] == ['post 1', 'post 0']
+    assert store.get_posts(6, 2) == []
+    assert len(store.get_posts()) == 6
+    profile = store.get_profile('alice', 1, 3)
+    assert [post['entry'] for post in profile['posts']] == ['post 3', 'post 2', 'post 1']
+    assert len(store.get_profile('alice')['posts']) == 5
+    store.close()
+
+
+@pytest.mark.parametrize('backend', dss.BACKENDS)
+def test_peek_and_mark_read(tmp_path, backend):
+    '''
+    Tests that peeking at the new messages leaves them new until
+    mark_read is called with their ids, and that a message stored
+    between the peek and mark_read stays new even if its timestamp is
+    among those of the peeked messages.
+    '''
+    store = dss.create_store(backend, tmp_path)
+    store.open()
+    store.get_or_create_user('alice', 'pwd')
+    store.get_or_create_user('bob', 'pwd')
+    for number in range(3):
+        store.send_message(f'hi {number}', 'alice', 'bob', f'{number + 1}.0')
+    messages, ids = store.peek_new_messages('bob')
+    assert [message['message'] for message in messages] == ['hi 0', 'hi 1', 'hi 2']
+    assert store.peek_new_messages('bob') == (messages, ids)
+    store.send_message('late', 'alice', 'bob', '1.5')
+    store.send_message('same time', 'alice', 'bob', '2.0')
+    store.mark_read('bob', ids[:2])
+    store.mark_read('bob', ids[:2])
+    store.close()
+
+    store = dss.create_store(backend, tmp_path)
+    store.open()
+    assert store.read_new_messages('bob') == [{'from': 'alice', 'message': 'late', 'timestamp': '1.5'},
+                                              {'from': 'alice', 'message': 'same time', 'timestamp': '2.0'},
+                                              {'from': 'alice', 'message': 'hi 2', 'timestamp': '3.0'}]
+    assert store.peek_new_messages('nobody') is False
+    store.close()
@@ -0,0 +1,52 @@
+'''
+test_metrics.py
+
+Tests the functionality of metrics.py. No server needs to be running.
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import metrics
+
+
+def test_histogram():
+    '''
+    Tests that a Histogram counts values in cumulative buckets.
+    '''
+    histogram = metrics.Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.sum == 2.65
+    assert histogram.render('latency', {'command': 'join'}) == [
+        'latency_bucket{command="join",le="0.1"} 2',
+        'latency_bucket{command="join",le="1.0"} 3',
+        'latency_bucket{command="join",le="+Inf"} 4',
+        'latency_sum{command="join"} 2.65',
+        'latency_count{command="join"} 4']
+
+
+def test_render():
+    '''
+    Tests the Prometheus text rendered by Metrics: command counters,
+    named histograms and gauges with and without labels.
+    '''
+    registry = metrics.Metrics()
+    registry.histogram('lock_wait', 'Lock waits.')
+    registry.gauge('active_connections', 'Connected clients.', lambda: 3)
+    registry.gauge('store_file_bytes', 'Store files.', lambda: [({'file': 'a "b".json'}, 10)])
+    registry.observe_command('join', 0.002)
+    registry.observe_command('join', 0.003, error=True)
+    registry.observe('lock_wait', 0.0001)
+    registry.observe('not registered', 1.0)
+
+    lines = registry.render().splitlines()
+    assert 'dsu_commands_total{command="join"} 2' in lines
+    assert 'dsu_command_errors_total{command="join"} 1' in lines
+    assert 'dsu_command_seconds_count{command="join"} 2' in lines
+    assert '# TYPE dsu_lock_wait_seconds histogram' in lines
+    assert 'dsu_lock_wait_seconds_count 1' in lines
+    assert 'dsu_active_connections 3' in lines
+    assert 'dsu_store_file_bytes{file="a \\"b\\".json"} 10' in lines
+    assert not any('not registered' in line for line in lines)
@@ -0,0 +1,320 @@
+'''
+test_profile.py
+
+Tests the functionality of Profile.py. Each test works on its own
+.dsu file (pytest tmp_path), no server needs to be running.
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import json
+import threading
+import time
+from Profile import LAZY_SCAN_FACTOR, Profile, ProfileWriter, Message
+
+
+def new_profile(tmp_path):
+    '''
+    Returns a profile saved to a new .dsu file and the file path.
+    '''
+    path = tmp_path / 'user.dsu'
+    path.touch()
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    profile.save_profile(path)
+    return profile, path
+
+
+def test_add_msg_appends(tmp_path):
+    '''
+    Tests that add_msg appends one line to the saved file and that
+    saving afterwards does not rewrite the file.
+    '''
+    profile, path = new_profile(tmp_path)
+    profile.make_friend('bob')
+    profile.save_profile(path)
+    profile.add_msg(Message('hi bob', '1.0', 'alice', 'bob'))
+    profile.add_msg(Message('hi alice', '2.0', 'bob'))
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[0])['friends'] == ['bob']
+    assert json.loads(lines[2])['entry'] == 'hi alice'
+
+    profile.save_profile(path)
+    assert path.read_text(encoding='utf-8').splitlines() == lines
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.username == 'alice'
+    assert loaded.friends == ['bob']
+    assert [msg.get_entry() for msg in loaded.get_messages()] == ['hi bob', 'hi alice']
+
+
+def test_load_old_format(tmp_path):
+    '''
+    Tests that a file in the single json object format is loaded
+    and converted to version 2 on the next save.
+    '''
+    path = tmp_path / 'old.dsu'
+    path.write_text(json.dumps({'dsuserver': '127.0.0.1', 'username': 'alice',
+                                'password': 'pwd', 'friends': ['bob'],
+                                'messages': [{'entry': 'hi', 'timestamp': '1.0',
+                                              'from_user': 'bob', 'to_user': None}]}),
+                    encoding='utf-8')
+    profile = Profile()
+    profile.load_profile(path)
+    assert profile.friends == ['bob']
+    assert profile.get_messages()[0].get_from_user() == 'bob'
+
+    profile.add_msg(Message('hello', '2.0', 'alice', 'bob'))
+    profile.save_profile(path)
+    lines = path.read_text(encoding='utf-8').splitlines()
+    assert json.loads(lines[0])['version'] == 2
+    assert len(lines) == 3
+
+
+def test_torn_last_line(tmp_path):
+    '''
+    Tests that a partially written last message is skipped on load
+    and dropped on the next save.
+    '''
+    profile, path = new_profile(tmp_path)
+    profile.add_msg(Message('kept', '1.0', 'bob'))
+    with open(path, 'a', encoding='utf-8') as dsu_file:
+        dsu_file.write('{"entry": "to')
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert [msg.get_entry() for msg in loaded.get_messages()] == ['kept']
+    loaded.add_msg(Message('new', '2.0', 'bob'))
+    loaded.save_profile(path)
+    reloaded = Profile()
+    reloaded.load_profile(path)
+    assert [msg.get_entry() for msg in reloaded.get_messages()] == ['kept', 'new']
+
+
+def test_profile_writer(tmp_path):
+    '''
+    Tests that the writer buffers a burst of messages and saves them
+    together, in the background after the delay or on close.
+    '''
+    profile, path = new_profile(tmp_path)
+    writer = ProfileWriter(profile, path, delay=60)
+    for number in range(100):
+        writer.add_msg(Message(f'message {number}', f'{number}.0', 'bob'))
+    assert len(path.read_text(encoding='utf-8').splitlines()) == 1
+    profile.make_friend('bob')
+    writer.save()
+    writer.close()
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.friends == ['bob']
+    assert len(loaded.get_messages()) == 100
+    assert not (tmp_path / 'user.dsu.tmp').exists()
+
+    writer = ProfileWriter(loaded, path, delay=0.01)
+    writer.add_msg(Message('later', '100.0', 'bob'))
+    for _ in range(100):
+        if len(path.read_text(encoding='utf-8').splitlines()) == 102:
+            break
+        time.sleep(0.01)
+    assert len(path.read_text(encoding='utf-8').splitlines()) == 102
+    writer.close()
+
+
+def test_lazy_load(tmp_path):
+    '''
+    Tests that a lazy load only loads the newest messages of each
+    contact and that older messages are read on demand, before a
+    rewrite and in the right place of the appended file.
+    '''
+    profile, path = new_profile(tmp_path)
+    profile.make_friend('bob')
+    profile.make_friend('carol')
+    profile.save_profile(path)
+    for number in range(10):
+        profile.add_msg(Message(f'bob {number}', f'{number}.0', 'bob'))
+        profile.add_msg(Message(f'carol {number}', f'{number}.5', 'alice', 'carol'))
+
+    lazy = Profile()
+    lazy.load_profile(path, newest=3)
+    assert sorted(msg.get_entry() for msg in lazy.get_messages()) == [
+        'bob 7', 'bob 8', 'bob 9', 'carol 7', 'carol 8', 'carol 9']
+    assert lazy.has_older('bob')
+    older = lazy.load_older('bob', 2)
+    assert [msg.get_entry() for msg in older] == ['bob 5', 'bob 6']
+    assert [msg.get_entry() for msg in lazy.load_older('bob')] == [
+        f'bob {number}' for number in range(5)]
+    assert not lazy.has_older('bob') or lazy.load_older('bob') == []
+
+    lazy.add_msg(Message('bob 10', '10.0', 'bob'))
+    lazy.make_friend('dave')
+    lazy.save_profile(path)
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert len(loaded.get_messages()) == 21
+    assert loaded.friends == ['bob', 'carol', 'dave']
+
+
+def test_lazy_load_is_bounded(tmp_path):
+    '''
+    Tests that a friend without messages does not make a lazy load
+    read the whole file: the lines read are bounded by newest, and
+    the older messages are still found by load_older.
+    '''
+    profile, path = new_profile(tmp_path)
+    profile.make_friend('bob')
+    profile.make_friend('nobody')  # new contact, no messages yet
+    profile.save_profile(path)
+    profile.autosave = False
+    for number in range(2000):
+        profile.add_msg(Message(f'bob {number}', f'{number}.0', 'bob'))
+    profile.save_profile(path)
+
+    lazy = Profile()
+    lazy.load_profile(path, newest=10)
+    assert [msg.get_entry() for msg in lazy.get_messages()] == [
+        f'bob {number}' for number in range(1990, 2000)]
+    history = lazy._history
+    assert history._map[history.frontier:].count(b'\n') <= LAZY_SCAN_FACTOR * 10 * 2
+    assert lazy.has_older('nobody')
+    assert len(lazy.load_older('bob')) == 1990
+
+
+def test_lazy_load_without_friends(tmp_path):
+    '''
+    Tests that a lazy load also loads the newest messages of senders
+    that are not friends, including a profile without friends.
+    '''
+    profile, path = new_profile(tmp_path)
+    profile.autosave = False
+    for number in range(30):
+        profile.add_msg(Message(f'carol {number}', f'{2 * number}.0', 'carol'))
+        profile.add_msg(Message(f'dave {number}', f'{2 * number + 1}.0', 'dave'))
+    profile.save_profile(path)
+
+    lazy = Profile()
+    lazy.load_profile(path, newest=3)
+    assert [msg.get_entry() for msg in lazy.get_conversation('carol')] == [
+        'carol 27', 'carol 28', 'carol 29']
+    assert [msg.get_entry() for msg in lazy.get_conversation('dave')] == [
+        'dave 27', 'dave 28', 'dave 29']
+    assert len(lazy.load_older('dave')) == 27
+
+
+def test_header_change_keeps_lazy_history(tmp_path):
+    '''
+    Tests that saving a new contact after a lazy load only rewrites
+    the header: the older messages stay in the file, not in memory,
+    and are still read from the right place afterwards.
+    '''
+    profile, path = new_profile(tmp_path)
+    profile.make_friend('bob')
+    profile.save_profile(path)
+    profile.autosave = False
+    for number in range(500):
+        profile.add_msg(Message(f'bob {number}', f'{number}.0', 'bob'))
+    profile.save_profile(path)
+
+    lazy = Profile()
+    lazy.load_profile(path, newest=5)
+    lazy.add_msg(Message('bob 500', '500.0', 'bob'))
+    lazy.make_friend('a contact with a long name')
+    lazy.save_profile(path)
+    assert len(lazy.get_messages()) == 6
+    assert [msg.get_entry() for msg in lazy.load_older('bob', 2)] == ['bob 493', 'bob 494']
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.friends == ['bob', 'a contact with a long name']
+    assert [msg.get_entry() for msg in loaded.get_messages()] == [
+        f'bob {number}' for number in range(501)]
+
+
+def test_writer_saves_without_lock(tmp_path):
+    '''
+    Tests that add_msg and load_older of a ProfileWriter do not wait
+    while it writes the file, and that what they changed meanwhile is
+    saved by the next flush.
+    '''
+    profile, path = new_profile(tmp_path)
+    profile.make_friend('bob')
+    profile.autosave = False
+    for number in range(50):
+        profile.add_msg(Message(f'bob {number}', f'{number}.0', 'bob'))
+    profile.save_profile(path)
+
+    lazy = Profile()
+    lazy.load_profile(path, newest=5)
+    writer = ProfileWriter(lazy, path, delay=60)
+    writing = threading.Event()
+    release = threading.Event()
+    write_save = lazy._write_save
+
+    def slow_write(save):
+        writing.set()
+        release.wait(5)
+        write_save(save)
+
+    lazy._write_save = slow_write
+    lazy.make_friend('carol')
+    writer.save()
+    flusher = threading.Thread(target=writer.flush)
+    flusher.start()
+    assert writing.wait(5)
+    writer.add_msg(Message('bob 50', '50.0', 'bob'))
+    assert [msg.get_entry() for msg in writer.load_older('bob', 2)] == ['bob 43', 'bob 44']
+    assert not release.is_set() and flusher.is_alive()
+    release.set()
+    flusher.join()
+    del lazy._write_save
+    writer.close()
+
+    loaded = Profile()
+    loaded.load_profile(path)
+    assert loaded.friends == ['bob', 'carol']
+    assert [msg.get_entry() for msg in loaded.get_messages()] == [f'bob {number}' for number in range(51)]
+
+
+def test_message_fields():
+    '''
+    Tests that Message keeps the getters and the dict style access
+    without a per-message __dict__.
+    '''
+    msg = Message('hi', '1.0', 'bob', 'alice')
+    assert not hasattr(msg, '__dict__')
+    assert msg['entry'] == msg.get_entry() == msg.entry == 'hi'
+    assert msg['timestamp'] == msg.timestamp == '1.0'
+    assert msg['from_user'] == 'bob' and msg['to_user'] == msg.user == 'alice'
+    assert msg.to_dict() == {'entry': 'hi', 'timestamp': '1.0',
+                             'from_user': 'bob', 'to_user': 'alice'}
+    assert msg == Message('hi', '1.0', 'bob', 'alice')
+    assert Message('no time').get_time() != 0
+
+
+def test_get_conversation():
+    '''
+    Tests the per contact conversation index: timestamp order,
+    limit/before and updates from add_msg and del_msg.
+    '''
+    profile = Profile('127.0.0.1', 'alice', 'pwd')
+    profile.add_msg(Message('bob 2', '2.0', 'bob'))
+    profile.add_msg(Message('to bob', '3.0', 'alice', 'bob'))
+    profile.add_msg(Message('carol 1', '1.0', 'carol'))
+    assert [msg.get_entry() for msg in profile.get_conversation('bob')] == ['bob 2', 'to bob']
+
+    profile.add_msg(Message('bob 1', '1.0', 'bob'))
+    profile.add_msg(Message('bob 4', '4.0', 'bob'))
+    assert [msg.get_entry() for msg in profile.get_conversation('bob')] == [
+        'bob 1', 'bob 2', 'to bob', 'bob 4']
+    assert [msg.get_entry() for msg in profile.get_conversation('bob', limit=2)] == [
+        'to bob', 'bob 4']
+    assert [msg.get_entry() for msg in profile.get_conversation('bob', limit=2, before='3.0')] == [
+        'bob 1', 'bob 2']
+    assert profile.get_conversation('nobody') == []
+
+    assert profile.del_msg(1)
+    assert [msg.get_entry() for msg in profile.get_conversation('bob')] == [
+        'bob 1', 'bob 2', 'bob 4']
+    assert [msg.get_entry() for msg in profile.get_conversation('carol')] == ['carol 1']
@@ -0,0 +1,333 @@
+'''
+test_server.py
+
+Tests the functionality of server.py. Every test starts its own
+DSUServer on a free port with a store in pytest's tmp_path, no server
+needs to be running.
+
+Stephanie Lee
+stephl25@uci.edu
+
+'''
+import re
+import socket
+import struct
+import threading
+import time
+import pytest
+import ds_protocol as dsp
+import ds_store
+import server
+
+
+def start_server(tmp_path, engine='threaded', **options):
+    '''
+    Starts a DSUServer on a free port in a daemon thread and returns it
+    once it is listening.
+    '''
+    dsu_server = server.DSUServer('127.0.0.1', 0, engine, store_dir=tmp_path / 'store', **options)
+    threading.Thread(target=dsu_server.start_server, daemon=True).start()
+    assert dsu_server.listening.wait(5)
+    return dsu_server
+
+
+def connect(dsu_server):
+    '''
+    Opens a ds_protocol connection to dsu_server.
+    '''
+    sock = socket.create_connection(('127.0.0.1', dsu_server.port), timeout=5)
+    return dsp.init(sock)
+
+
+def request(conn, command: dict):
+    '''
+    Sends command and returns the response as a DataTuple.
+    '''
+    dsp.write(conn, command)
+    return dsp.read_data(dsp.read_frame(conn))
+
+
+def join(dsu_server, username: str):
+    '''
+    Opens a connection to dsu_server and joins username on it.
+    Returns the connection and the token.
+    '''
+    conn = connect(dsu_server)
+    return conn, dsp.get_token(request(conn, dsp.format_join(username, 'pwd')))
+
+
+def direct_message(token: str, entry: str, recipient: str) -> dict:
+    '''
+    Returns a directmessage command.
+    '''
+    return {'token': token, 'directmessage': {'entry': entry, 'recipient': recipient,
+                                              'timestamp': str(time.time())}}
+
+
+def wait_until(condition, timeout=5.0):
+    '''
+    Waits for condition() to be true, the server works in other threads.
+    '''
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+@pytest.mark.parametrize('engine', server.ENGINES)
+def test_round_trip(tmp_path, engine):
+    '''
+    Tests join, post, directmessage and new against a server of each
+    engine, including two commands sent in one write.
+    '''
+    dsu_server = start_server(tmp_path, engine)
+    alice, alice_token = join(dsu_server, 'alice')
+    bob, bob_token = join(dsu_server, 'bob')
+    assert request(alice, dsp.format_join('alice', 'wrong')).type == 'error'
+
+    post = {'token': alice_token, 'post': {'entry': 'hello world', 'timestamp': '1.0'}}
+    assert request(alice, post).type == 'ok'
+    assert [entry['entry'] for entry in dsu_server.store.get_posts()] == ['hello world']
+
+    dsp.write_many(alice, [direct_message(alice_token, 'hi bob', 'bob'),
+                           direct_message(alice_token, 'again', 'bob')])
+    assert dsp.read_data(dsp.read_frame(alice)).type == 'ok'
+    assert dsp.read_data(dsp.read_frame(alice)).type == 'ok'
+    assert request(alice, direct_message(alice_token, 'hi', 'nobody')).type == 'error'
+
+    inbox = dsp.get_server_messages(request(bob, dsp.format_new(bob_token)))
+    assert [(message['from'], message['message']) for message in inbox] == [
+        ('alice', 'hi bob'), ('alice', 'again')]
+    assert dsp.get_server_messages(request(bob, dsp.format_new(bob_token))) == []
+    assert request(bob, dsp.format_new(alice_token)).type == 'error'
+
+
+def test_unknown_engine():
+    '''
+    Tests that DSUServer refuses an engine it does not have.
+    '''
+    with pytest.raises(ValueError):
+        server.DSUServer(engine='twisted')
+
+
+def test_line_framer_split_and_joined_frames():
+    '''
+    Tests that LineFramer keeps a frame split over several reads until
+    its line ending arrives and returns every frame of one read.
+    '''
+    framer = server.LineFramer()
+    assert framer.feed(b'{"join": ') == []
+    assert framer.feed(b'1}\r') == []
+    assert framer.feed(b'\n{"a": 2}\r\n{"b": 3}\n{"c"') == [b'{"join": 1}', b'{"a": 2}', b'{"b": 3}']
+    assert framer.feed(b': 4}\r\n') == [b'{"c": 4}']
+
+
+@pytest.mark.parametrize('line_end', [b'\r\n', b'\n'])
+def test_line_framer_size_limit(line_end):
+    '''
+    Tests that a frame of exactly max_frame_size bytes is accepted with
+    either line ending and that one byte more is rejected.
+    '''
+    framer = server.LineFramer(10)
+    assert framer.feed(b'0123456789' + line_end) == [b'0123456789']
+    assert framer.feed(b'0123456789') == []
+    assert framer.feed(line_end) == [b'0123456789']
+    with pytest.raises(server.FrameTooLarge):
+        server.LineFramer(10).feed(b'0123456789a' + line_end)
+
+
+def test_line_framer_no_line_ending():
+    '''
+    Tests that more than max_frame_size bytes without a line ending are
+    rejected before the line ending arrives.
+    '''
+    framer = server.LineFramer(10)
+    assert framer.feed(b'0123456789\r') == []  # the \n of the CRLF is still to come
+    assert framer.feed(b'\n') == [b'0123456789']
+    assert framer.feed(b'0123456789') == []
+    with pytest.raises(server.FrameTooLarge):
+        framer.feed(b'a')
+
+
+@pytest.mark.parametrize('engine', server.ENGINES)
+def test_reset_connection_detaches_session(tmp_path, engine):
+    '''
+    Tests that the session of a connection reset by the client is
+    detached, then swept once session_ttl has passed.
+    '''
+    dsu_server = start_server(tmp_path, engine, session_ttl=0.2)
+    conn = connect(dsu_server)
+    token = dsp.get_token(request(conn, dsp.format_join('reset_user', 'pwd')))
+    assert token in dsu_server.sessions
+    # SO_LINGER 0: close() sends a RST instead of a FIN
+    conn.socket.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    conn.send.close()
+    conn.recv.close()
+    conn.socket.close()
+    wait_until(lambda: dsu_server.sessions._sessions[token][1] == 0)
+    time.sleep(0.3)
+    assert dsu_server.sessions.sweep() == 1
+    assert token not in dsu_server.sessions
+
+
+@pytest.mark.parametrize('engine', server.ENGINES)
+def test_slow_subscriber_does_not_block_senders(tmp_path, engine):
+    '''
+    Tests that a subscriber that stops reading does not hold up the
+    senders, and that the messages it was not sent stay new.
+    '''
+    dsu_server = start_server(tmp_path, engine)
+    subscriber, subscriber_token = join(dsu_server, 'slow_reader')
+    assert request(subscriber, dsp.format_subscribe(subscriber_token)).type == 'ok'
+    # the subscriber never reads again, its socket buffers fill up
+    sender, token = join(dsu_server, 'fast_sender')
+    sender.socket.settimeout(5)
+    entry = 'x' * 50000
+    for _ in range(300):
+        assert request(sender, direct_message(token, entry, 'slow_reader')).type == 'ok'
+    poller, poller_token = join(dsu_server, 'slow_reader')
+    unsent = dsp.get_server_messages(request(poller, dsp.format_new(poller_token)))
+    assert 0 < len(unsent) < 300
+
+
+def web_client(tmp_path, backend='json'):
+    '''
+    Returns a DSUServer with an open store of backend (not listening)
+    and a flask test client of the pages reading from it.
+    '''
+    dsu_server = server.DSUServer(store_dir=tmp_path / 'store', store_backend=backend)
+    dsu_server._create_storage_system()
+    server.app.config.update(DSU_STORE=dsu_server.store, DSU_METRICS=dsu_server.metrics,
+                             DSU_PAGES=dsu_server.pages)
+    dsu_server.store.get_or_create_user('alice', 'pwd')
+    for number in range(5):
+        dsu_server._create_post('alice', f'post {number}', f'{number}.0')
+    return dsu_server, server.app.test_client()
+
+
+def test_page_cache_lru():
+    '''
+    Tests that PageCache drops the least recently used page and does
+    not keep a page rendered before an invalidation of its group.
+    '''
+    pages = server.PageCache(size=2)
+    for page in (1, 2):
+        pages.put(('posts', page, 20), pages.version('posts'), f'page {page}')
+    assert pages.get(('posts', 1, 20))[1] == 'page 1'
+    pages.put(('posts', 3, 20), pages.version('posts'), 'page 3')
+    assert pages.get(('posts', 2, 20)) is None
+    assert pages.get(('posts', 1, 20)) is not None
+
+    version = pages.version(('user', 'alice'))
+    pages.invalidate(('user', 'alice'))
+    etag, html = pages.put((('user', 'alice'), 1, 20), version, 'stale')
+    assert etag and html == 'stale'
+    assert pages.get((('user', 'alice'), 1, 20)) is None
+
+
+def test_posts_etag(tmp_path):
+    '''
+    Tests that /posts is answered with an ETag, a 304 when the client
+    sends it back, and a new page once a post was created.
+    '''
+    dsu_server, client = web_client(tmp_path)
+    response = client.get('/posts')
+    assert response.status_code == 200 and response.headers['ETag']
+    etag = response.headers['ETag']
+    cached = client.get('/posts', headers={'If-None-Match': etag})
+    assert cached.status_code == 304 and cached.data == b''
+
+    dsu_server._create_post('alice', 'newest post', '9.0')
+    response = client.get('/posts', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and 'newest post' in response.text
+    assert response.headers['ETag'] != etag
+    dsu_server.store.close()
+
+
+@pytest.mark.parametrize('backend', ds_store.BACKENDS)
+def test_posts_pages(tmp_path, backend):
+    '''
+    Tests the page and limit parameters of /posts and /user/<username>,
+    including out of range and invalid values, on both store backends.
+    '''
+    dsu_server, client = web_client(tmp_path, backend)
+    first = client.get('/posts?limit=2').text
+    assert 'post 4' in first and 'post 3' in first and 'post 2' not in first
+    assert 'Older posts' in first and 'Newer posts' not in first
+    last = client.get('/posts?limit=2&page=3').text
+    assert 'post 0' in last and 'Older posts' not in last and 'Newer posts' in last
+    assert 'Nothing to see here' in client.get('/posts?limit=2&page=9').text
+    # invalid values fall back to the defaults, limit is clamped to 1..MAX_PAGE_SIZE
+    assert client.get('/posts?page=x&limit=y').text == client.get('/posts').text
+    assert 'post 3' not in client.get('/posts?limit=-5').text
+    assert 'post 0' in client.get(f'/posts?limit={server.MAX_PAGE_SIZE + 1}').text
+    # a page past the end of any store, too large for an sqlite OFFSET
+    huge = client.get('/posts?page=99999999999999999999')
+    assert huge.status_code == 200 and 'Nothing to see here' in huge.text
+    assert client.get('/user/alice?page=99999999999999999999').status_code == 200
+
+    profile = client.get('/user/alice?page=2&limit=2').text
+    assert 'post 2' in profile and 'post 1' in profile and 'post 4' not in profile
+    assert client.get('/user/nobody').text == 'User not found...'
+    dsu_server.store.close()
+
+
+def test_profile_invalidated(tmp_path):
+    '''
+    Tests that a cached profile page is rendered again after a bio
+    update, and that the page of another user stays cached.
+    '''
+    dsu_server, client = web_client(tmp_path)
+    dsu_server.store.get_or_create_user('bob', 'pwd')
+    assert 'new bio' not in client.get('/user/alice').text
+    bob_etag = client.get('/user/bob').headers['ETag']
+    dsu_server._update_bio('alice', 'new bio', '10.0')
+    assert 'new bio' in client.get('/user/alice').text
+    assert (('user', 'bob'), 1, server.PAGE_SIZE) in dsu_server.pages._pages
+    assert client.get('/user/bob', headers={'If-None-Match': bob_etag}).status_code == 304
+    dsu_server.store.close()
+
+
+def scrape(client) -> dict:
+    '''
+    Requests /metrics and returns {metric with its labels: value},
+    checking that every line is in the Prometheus text format.
+    '''
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type == server.METRICS_CONTENT_TYPE
+    samples = {}
+    for line in response.text.splitlines():
+        if line.startswith('#'):
+            assert re.fullmatch(r'# (HELP \w+ .+|TYPE \w+ (counter|gauge|histogram))', line), line
+            continue
+        match = re.fullmatch(r'(\w+(?:\{.*\})?) (\S+)', line)
+        assert match, line
+        samples[match.group(1)] = float(match.group(2))
+    return samples
+
+
+def test_metrics_page(tmp_path):
+    '''
+    Tests that /metrics serves the metrics of the server in the
+    Prometheus text format and that the counters follow the commands.
+    '''
+    dsu_server = start_server(tmp_path)
+    server.app.config.update(DSU_STORE=dsu_server.store, DSU_METRICS=dsu_server.metrics,
+                             DSU_PAGES=dsu_server.pages)
+    client = server.app.test_client()
+    alice, alice_token = join(dsu_server, 'alice')
+    before = scrape(client)
+    assert before['dsu_commands_total{command="join"}'] == 1
+    assert before['dsu_active_connections'] == 1
+
+    bob, _ = join(dsu_server, 'bob')
+    assert request(alice, direct_message(alice_token, 'hi bob', 'bob')).type == 'ok'
+    assert request(alice, direct_message(alice_token, 'hi', 'nobody')).type == 'error'
+    after = scrape(client)
+    assert after['dsu_commands_total{command="join"}'] == 2
+    assert after['dsu_commands_total{command="directmessage_send"}'] == 2
+    assert after['dsu_command_errors_total{command="directmessage_send"}'] == 1
+    assert after['dsu_command_seconds_count{command="directmessage_send"}'] == 2
+    assert after['dsu_decode_seconds_count'] > before['dsu_decode_seconds_count']
+    assert after['dsu_active_connections'] == 2